@@ -0,0 +1,92 @@
+import os
+import time
+import tempfile
+import numpy as np
+
+import np2_ultra.tools.compress_tools as ct
+
+'''
+Benchmark of the .cdat format in compress_tools: compression ratio, compress and full decode throughput, and random
+window reads through CompressedRecording against the same reads from a memmap of the continuous.dat file.
+Uses --raw_data_file if given, otherwise writes synthetic int16 data to a temporary folder (a shared slow drift plus
+per-channel noise, so it compresses more like a recording than uniform noise would).
+
+    python benchmarks/bench_compress.py --seconds 60 --n_threads 1 4
+    python benchmarks/bench_compress.py --raw_data_file /path/to/continuous.dat
+'''
+
+def write_synthetic(raw_data_file, seconds, n_channels, sample_rate=30000.):
+    rng = np.random.RandomState(0)
+    n_samples = int(seconds*sample_rate)
+    with open(raw_data_file, 'wb') as f:
+        for start in range(0, n_samples, 300000):
+            n = min(300000, n_samples-start)
+            drift = np.cumsum(rng.normal(0, 2, size=(n, 1)), axis=0)
+            f.write((drift + rng.normal(0, 15, size=(n, n_channels))).astype(np.int16).tobytes())
+
+def read_windows(data, starts, window_samples):
+    total = 0
+    for s in starts:
+        total += int(np.asarray(data[s:s+window_samples]).sum(dtype=np.int64))
+    return total
+
+def run_benchmark(raw_data_file=None, seconds=60., n_channels=384, n_threads=(1, 4), chunk_samples=3000, level=1,
+                    n_windows=200, window_samples=90):
+    folder = tempfile.mkdtemp()
+    if raw_data_file is None:
+        raw_data_file = os.path.join(folder, 'continuous.dat')
+        write_synthetic(raw_data_file, seconds, n_channels)
+    size_mb = os.path.getsize(raw_data_file)/1e6
+    print("{:.0f} MB of {} channel data".format(size_mb, n_channels))
+
+    for threads in n_threads:
+        compressed_file = os.path.join(folder, 'continuous_{}.cdat'.format(threads))
+        start = time.perf_counter()
+        ct.compress_file(raw_data_file, compressed_file, n_channels=n_channels, chunk_samples=chunk_samples, level=level,
+                            n_threads=threads)
+        compress_seconds = time.perf_counter() - start
+        decoded_file = os.path.join(folder, 'decoded_{}.dat'.format(threads))
+        start = time.perf_counter()
+        ct.decompress_file(compressed_file, decoded_file, n_threads=threads)
+        decode_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        matches = ct.verify_compressed_file(compressed_file, raw_data_file, n_threads=threads)
+        verify_seconds = time.perf_counter() - start
+        print("{} threads: ratio {:.2f}x, compress {:.0f} MB/s, decompress to file {:.0f} MB/s, verify {:.0f} MB/s, lossless: {}".format(
+                threads, os.path.getsize(raw_data_file)/os.path.getsize(compressed_file), size_mb/compress_seconds,
+                size_mb/decode_seconds, size_mb/verify_seconds, matches))
+        os.remove(decoded_file)
+
+    raw_data = np.memmap(raw_data_file, dtype='int16', mode='r')
+    raw_data = np.reshape(raw_data[:int(raw_data.size/n_channels)*n_channels], (-1, n_channels))
+    recording = ct.CompressedRecording(compressed_file)
+    starts = np.random.RandomState(1).randint(0, raw_data.shape[0]-window_samples, n_windows)
+    start = time.perf_counter()
+    raw_total = read_windows(raw_data, starts, window_samples)
+    raw_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    compressed_total = read_windows(recording, starts, window_samples)
+    compressed_seconds = time.perf_counter() - start
+    print("{} random {} sample windows: memmap {:.1f} ms, .cdat {:.1f} ms ({:.1f}x), same data: {}".format(n_windows,
+            window_samples, raw_seconds*1e3, compressed_seconds*1e3, compressed_seconds/raw_seconds, raw_total == compressed_total))
+    recording.close()
+    del raw_data
+
+    for name in os.listdir(folder):
+        os.remove(os.path.join(folder, name))
+    os.rmdir(folder)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--raw_data_file', default=None)
+    parser.add_argument('--seconds', type=float, default=60.)
+    parser.add_argument('--n_channels', type=int, default=384)
+    parser.add_argument('--n_threads', nargs="+", type=int, default=[1, 4])
+    parser.add_argument('--chunk_samples', type=int, default=3000)
+    parser.add_argument('--level', type=int, default=1)
+    args = parser.parse_args()
+
+    run_benchmark(args.raw_data_file, args.seconds, args.n_channels, n_threads=args.n_threads,
+                    chunk_samples=args.chunk_samples, level=args.level)
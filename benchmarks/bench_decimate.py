@@ -0,0 +1,70 @@
+import os
+import time
+import tempfile
+import numpy as np
+
+import np2_ultra.tools.signal_tools as st
+
+'''
+Benchmark of signal_tools.decimate_file (chunked polyphase FIR on a thread pool) against filtering the whole file
+in memory with one multiply-add per tap, which computes the same output samples.
+Writes a synthetic int16 continuous.dat to a temporary folder, and checks the outputs match.
+
+    python benchmarks/bench_decimate.py --seconds 60 --n_threads 1 4
+'''
+
+def whole_file_decimate(raw_data_file, n_channels, taps, decimation):
+    """
+    Load the whole file, pad it by half the filter on either side and accumulate every tap over the kept output samples.
+    """
+    data = np.fromfile(raw_data_file, dtype=np.int16).reshape(-1, n_channels)
+    half = (taps.size-1)//2
+    n_out = int(np.ceil(data.shape[0]/decimation))
+    padded = st.read_padded(data, -half, (n_out-1)*decimation + half + 1)
+    decimated = np.zeros((n_out, n_channels), dtype=np.float32)
+    for j in range(taps.size):
+        decimated += taps[j] * padded[j:j+(n_out-1)*decimation+1:decimation]
+    return np.clip(np.round(decimated), -32768, 32767).astype(np.int16)
+
+def run_benchmark(seconds=60., n_channels=384, sample_rate=30000., n_threads=(1, 4)):
+    folder = tempfile.mkdtemp()
+    raw_data_file = os.path.join(folder, 'continuous.dat')
+    rng = np.random.RandomState(0)
+    n_samples = int(seconds*sample_rate)
+    with open(raw_data_file, 'wb') as f:
+        for start in range(0, n_samples, 300000):
+            f.write(rng.randint(-500, 500, size=(min(300000, n_samples-start), n_channels)).astype(np.int16).tobytes())
+    size_mb = os.path.getsize(raw_data_file)/1e6
+    print("{:.0f} MB of {} channel data".format(size_mb, n_channels))
+
+    decimation = 12
+    taps = st.design_lowpass(1000., sample_rate, 24*decimation)
+    start = time.perf_counter()
+    reference = whole_file_decimate(raw_data_file, n_channels, taps, decimation)
+    seconds_taken = time.perf_counter() - start
+    print("whole file, per-tap loop: {:.1f} s ({:.0f} MB/s)".format(seconds_taken, size_mb/seconds_taken))
+
+    for threads in n_threads:
+        lfp_file = os.path.join(folder, 'lfp_{}.dat'.format(threads))
+        start = time.perf_counter()
+        st.decimate_file(raw_data_file, lfp_file, n_channels=n_channels, sample_rate=sample_rate, n_threads=threads)
+        seconds_taken = time.perf_counter() - start
+        decimated = np.fromfile(lfp_file, dtype=np.int16).reshape(-1, n_channels)
+        max_difference = np.abs(decimated.astype(int) - reference).max()
+        print("decimate_file, {} threads: {:.1f} s ({:.0f} MB/s), max difference from whole file: {} bits".format(threads,
+                seconds_taken, size_mb/seconds_taken, max_difference))
+
+    for name in os.listdir(folder):
+        os.remove(os.path.join(folder, name))
+    os.rmdir(folder)
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--seconds', type=float, default=60.)
+    parser.add_argument('--n_channels', type=int, default=384)
+    parser.add_argument('--n_threads', nargs="+", type=int, default=[1, 4])
+    args = parser.parse_args()
+
+    run_benchmark(args.seconds, args.n_channels, n_threads=args.n_threads)
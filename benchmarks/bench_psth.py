@@ -0,0 +1,81 @@
+import time
+import numpy as np
+
+import np2_ultra.tools.analysis_tools as ant
+
+'''
+Benchmark of analysis_tools.getPSTH against the per-trial boolean mask version it replaced.
+Simulates one unit firing at a constant rate over a session and a set of opto trials, and checks the outputs match.
+With --n_clusters, also times analysis_tools.get_population_psth against calling getPSTH once per cluster.
+
+    python benchmarks/bench_psth.py --rate_hz 30 --minutes 60 --n_trials 600 --n_clusters 300
+'''
+
+def mask_psth(spikes, startTimes, windowDur, binSize=0.01, avg=True):
+    """
+    getPSTH before the searchsorted version: a boolean mask over the whole spike train for every trial.
+    """
+    bins = np.arange(0,windowDur+binSize,binSize)
+    counts = np.zeros((len(startTimes),bins.size-1))
+    for i,start in enumerate(startTimes):
+        counts[i] = np.histogram(spikes[(spikes>=start) & (spikes<=start+windowDur)]-start,bins)[0]
+    if avg:
+        counts = counts.mean(axis=0)
+    counts /= binSize
+    t = bins[:-1]
+    return counts,t
+
+def best_time(function, repeats):
+    times = []
+    for r in range(repeats):
+        start = time.perf_counter()
+        output = function()
+        times.append(time.perf_counter() - start)
+    return min(times), output
+
+def run_benchmark(rate_hz=30., minutes=60., n_trials=600, repeats=5, seed=0):
+    rng = np.random.RandomState(seed)
+    duration = minutes*60
+    spikes = np.sort(rng.uniform(0, duration, int(rate_hz*duration)))
+    startTimes = np.sort(rng.uniform(0, duration-3, n_trials))
+    print("{} spikes, {} trials".format(spikes.size, n_trials))
+    for name, windowDur, binSize in [('2 s window, 10 ms bins', 2., 0.01), ('30 ms window, 0.5 ms bins', 0.03, 0.0005)]:
+        mask_seconds, (mask_counts, mask_t) = best_time(lambda: mask_psth(spikes, startTimes, windowDur, binSize, avg=False), repeats)
+        new_seconds, (counts, t) = best_time(lambda: ant.getPSTH(spikes, startTimes, windowDur, binSize, avg=False), repeats)
+        same = np.array_equal(counts, mask_counts) and np.array_equal(t, mask_t)
+        print("{}: mask {:.1f} ms, searchsorted {:.1f} ms ({:.0f}x), outputs match: {}".format(name, mask_seconds*1e3, new_seconds*1e3,
+                mask_seconds/new_seconds, same))
+
+def run_population_benchmark(n_clusters=300, rate_hz=5., minutes=60., n_trials=(100, 1000), repeats=3, seed=0):
+    rng = np.random.RandomState(seed)
+    duration = minutes*60
+    n_spikes = int(n_clusters*rate_hz*duration)
+    spike_times = np.sort(rng.uniform(0, duration, n_spikes))
+    spike_index = ant.SpikeIndex(rng.randint(0, n_clusters, n_spikes))
+    cluster_ids = list(range(n_clusters))
+    print("{} clusters, {} spikes".format(n_clusters, n_spikes))
+    for trials in n_trials:
+        startTimes = np.sort(rng.uniform(0, duration-3, trials))
+        for windowDur, binSize in [(1., 0.01), (0.05, 0.001)]:
+            loop = lambda: np.array([ant.getPSTH(spike_times[spike_index.spikes_in_cluster(c)], startTimes, windowDur, binSize, avg=False)[0]
+                                        for c in cluster_ids])
+            loop_seconds, loop_counts = best_time(loop, repeats)
+            population_seconds, (counts, t) = best_time(lambda: ant.get_population_psth(spike_times, spike_index, cluster_ids,
+                                                                                        startTimes, windowDur, binSize), repeats)
+            print("{} trials, {} s window, {} ms bins: getPSTH per cluster {:.0f} ms, get_population_psth {:.0f} ms, outputs match: {}".format(
+                    trials, windowDur, binSize*1e3, loop_seconds*1e3, population_seconds*1e3, np.array_equal(counts, loop_counts)))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate_hz', type=float, default=30.)
+    parser.add_argument('--minutes', type=float, default=60.)
+    parser.add_argument('--n_trials', type=int, default=600)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--n_clusters', type=int, default=None)
+    args = parser.parse_args()
+
+    run_benchmark(args.rate_hz, args.minutes, args.n_trials, args.repeats)
+    if args.n_clusters is not None:
+        run_population_benchmark(args.n_clusters, minutes=args.minutes, repeats=args.repeats)
@@ -1,5 +1,8 @@
 import argparse
+import queue
+import threading
 from np2_ultra.scripts import transfer, kilosort, waveforms
+from np2_ultra.tools import engine_tools
 
 '''
 Runs transfer to data drive, kilosort, and waveform extraction on a session.
@@ -16,15 +19,47 @@ if __name__ == "__main__":
     parser.add_argument('--destination', nargs="+", default=('dest_root', 'np2_data'))
     parser.add_argument('--openephys_folder',default='false')
     parser.add_argument('--path_to_files', default=None, type=str)
+    parser.add_argument('--also_backup', action='store_true', help="write the backup drive copy from the same read of the acquisition data")
+    parser.add_argument('--max_mb_per_second', type=float, default=None)
+    parser.add_argument('--start_when_ready', action='store_true', help="run kilosort on each recording as soon as its ephys and sync data land")
     #for kilosort and waveforms
     parser.add_argument('--probes_to_run', nargs="+", default='all')
     parser.add_argument('--recordings_to_run', nargs="+", default='all')
     parser.add_argument('--pxi_dict', default='default')
+    #for kilosort
+    parser.add_argument('--n_jobs', type=int, default=1)
+    parser.add_argument('--gpu_devices', nargs="+", type=int, default=None)
+    parser.add_argument('--scratch_dir', default=None, help="local folder to sort from, see scripts/kilosort.py")
+    parser.add_argument('--scratch_gb', type=float, default=500.)
+    parser.add_argument('--shared_engine', action='store_true', help="sort on MATLAB sessions shared with matlab.engine.shareEngine, and leave them running for the next session")
     #for waveforms
     parser.add_argument('--use_json_params', default=None)
 
     args = parser.parse_args()
 
-    transfer.TransferFiles(args.date, args.mouse_id, args.destination, args.openephys_folder, args.path_to_files).run_it()
-    kilosort.RunKilosort(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run, args.pxi_dict)
+    #started before transfer so the engines warm up while data copies
+    engine_tools.get_service(n_engines=args.n_jobs, connect_shared=args.shared_engine)
+    extra_destinations = [("backup_drive", '')] if args.also_backup else None
+    transferer = transfer.TransferFiles(args.date, args.mouse_id, args.destination, args.openephys_folder, args.path_to_files,
+                                        extra_destinations=extra_destinations, max_mb_per_second=args.max_mb_per_second)
+    if args.start_when_ready:
+        #sort each recording while the lower priority files (opto, videos, images) are still copying
+        transfer_thread = threading.Thread(target=transferer.run_it)
+        transfer_thread.start()
+        while transfer_thread.is_alive() or transferer.ready_recordings.empty()==False:
+            try:
+                recording = transferer.ready_recordings.get(timeout=5)
+            except queue.Empty:
+                continue
+            if (args.recordings_to_run == 'all') or (recording in args.recordings_to_run):
+                kilosort.RunKilosort(args.date, args.mouse_id, args.probes_to_run, [recording], args.pxi_dict,
+                                        n_jobs=args.n_jobs, gpu_devices=args.gpu_devices,
+                                        scratch_dir=args.scratch_dir, scratch_gb=args.scratch_gb)
+        transfer_thread.join()
+    else:
+        transferer.run_it()
+        kilosort.RunKilosort(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run, args.pxi_dict,
+                                n_jobs=args.n_jobs, gpu_devices=args.gpu_devices, scratch_dir=args.scratch_dir, scratch_gb=args.scratch_gb)
+    #quits engines this process started, only disconnects from shared ones
+    engine_tools.shutdown_services()
     waveforms.GetWaveforms(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run, args.pxi_dict, args.use_json_params).run_it()
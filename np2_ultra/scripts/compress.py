@@ -0,0 +1,132 @@
+import os
+import time
+
+from np2_ultra.tools import file_tools
+import np2_ultra.tools.compress_tools as ct
+
+class CompressSession():
+    """
+    Losslessly compress (or decompress) the continuous.dat files of a session into the chunked .cdat format.
+    Compressed sessions can be read directly by GetFiles.get_raw_recording() and waveform extraction.
+
+    Methods
+    ----------
+    run_it()
+    get_jobs()
+    compress_one(raw_data_file, n_channels)
+    decompress_one(compressed_file)
+    """
+    def __init__(self, date, mouse_id, probes_to_run='all', recordings_to_run='all', pxi_dict='default',
+                    decompress=False, remove_source=False, chunk_samples=3000, level=1, n_threads=4):
+        """
+        Parameters
+        ----------
+        date: str
+            The date of the session in YYYY-MM-DD format
+        mouse_id: str
+            The 6 digit mouse number
+        probes_to_run: list, optional, default = 'all'
+            Optionally only process a subset of probes in the session, eg ['A', 'E']
+        recordings_to_run: list, optional, default = 'all'
+            Optionally only process a subset of recordings in the session, eg ['recording2']
+        pxi_dict: path, optional, default = 'default'
+            Pass a path to a JSON containing a customized dictionary of mappings of probe letter to OpenEphys folder suffix.
+        decompress: bool, optional, default = False
+            Write continuous.dat files back out from continuous.cdat files instead of compressing.
+        remove_source: bool, optional, default = False
+            Delete the input file once the output has been written, and every chunk of the .cdat file has been decoded and
+            its SHA-1 matched against the continuous.dat file (see compress_tools.verify_compressed_file()).
+        chunk_samples: int, optional, default = 3000
+            Samples per compressed chunk (0.1 s at 30 kHz).
+        level: int, optional, default = 1
+            zlib compression level.
+        n_threads: int, optional, default = 4
+            Number of chunks compressed or decompressed at the same time.
+        """
+        self.decompress = decompress
+        self.remove_source = remove_source
+        self.chunk_samples = chunk_samples
+        self.level = level
+        self.n_threads = n_threads
+
+        self.files = file_tools.GetFiles(date, mouse_id, probes=probes_to_run, recordings=recordings_to_run, pxi_dict=pxi_dict)
+        self.files.determine_recordings(recordings_to_run)
+        self.files.get_probe_dirs(probes_to_run)
+
+    def get_jobs(self):
+        """
+        Returns
+        ----------
+        jobs: list
+            (input file, n_channels) for every AP and LFP band file of the selected recordings/probes that has an input to convert.
+        """
+        suffix = ct.COMPRESSED_SUFFIX if self.decompress else '.dat'
+        jobs = []
+        for recording, probes in self.files.probe_data_dirs.items():
+            for probe, data_dir in probes.items():
+                band_dirs = {'spike': data_dir, 'lfp': data_dir[:-2] + self.files.pxi_dict['lfp'][probe]}
+                for band, band_dir in band_dirs.items():
+                    input_file = os.path.join(band_dir, 'continuous' + suffix)
+                    if os.path.exists(input_file):
+                        jobs.append((input_file, self.files.get_channel_count(band=band)))
+        return jobs
+
+    def run_it(self):
+        """
+        Compresses (or decompresses) every file returned by get_jobs().
+        if __name__ == __main__ automatically calls this function.
+        """
+        for input_file, n_channels in self.get_jobs():
+            start = time.time()
+            if self.decompress:
+                output_file = self.decompress_one(input_file)
+            else:
+                output_file = self.compress_one(input_file, n_channels)
+            input_size, output_size = os.path.getsize(input_file), os.path.getsize(output_file)
+            print("{} -> {}: {:.2f}x size change, {:.1f} MB/s".format(input_file, os.path.basename(output_file),
+                    input_size/output_size, input_size/1e6/(time.time()-start)))
+            if self.remove_source:
+                compressed_file, raw_data_file = (input_file, output_file) if self.decompress else (output_file, input_file)
+                if ct.verify_compressed_file(compressed_file, raw_data_file, n_threads=self.n_threads)==False:
+                    raise IOError("{} does not decode to the same data as {}, keeping {}".format(compressed_file, raw_data_file, input_file))
+                os.remove(input_file)
+                print("Checked {} against {} and removed {}".format(compressed_file, raw_data_file, input_file))
+
+    def compress_one(self, raw_data_file, n_channels):
+        compressed_file = ct.compress_file(raw_data_file, n_channels=n_channels, chunk_samples=self.chunk_samples,
+                                            level=self.level, n_threads=self.n_threads)
+        recording = ct.CompressedRecording(compressed_file)
+        if recording.n_samples*recording.n_channels*recording.dtype.itemsize != os.path.getsize(raw_data_file):
+            raise IOError("{} does not cover all of {}, check the channel count".format(compressed_file, raw_data_file))
+        recording.close()
+        return compressed_file
+
+    def decompress_one(self, compressed_file):
+        recording = ct.CompressedRecording(compressed_file)
+        expected_size = recording.n_samples*recording.n_channels*recording.dtype.itemsize
+        recording.close()
+        raw_data_file = ct.decompress_file(compressed_file, n_threads=self.n_threads)
+        if os.path.getsize(raw_data_file) != expected_size:
+            raise IOError("{} was not fully decompressed".format(raw_data_file))
+        return raw_data_file
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('date', type=str)
+    parser.add_argument('mouse_id', type=str)
+    parser.add_argument('--probes_to_run', nargs="+", default='all')
+    parser.add_argument('--recordings_to_run', nargs="+", default='all')
+    parser.add_argument('--pxi_dict', default='default')
+    parser.add_argument('--decompress', action='store_true')
+    parser.add_argument('--remove_source', action='store_true')
+    parser.add_argument('--chunk_samples', type=int, default=3000)
+    parser.add_argument('--level', type=int, default=1)
+    parser.add_argument('--n_threads', type=int, default=4)
+    args = parser.parse_args()
+
+    runner = CompressSession(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run, args.pxi_dict,
+                                decompress=args.decompress, remove_source=args.remove_source, chunk_samples=args.chunk_samples,
+                                level=args.level, n_threads=args.n_threads)
+    runner.run_it()
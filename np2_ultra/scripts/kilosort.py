@@ -1,26 +1,35 @@
 import os
 import glob2
-from datetime import datetime
 import time
-import shutil
 import json
-import matlab.engine
 
-from np2_ultra.tools import io, file_tools
+from np2_ultra.tools import io, file_tools, engine_tools, copy_tools
 import np2_ultra.files as files
 
+# the only files in a probe folder the Kilosort scripts read: the raw data and an optional channel map.
+# The scripts sort the first *.bin or *.dat they find, so derived files (lfp.dat, preprocessed data) must not be staged.
+KILOSORT_INPUT_FILES = ['continuous.dat', 'chan*.mat']
+
+
 class RunKilosort():
     """
     Run Kilosort spike sorting via the Python Matlab engine.
+    Jobs go to a warm EngineService (see tools.engine_tools), so MATLAB is only started once per process.
+    Each recording/probe gets its own script in the kilosort_jobs folder, and up to n_jobs of them run at the same time.
+    With a scratch_dir, each probe's data is sorted from a local copy (see copy_tools.ScratchCache).
 
     Methods
     ----------
     get_all_file_locations(pxi_dict)
-    write_ks_file(probe_dir)
+    write_ks_file(recording, probe, probe_dir, gpu_device)
+    start_job(recording, probe, probe_dir, gpu_device)
+    finish_job(recording, probe, probe_dir)
+    screen_probe(recording, probe)
     run_kilosort()
     """
 
-    def __init__(self, date, mouse_id, probes_to_run='all', recordings_to_run='all', pxi_dict='default', override_ks_flag=False):
+    def __init__(self, date, mouse_id, probes_to_run='all', recordings_to_run='all', pxi_dict='default', override_ks_flag=False, screen_bad_fraction=None,
+                    engine_service=None, n_jobs=1, gpu_devices=None, max_attempts=2, scratch_dir=None, scratch_gb=500.):
         '''
         Parameters
         ----------
@@ -40,12 +49,36 @@ class RunKilosort():
         override_ks_flag: bool, optional, default = False
             Optionally override any flags preventing Kilosort from running.
             Note: this will not override the stop caused by the rez.mat file existing, and you will still need to manually delete that to rerun (if it exists).
+        screen_bad_fraction: float, optional, default = None
+            If set, channel noise is measured on a sample of the data before sorting (see GetFiles.get_channel_noise()),
+            and probes where more than this fraction of channels are dead, noisy or saturated are flagged and skipped.
+        engine_service: EngineService, optional, default = None
+            Service to run Kilosort on. Default is the process's shared MATLAB service, engine_tools.get_service(), with n_jobs engines.
+        n_jobs: int, optional, default = 1
+            Number of recording/probe combos sorted at the same time. Each needs its own engine, and GPU if gpu_devices is set.
+        gpu_devices: list, optional, default = None
+            GPU numbers (Matlab numbering, from 1) to share between jobs, one job per GPU at a time, eg [1, 2].
+        max_attempts: int, optional, default = 2
+            Attempts per recording/probe before it is flagged to skip Kilosort.
+            State, attempts and errors of every job are kept in kilosort_jobs.json in the session folder.
+        scratch_dir: path, optional, default = None
+            Local folder (eg on the sorting computer's SSD) to copy each probe's data to before sorting it.
+            The next probe in the queue is copied while the current one sorts, and Kilosort's outputs are copied back
+            to the data drive once it's done. Default sorts the data where it is.
+        scratch_gb: float, optional, default = 500.
+            Space staged data may take up in scratch_dir. Least recently used probes are removed to make room.
         '''
         self.date = date
         self.mouse_id = mouse_id
         self.probes = probes_to_run
         self.recordings = recordings_to_run
         self.flag_override = override_ks_flag
+        self.screen_bad_fraction = screen_bad_fraction
+        self.n_jobs = n_jobs
+        self.gpu_devices = gpu_devices
+        self.max_attempts = max_attempts
+        self.scratch = copy_tools.ScratchCache(scratch_dir, scratch_gb*1e9) if scratch_dir is not None else None
+        self.engine_service = engine_service if engine_service is not None else engine_tools.get_service(n_engines=n_jobs)
 
         self.computer_names = io.read_computer_names()
         self.get_all_file_locations(pxi_dict=pxi_dict)
@@ -63,67 +96,124 @@ class RunKilosort():
         self.get_files = file_tools.GetFiles(self.date, self.mouse_id, pxi_dict=pxi_dict)
         self.pxi_dict = self.get_files.pxi_dict
         self.main_folder = self.get_files.session_dir
-        self.bad_dats_txt = os.path.join(self.main_folder, "bad_dat_files.txt")
+        self.ks_jobs_folder = os.path.join(self.main_folder, "kilosort_jobs")
+        self.ks_jobs_json = os.path.join(self.main_folder, "kilosort_jobs.json")
         self.get_files.get_probe_dirs(probes='all')
         self.probe_dict = self.get_files.probe_data_dirs
         self.path_to_ks_one_oh, self.path_to_ks_ultra = io.get_paths_to_kilosort_templates()
 
-    def write_ks_file(self, probe_dir):
+    def write_ks_file(self, recording, probe, probe_dir, gpu_device=None):
         """
-        Retrieves templates for Kilosort's Matlab scripts, transfers to data folder and writes the path to the DAT file as rootZ.
-        This function is called in run_kilosort() for each DAT file processed.
+        Writes a Kilosort Matlab script for one recording/probe from the templates, with the path to the DAT file as rootZ
+        and its own temp_wh file, so several jobs can sort at the same time.
+        This function is called by the job scheduler in run_kilosort() as each job starts.
 
         Parameters
         ----------
+        recording: str
+            Recording being processed.
+        probe: str
+            Probe being processed.
         probe_dir: path
             The path to the directory where raw data for the probe being processed is stored.
+        gpu_device: int, optional, default = None
+            If set, the script selects this GPU (Matlab numbering, from 1) before sorting.
 
         Returns
         ----------
-        one_oh: bool
-            A boolean specifying whether the probe being processed is a 1.0 probe or not.
-            Determined by the "one_oh_probes" key in the pxi_dict json passed to the class.
+        script: str
+            Name of the script, written to the kilosort_jobs folder of the session.
         """
-        one_oh_probes=self.pxi_dict['one_oh_probes']
-        probe_dir_key = probe_dir[-2:]
-        probe = self.pxi_dict['reverse'][probe_dir_key]
-
-        if probe in one_oh_probes:
-            session_file = os.path.join(self.main_folder, "kilosort_one_oh_session.m")
-            if os.path.exists(session_file)==False:
-                shutil.copy(self.path_to_ks_one_oh, session_file)
-            one_oh = True
+        if probe in self.pxi_dict['one_oh_probes']:
+            template = self.path_to_ks_one_oh
         else:
-            session_file = os.path.join(self.main_folder, "kilosort_ultra_session.m")
-            if os.path.exists(session_file)==False:
-                shutil.copy(self.path_to_ks_ultra, session_file)
-            one_oh = False
+            template = self.path_to_ks_ultra
+
+        with open(template, "r") as f:
+            lines = [l for l in f.readlines() if "rootZ =" not in l]
+
+        temp_file = "temp_wh_{}_{}_{}_{}.dat".format(self.date.replace('-', ''), self.mouse_id, recording, probe)
+        lines = [l.replace("'temp_wh.dat'", "'{}'".format(temp_file)) for l in lines]
+        header = ["rootZ = '{}';\n".format(probe_dir)]
+        if gpu_device is not None:
+            header.append("gpuDevice({});\n".format(gpu_device))
+
+        script = "ks_{}_{}".format(recording, probe)
+        if os.path.exists(self.ks_jobs_folder)==False:
+            os.mkdir(self.ks_jobs_folder)
+        with open(os.path.join(self.ks_jobs_folder, script + ".m"), "w") as dest:
+            dest.writelines(header + lines)
+
+        return script
 
-        with open(session_file, "r") as f:
-            lines = f.readlines()
+    def scratch_key(self, recording, probe):
+        return "{}_{}_{}_{}".format(self.date, self.mouse_id, recording, probe)
+
+    def start_job(self, recording, probe, probe_dir, gpu_device=None):
+        """
+        Stages the probe's KILOSORT_INPUT_FILES to scratch, if there is a scratch_dir, starts staging the next queued probe and writes the Kilosort script.
+        Called by the job scheduler in run_kilosort() as each job starts.
+
+        Returns
+        ----------
+        script: str
+            Name of the script, see write_ks_file().
+        """
+        if self.scratch is not None:
+            probe_dir = self.scratch.stage(self.scratch_key(recording, probe), probe_dir, files=KILOSORT_INPUT_FILES)
+            queued = [job for job in self.scheduler.jobs.values() if job['state'] == 'queued']
+            if len(queued) > 0:
+                self.scratch.prefetch(self.scratch_key(queued[0]['recording'], queued[0]['probe']), queued[0]['probe_dir'],
+                                        files=KILOSORT_INPUT_FILES)
+        return self.write_ks_file(recording, probe, probe_dir, gpu_device)
 
-        zline = [n for n,l in enumerate(lines) if "rootZ =" in l]
-        while len(zline) > 0:
-            for z in zline:
-                del lines[z]
-            zline = [n for n,l in enumerate(lines) if "rootZ =" in l]
+    def finish_job(self, recording, probe, probe_dir):
+        """
+        Copies Kilosort's outputs from scratch back to the probe's data folder, if there is a scratch_dir, and lets the
+        scratch copy be removed when space is needed.
+        Called by the job scheduler in run_kilosort() once Kilosort has run.
+        """
+        if self.scratch is not None:
+            synced = self.scratch.sync_back(self.scratch_key(recording, probe), probe_dir)
+            self.scratch.release(self.scratch_key(recording, probe))
+            if len(synced) > 0:
+                print("{} {}: copied {} Kilosort outputs back to {}".format(recording, probe, len(synced), probe_dir))
 
-        text_insert = "rootZ = '{}';\n".format(probe_dir)
-        lines.insert(0, text_insert)
+    def screen_probe(self, recording, probe):
+        """
+        Quick bad-channel screen before spending Kilosort time on a probe.
+        Probes that fail are flagged to skip Kilosort.
 
-        with open(session_file, "w") as dest:
-            dest.writelines(lines)
+        Parameters
+        ----------
+        recording: str
+            Recording to check.
+        probe: str
+            Probe to check.
 
-        return one_oh
+        Returns
+        ----------
+        skip_ks: bool
+            True if more than screen_bad_fraction of the channels are dead, noisy or saturated for more than 1% of samples.
+        """
+        noise = self.get_files.get_channel_noise(recording, probe)
+        bad = noise['dead_channels'] | noise['noisy_channels'] | (noise['saturated_fraction'] > 0.01)
+        print("{} probe {}: {} dead, {} noisy, {} saturated channels".format(recording, probe, noise['dead_channels'].sum(),
+                noise['noisy_channels'].sum(), (noise['saturated_fraction'] > 0.01).sum()))
+        if bad.mean() > self.screen_bad_fraction:
+            self.get_files.make_flags_json(recording,
+                                        probe,
+                                        text = "failed channel screen: {} of {} channels bad".format(bad.sum(), bad.size),
+                                        skip_kilosort = True,)
+            return True
+        return False
 
     def run_kilosort(self):
         """
-        Calls and runs the Python Matlab engine with Kilosort per recording/probe combo.
+        Runs Kilosort per recording/probe combo on the engine service, n_jobs at a time.
+        Combos that fail every attempt are flagged to skip Kilosort.
         Is initialized under __init__.
         """
-        eng = matlab.engine.start_matlab()
-        eng.addpath(self.main_folder, nargout=0)
-
         if self.recordings != 'all':
             remove_list = [key for key in self.probe_dict if key not in self.recordings]
             [self.probe_dict.pop(key, None) for key in self.probe_dict.copy().keys() if key not in self.recordings]
@@ -138,7 +228,8 @@ class RunKilosort():
                 tups = [(recording, p) for p in probes]
                 [self.probe_dict[t[0]].pop(t[1], None) for t in tups]
 
-        bad_dats = []
+        self.scheduler = engine_tools.JobScheduler(self.engine_service, jobs_file=self.ks_jobs_json, n_parallel=self.n_jobs,
+                                                    gpu_devices=self.gpu_devices, max_attempts=self.max_attempts)
         for recording_key in self.probe_dict:
             for probe_key in self.probe_dict[recording_key]:
                 d = self.probe_dict[recording_key][probe_key]
@@ -146,38 +237,35 @@ class RunKilosort():
                     skip_ks = False
                 else:
                     skip_ks = self.get_files.get_kilosort_flag(recording_key, probe_key)
+                if (("rez.mat" in os.listdir(d))==False) and (skip_ks == False) and (self.screen_bad_fraction is not None):
+                    skip_ks = self.screen_probe(recording_key, probe_key)
 
                 if (("rez.mat" in os.listdir(d))==False) and (skip_ks == False):
-                    one_oh = self.write_ks_file(probe_dir=d)
-
-                    try:
-                        start = time.time()
-                        print('starting Kilosort on {} {}'.format(d.split("\\")[6], d.split('\\')[-1]))
-                        eng.cd(self.main_folder)
-                        if one_oh == True:
-                            eng.kilosort_one_oh_session(nargout=0)
-                        elif one_oh == False:
-                            eng.kilosort_ultra_session(nargout=0)
-                        end = time.time()
-                        print("done with Kilosort. that took {}s".format(end-start))
-                    except Exception as e:
-                        now = datetime.strftime(datetime.now(), '%Y%m%d-%H%M')
-                        bad_dats.append("{} {} {}".format(now, d, e))
-                        self.get_files.make_flags_json(recording_key,
-                                                    probe_key,
-                                                    text = "failed kilosort",
-                                                    skip_kilosort = True,)
-                        pass
-
+                    write_script = lambda gpu_device, r=recording_key, p=probe_key, d=d: self.start_job(r, p, d, gpu_device)
+                    finish = lambda r=recording_key, p=probe_key, d=d: self.finish_job(r, p, d)
+                    self.scheduler.add("{}_{}".format(recording_key, probe_key), self.ks_jobs_folder, write_script, finish=finish,
+                                        recording=recording_key, probe=probe_key, probe_dir=d)
                 elif ("rez.mat" in os.listdir(d))==True:
                     print("{} {} has already been processed. Delete rez.mat to reprocess.".format(d.split("\\")[6], d.split('\\')[-1]))
                 elif skip_ks == True:
                     flags = self.get_files.get_flags_json(recording_key, probe_key)
                     print("Skipping {} {} because of flags file: {}".format(d.split("\\")[6], d.split('\\')[-1], flags['other notes']))
 
-            with open(self.bad_dats_txt, 'a') as f:
-                for line in bad_dats:
-                    f.write(line + "\n")
+        if len(self.scheduler.jobs) == 0:
+            return
+        start = time.time()
+        print("starting Kilosort on {} recording/probe combos, {} at a time".format(len(self.scheduler.jobs), self.scheduler.n_parallel))
+        self.scheduler.run()
+        if self.scratch is not None:
+            #failed jobs are still marked in use
+            for job in self.scheduler.jobs.values():
+                self.scratch.release(self.scratch_key(job['recording'], job['probe']))
+        for job_id, job in self.scheduler.failures().items():
+            self.get_files.make_flags_json(job['recording'],
+                                        job['probe'],
+                                        text = "failed kilosort: {}".format(job['errors'][-1]['error']),
+                                        skip_kilosort = True,)
+        print("done with Kilosort. that took {}s, {} failed (see {})".format(time.time()-start, len(self.scheduler.failures()), self.ks_jobs_json))
 
 
 if __name__ == "__main__":
@@ -189,7 +277,19 @@ if __name__ == "__main__":
     parser.add_argument('--recordings_to_run', nargs="+", default='all')
     parser.add_argument('--pxi_dict', default='default')
     parser.add_argument('--override_ks_flag', type=bool, default=False)
+    parser.add_argument('--screen_bad_fraction', type=float, default=None)
+    parser.add_argument('--engine_backend', default='matlab', choices=sorted(engine_tools.BACKENDS.keys()))
+    parser.add_argument('--shared_engine', action='store_true', help="sort on MATLAB sessions shared with matlab.engine.shareEngine, and leave them running")
+    parser.add_argument('--n_jobs', type=int, default=1)
+    parser.add_argument('--gpu_devices', nargs="+", type=int, default=None)
+    parser.add_argument('--max_attempts', type=int, default=2)
+    parser.add_argument('--scratch_dir', default=None)
+    parser.add_argument('--scratch_gb', type=float, default=500.)
 
     args = parser.parse_args()
 
-    RunKilosort(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run, args.pxi_dict, args.override_ks_flag)
+    service = engine_tools.get_service(args.engine_backend, n_engines=args.n_jobs, connect_shared=args.shared_engine)
+    RunKilosort(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run, args.pxi_dict, args.override_ks_flag, args.screen_bad_fraction,
+                engine_service=service, n_jobs=args.n_jobs, gpu_devices=args.gpu_devices, max_attempts=args.max_attempts,
+                scratch_dir=args.scratch_dir, scratch_gb=args.scratch_gb)
+    service.shutdown()
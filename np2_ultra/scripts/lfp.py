@@ -0,0 +1,103 @@
+import os
+import time
+
+from np2_ultra.tools import file_tools
+import np2_ultra.tools.signal_tools as st
+
+class ExtractLFP():
+    """
+    Make lfp.dat files for probes that only record the AP band (ultra probes) by low-pass filtering and decimating continuous.dat.
+    Once made, GetFiles.get_raw_recording(recording, probe, band='lfp') returns the LFP data.
+
+    Methods
+    ----------
+    get_jobs()
+    run_it()
+    """
+    def __init__(self, date, mouse_id, probes_to_run='all', recordings_to_run='all', pxi_dict='default',
+                    target_rate=2500., cutoff_hz=1000., n_threads=4, overwrite=False):
+        """
+        Parameters
+        ----------
+        date: str
+            The date of the session in YYYY-MM-DD format
+        mouse_id: str
+            The 6 digit mouse number
+        probes_to_run: list, optional, default = 'all'
+            Optionally only process a subset of probes in the session, eg ['A', 'E']
+        recordings_to_run: list, optional, default = 'all'
+            Optionally only process a subset of recordings in the session, eg ['recording2']
+        pxi_dict: path, optional, default = 'default'
+            Pass a path to a JSON containing a customized dictionary of mappings of probe letter to OpenEphys folder suffix.
+        target_rate: float, optional, default = 2500.
+            Approximate LFP sample rate in Hz.
+        cutoff_hz: float, optional, default = 1000.
+            Anti-alias low-pass cutoff in Hz.
+        n_threads: int, optional, default = 4
+            Number of chunks filtered at the same time.
+        overwrite: bool, optional, default = False
+            Remake lfp.dat files that already exist.
+        """
+        self.target_rate = target_rate
+        self.cutoff_hz = cutoff_hz
+        self.n_threads = n_threads
+        self.overwrite = overwrite
+
+        self.files = file_tools.GetFiles(date, mouse_id, probes=probes_to_run, recordings=recordings_to_run, pxi_dict=pxi_dict)
+        self.files.determine_recordings(recordings_to_run)
+        self.files.get_probe_dirs(probes_to_run)
+
+    def get_jobs(self):
+        """
+        Returns
+        ----------
+        jobs: list
+            (recording, probe, lfp_file) for every selected recording/probe without an LFP band folder.
+        """
+        jobs = []
+        for recording, probes in self.files.probe_data_dirs.items():
+            for probe in probes.keys():
+                lfp_file = self.files.get_raw_data_file(recording, probe, band='lfp')
+                if os.path.basename(lfp_file) != 'lfp.dat':
+                    continue
+                if os.path.exists(lfp_file) and self.overwrite==False:
+                    print("{} probe {} already has {}, skipping.".format(recording, probe, lfp_file))
+                    continue
+                jobs.append((recording, probe, lfp_file))
+        return jobs
+
+    def run_it(self):
+        """
+        Makes lfp.dat and lfp.json for every job returned by get_jobs().
+        if __name__ == __main__ automatically calls this function.
+        """
+        for recording, probe, lfp_file in self.get_jobs():
+            start = time.time()
+            raw_recording = self.files.get_raw_recording(recording, probe, band='spike')
+            st.decimate_file(raw_recording.raw_data_file, lfp_file,
+                            n_channels=raw_recording.n_channels,
+                            sample_rate=raw_recording.sample_rate,
+                            gain_factor=raw_recording.gain_factor,
+                            target_rate=self.target_rate,
+                            cutoff_hz=self.cutoff_hz,
+                            n_threads=self.n_threads)
+            print("{} probe {} LFP saved to {} in {:.1f} s".format(recording, probe, lfp_file, time.time()-start))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('date', type=str)
+    parser.add_argument('mouse_id', type=str)
+    parser.add_argument('--probes_to_run', nargs="+", default='all')
+    parser.add_argument('--recordings_to_run', nargs="+", default='all')
+    parser.add_argument('--pxi_dict', default='default')
+    parser.add_argument('--target_rate', type=float, default=2500.)
+    parser.add_argument('--cutoff_hz', type=float, default=1000.)
+    parser.add_argument('--n_threads', type=int, default=4)
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args()
+
+    runner = ExtractLFP(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run, args.pxi_dict,
+                            target_rate=args.target_rate, cutoff_hz=args.cutoff_hz, n_threads=args.n_threads, overwrite=args.overwrite)
+    runner.run_it()
@@ -6,13 +6,30 @@ import shutil
 import json
 
 import np2_ultra.files as files
+from np2_ultra.tools.copy_tools import CopyEngine, TransferManifest, TransferScheduler, TailFollower, SourceInventory
 
 class TransferFiles():
     """
     Transfer ephys data from NP2 computers to backup and processing drives.
+    Every copied file is hashed and recorded in transfer_manifest.json in the session folder, so an interrupted transfer
+    resumes where it stopped and verify_transfer() can check the destination without reading the source again.
+    With extra_destinations, each file is read from the acquisition computers once and written to every destination
+    (eg the data drive and the backup drive) at the same time. Each destination has its own manifest.
+    The acquisition computers' shares are listed through a SourceInventory, cached in source_inventory.json in the
+    destination folder, so each share is listed at most once per run and only re-listed when it has changed.
+    run_it() plans every step first and then copies through a TransferScheduler, ephys data first and videos last by default,
+    optionally under a bandwidth cap. Recordings are put on ready_recordings (and passed to on_ready) as soon as their
+    ephys and sync files have landed.
+    watch_ephys_data() copies the Open Ephys recordings while they are still being written, so only the last few seconds
+    of data are left to copy when the session ends.
 
     Methods
     ----------
+    watch_ephys_data(poll_seconds=10., settle_seconds=60., idle_minutes=30.)
+    find_ephys_folder()
+    verify_transfer()
+    submit()
+    transferred_files(pattern)
     xfer_ephys_data()
     xfer_sync_data()
     xfer_opto_data()
@@ -23,7 +40,8 @@ class TransferFiles():
 
     """
 
-    def __init__(self, date, mouse_id, destination=('dest_root', 'np2_data'), openephys_folder='false', path_to_files=None):
+    def __init__(self, date, mouse_id, destination=('dest_root', 'np2_data'), openephys_folder='false', path_to_files=None, n_threads=8,
+                    extra_destinations=None, priorities=None, max_mb_per_second=None, on_ready=None):
         '''
         Parameters
         ----------
@@ -40,6 +58,18 @@ class TransferFiles():
         path_to_files: path, optional, default = None
             Can be relative or exact path to where comp_names json and kilosort template files are located. Not typically used.
             If None, will use the relative path of folder 'files' located one directory up from current.
+        n_threads: int, optional, default = 8
+            Number of file chunks copied at the same time, see tools.copy_tools.CopyEngine.
+        extra_destinations: list, optional, default = None
+            More (key, sub-folder) tuples like destination, eg [('backup_drive', '')]. The sub-folder can be left out.
+            Files are written to all destinations from a single read of the source.
+        priorities: dict, optional, default = None
+            Category: priority (lower is copied first), overriding tools.copy_tools.DEFAULT_PRIORITIES.
+            Categories are 'ephys', 'sync', 'opto', 'params', 'images' and 'videos'.
+        max_mb_per_second: float, optional, default = None
+            Cap on the total rate read from the acquisition computers. None is uncapped.
+        on_ready: function, optional, default = None
+            Called with a recording name (eg 'recording1') once its ephys and sync files have landed in every destination.
         '''
         if path_to_files==None:
             self.path_to_files = os.path.dirname(files.__file__)
@@ -60,11 +90,25 @@ class TransferFiles():
         else:
             self.date = date
 
-        self.destination_folder = os.path.join(self.computer_names[destination[0]], destination[1])
-        self.main_folder = os.path.join(self.destination_folder, self.date +'_' + self.mouse_id)
-        if os.path.exists(self.main_folder)==False:
-            os.mkdir(self.main_folder)
+        destinations = [destination] + (list(extra_destinations) if extra_destinations is not None else [])
+        #a destination given as just a key (eg --extra_destination backup_drive) is the top of that share
+        self.destination_folders = [os.path.join(self.computer_names[d[0]], d[1] if len(d) > 1 else '') for d in destinations]
+        self.session_folders = [os.path.join(d, self.date +'_' + self.mouse_id) for d in self.destination_folders]
+        for folder in self.session_folders:
+            if os.path.exists(folder)==False:
+                os.mkdir(folder)
+        self.destination_folder = self.destination_folders[0]
+        self.main_folder = self.session_folders[0]
+        self.manifests = [TransferManifest(os.path.join(folder, 'transfer_manifest.json')) for folder in self.session_folders]
+        self.copier = CopyEngine(n_threads=n_threads, manifest=self.manifests,
+                                    max_bytes_per_second=max_mb_per_second*1e6 if max_mb_per_second else None)
+        self.scheduler = TransferScheduler(self.copier, priorities=priorities, on_ready=on_ready)
+        self.ready_recordings = self.scheduler.ready
+        self.defer = False
         self.bad_dats_txt = os.path.join(self.main_folder, "bad_dat_files.txt")
+        source_shares = ['acq', 'sync', 'stim', 'video_eye_beh', 'video_brain_img', 'video_sess_params']
+        self.inventory = SourceInventory({share: self.computer_names[share] for share in source_shares if share in self.computer_names},
+                                            cache_file=os.path.join(self.destination_folder, 'source_inventory.json'))
 
         #codeblock below pertains to running more than one experiment in a day -- can otherwise be ignored
         if openephys_folder != 'false':
@@ -72,7 +116,7 @@ class TransferFiles():
         else:
             self.specify_folder = False
         self.multiple_experiments = False
-        potential_folders = [f for f in os.listdir(self.computer_names['acq']) if self.date in f]
+        potential_folders = self.inventory.match('acq', self.date)
         if len(potential_folders) > 1:
             self.multiple_experiments=True
             if self.specify_folder==False:
@@ -89,15 +133,71 @@ class TransferFiles():
         print("date: {}, mouse: {}".format(self.date, self.mouse_id))
         print("looking in {}".format(self.computer_names['acq']))
         print("------TRANSFERRING ALL FILES--------")
-        print("transferring to {}".format(self.destination_folder))
-        self.xfer_ephys_data()
-        self.xfer_sync_data()
-        self.xfer_opto_data()
-        self.xfer_behavior_videos()
-        self.xfer_brain_imgs()
-        self.xfer_params_file()
+        print("transferring to {}".format(', '.join(self.destination_folders)))
+        self.defer = True
+        try:
+            self.xfer_ephys_data()
+            self.xfer_sync_data()
+            self.xfer_opto_data()
+            self.xfer_behavior_videos()
+            self.xfer_brain_imgs()
+            self.xfer_params_file()
+        finally:
+            self.defer = False
+        self.inventory.save()
+        print("Copying.")
+        self.submit()
+        self.copier.report()
         print("------DONE TRANSFERRING FILES {}_{}--------".format(self.date, self.mouse_id))
 
+    def submit(self):
+        """
+        Copy everything the xfer_ steps have queued. run_it() defers this until every step has been planned,
+        so the scheduler can order all of the session's files by priority.
+        """
+        if self.defer == False:
+            self.scheduler.run()
+
+    def verify_transfer(self):
+        """
+        Re-hash the files at the destination and compare them with the transfer manifest. The acquisition computers are not read.
+
+        Returns
+        ----------
+        problems: dict
+            Path: description, for every file in any destination that is missing, incomplete or doesn't match.
+        """
+        start = time.time()
+        problems = {}
+        for folder, manifest in zip(self.session_folders, self.manifests):
+            print("Verifying {} files in {}".format(len(manifest.files), folder))
+            for path, problem in manifest.verify(n_threads=self.copier.n_threads).items():
+                problems[os.path.join(folder, path)] = problem
+        for path, problem in sorted(problems.items()):
+            print("---------{}: {}---------".format(path, problem))
+        if len(problems) == 0:
+            print("All files match the manifest.")
+        print("That took {} seconds".format(time.time()-start))
+        return problems
+
+    def transferred_files(self, pattern):
+        """
+        glob2 matches for pattern that the manifest records as completely copied. Files it has no entry for, or whose copy
+        was interrupted, are left out so they are copied again.
+        """
+        manifest = self.copier.manifest_for(pattern)
+        if manifest is None:
+            return glob2.glob(pattern)
+        return [f for f in glob2.glob(pattern) if manifest.is_complete(f)]
+
+    def short_name(self, path):
+        """
+        Name of a recording folder for printing, with its destination when there is more than one.
+        """
+        if len(self.session_folders) == 1:
+            return os.path.basename(path)
+        return path
+
     def get_date_modified(self, file_path, date_format=False):
         """
         Get the date a file was last modified. Currently used to ID the correct sync files.
@@ -108,7 +208,8 @@ class TransferFiles():
             Can optionally return the date as a string of the specified format, using standard datetime format codes.
             Default returns a datetime timestamp object.
         """
-        timestamp = datetime.fromtimestamp(os.stat(file_path).st_mtime)
+        entry = self.inventory.stat(file_path)
+        timestamp = datetime.fromtimestamp(entry['mtime'] if entry is not None else os.stat(file_path).st_mtime)
         if date_format != False:
             timestamp = datetime.strftime(timestamp, date_format)
         return timestamp
@@ -121,45 +222,152 @@ class TransferFiles():
         start = time.time()
         print("Transferring ephys data.")
 
-        if len(glob2.glob(os.path.join(self.main_folder, 'recording*'))) == 0:
-            transfer_ephys_data = True
-        else:
-            transfer_ephys_data = False
+        transfer_folders = []
+        resume = False
+        for folder, manifest in zip(self.session_folders, self.manifests):
+            if len(glob2.glob(os.path.join(folder, 'recording*'))) == 0:
+                transfer_folders.append(folder)
+                continue
+            recording_files = [os.path.join(root, f) for name in glob2.glob(os.path.join(folder, 'recording*'))
+                                for root, dirs, file_names in os.walk(name) for f in file_names]
+            unfinished = manifest.unfinished(recording_files)
+            if len(recording_files) == 0 or len(unfinished) > 0:
+                #sessions with any recording file the manifest doesn't show as complete are re-entered;
+                #the manifest then skips files that are already complete and copies the rest again
+                print("Resuming ephys transfer to {}: {} of {} files not recorded as complete.".format(folder, len(unfinished),
+                        len(recording_files)))
+                transfer_folders.append(folder)
+                resume = True
+        transfer_ephys_data = len(transfer_folders) > 0
 
         if transfer_ephys_data==True:
-            data_folders = glob2.glob(os.path.join(self.computer_names['acq'], "*{}*".format(self.date), '**', 'experiment1'))
-
-            if (len(data_folders) > 1) & (self.specify_folder==False):
-                print("There is more than one experiment for this day. Please specify which one you'd like to process using the openephys_folder argument:\n{}".format(data_folders))
+            data_loc = self.find_ephys_folder()
+            if data_loc is None and resume==False:
                 return
-            elif (len(data_folders) > 1) & (self.specify_folder!=False):
-                try:
-                    data_loc = [f for f in data_folders if self.specify_folder in f][0]
-                except IndexError:
-                    print("The open ephys folder you specified does not exist. Check the name and try again.")
-                    return
+            elif data_loc is None:
+                #eg the acquisition computer has been cleared since; carry on with the recordings already at the destinations
+                print("Can't resume the ephys transfer without its source, using the recordings already there.")
+                transfer_folders = []
             else:
-                data_loc = data_folders[0]
-
-            transfer_loc = self.main_folder
-            xml_file = os.path.join(os.path.dirname(data_loc), "settings.xml")
-            shutil.copy(xml_file, os.path.join(transfer_loc, "settings.xml"))
-
-            for file in os.listdir(data_loc):
-                if "recording" in file:
-                    fol = os.path.join(data_loc, file)
-                    shutil.copytree(fol, os.path.join(transfer_loc, file))
-                    print("{} transfered".format(file))
+                xml_file = os.path.join(os.path.dirname(data_loc), "settings.xml")
+                self.scheduler.add('ephys', [(xml_file, [os.path.join(transfer_loc, "settings.xml") for transfer_loc in transfer_folders])])
+
+                #recordings are copied straight to their final recording1, recording2... names, see rename_recordings()
+                rename_dict = {0: 'recording1', 1: 'recording2', 2:'recording3', 3: 'recording4', 4: 'recording5'}
+                recording_folders = sorted([file for file in os.listdir(data_loc) if "recording" in file])
+                for n, file in enumerate(recording_folders):
+                    dsts = [os.path.join(transfer_loc, rename_dict[n]) for transfer_loc in transfer_folders]
+                    file_pairs, dir_pairs = self.copier.plan_trees([(os.path.join(data_loc, file), dsts)], resume=resume)
+                    #the copy of one timestamps.npy per recording that rename_recordings() makes, taken from the source instead
+                    timestamps = glob2.glob(os.path.join(data_loc, file, 'continuous', 'Neuropix-PXI-*.0', 'timestamps.npy'))
+                    if len(timestamps) > 0:
+                        file_pairs.append((timestamps[0], [os.path.join(d, 'timestamps.npy') for d in dsts]))
+                    self.scheduler.add('ephys', file_pairs, recording=rename_dict[n], copy_stat=True, dir_pairs=dir_pairs,
+                                        message="{} transfered".format(file))
         else:
             print("Ephys data already transferred.")
 
+        for folder in self.session_folders:
+            if folder not in transfer_folders:
+                self.rename_recordings(folder)
+            for name in glob2.glob(os.path.join(folder, 'recording*')):
+                self.scheduler.expect(os.path.basename(name))
+        self.submit()
+
+        end = time.time()
+        print("That took {} seconds".format(end-start))
+
+    def find_ephys_folder(self):
+        """
+        Returns
+        ----------
+        data_loc: path
+            The session's Open Ephys experiment1 folder on the acquisition computer, or None if it can't be determined.
+        """
+        data_folders = [f for folder in self.inventory.match('acq', self.date) for f in glob2.glob(os.path.join(folder, '**', 'experiment1'))]
+
+        if len(data_folders) == 0:
+            print("No Open Ephys folder for {} in {}".format(self.date, self.computer_names['acq']))
+            return None
+        elif (len(data_folders) > 1) & (self.specify_folder==False):
+            print("There is more than one experiment for this day. Please specify which one you'd like to process using the openephys_folder argument:\n{}".format(data_folders))
+            return None
+        elif (len(data_folders) > 1) & (self.specify_folder!=False):
+            try:
+                return [f for f in data_folders if self.specify_folder in f][0]
+            except IndexError:
+                print("The open ephys folder you specified does not exist. Check the name and try again.")
+                return None
+        return data_folders[0]
+
+    def watch_ephys_data(self, poll_seconds=10., settle_seconds=60., idle_minutes=30.):
+        """
+        Copy the Open Ephys recordings while the session is running. Every poll, new recording folders and files are picked up
+        and the bytes appended to each file since the last poll are copied. Files that stop growing are finalized and recorded
+        in the manifest as complete, so run_it() afterwards treats the ephys data as transferred and only copies the rest.
+        If watching is interrupted, the files still growing stay incomplete in the manifest and run_it() copies them again.
+
+        Parameters
+        ----------
+        poll_seconds: float, optional, default = 10.
+            Seconds between polls.
+        settle_seconds: float, optional, default = 60.
+            Seconds a file must stop growing before it is finalized.
+        idle_minutes: float, optional, default = 30.
+            Stop watching once every file is finalized and nothing has changed for this long.
+            Watching also stops if the session's folder appears on the acquisition computer but find_ephys_folder()
+            can't resolve a single experiment folder in it.
+        """
+        start = time.time()
+        print("Watching ephys data.")
+        follower = TailFollower(self.copier, settle_seconds=settle_seconds)
+        data_loc = None
+        last_change = time.time()
+        n_files = 0
+        dir_pairs = []
+        while True:
+            if data_loc is None:
+                self.inventory.refresh('acq')
+                if len(self.inventory.match('acq', self.date)) > 0:
+                    data_loc = self.find_ephys_folder()
+                    if data_loc is None:
+                        print("Stopped watching ephys data.")
+                        return
+            pairs = []
+            if data_loc is not None:
+                xml_file = os.path.join(os.path.dirname(data_loc), "settings.xml")
+                if os.path.exists(xml_file):
+                    pairs.append((xml_file, [os.path.join(folder, "settings.xml") for folder in self.session_folders]))
+                recording_folders = sorted([file for file in os.listdir(data_loc) if "recording" in file])
+                file_pairs, dir_pairs = self.copier.plan_trees([(os.path.join(data_loc, file), [os.path.join(folder, file) for folder in self.session_folders])
+                                                                for file in recording_folders], resume=True)
+                pairs.extend(file_pairs)
+            n_bytes, growing = follower.poll(pairs)
+            if n_bytes > 0 or len(pairs) != n_files:
+                last_change = time.time()
+                n_files = len(pairs)
+            print("{:.0f} s: {:.2f} GB copied, {} of {} files still growing".format(time.time()-start, self.copier.bytes_read/1e9, growing, n_files))
+            if growing == 0 and n_files > 0 and time.time() - last_change >= idle_minutes*60:
+                break
+            time.sleep(poll_seconds)
+        for src, dst in dir_pairs:
+            shutil.copystat(src, dst)
+        print("Recordings followed until {} minutes without new data.".format(idle_minutes))
+        end = time.time()
+        print("That took {} seconds".format(end-start))
+
+    def rename_recordings(self, folder):
+        """
+        Number the recording folders of one destination recording1, recording2... and copy a timestamps.npy into each.
+        """
         rename_dict = {0: 'recording1', 1: 'recording2', 2:'recording3', 3: 'recording4', 4: 'recording5'}
-        for n, name in enumerate(glob2.glob(os.path.join(self.main_folder, 'recording*'))):
+        for n, name in enumerate(sorted(glob2.glob(os.path.join(folder, 'recording*')))):
             if "recording" in name:
                 old = name
                 new = os.path.join(os.path.dirname(name), rename_dict[n])
                 try:
                     os.rename(old, new)
+                    self.copier.manifest_for(old).rename(old, new)
                 except FileExistsError:
                     pass
                 try:
@@ -167,14 +375,12 @@ class TransferFiles():
                     #it's necessary to save 1 timestamps.npy file per recording (from any probe is fine) outside of the folder where it usually is
                     #and this needs to happen before Kilosort is run because KS deletes that file.
                     #this timestamps.npy file is necessary to align the opto data properly. 
-                    probeA_timestamps = glob2.glob(os.path.join(new, 'continuous', 'Neuropix-PXI-*.0', 'timestamps.npy'))[0]
-                    shutil.copy(probeA_timestamps, new)
+                    if len(self.transferred_files(os.path.join(new, 'timestamps.npy'))) == 0:
+                        probeA_timestamps = glob2.glob(os.path.join(new, 'continuous', 'Neuropix-PXI-*.0', 'timestamps.npy'))[0]
+                        self.copier.copy(probeA_timestamps, new)
                 except:
                     print("---------{} timestamps file couldn't be moved.---------".format(rename_dict[n]))
 
-        end = time.time()
-        print("That took {} seconds".format(end-start))
-
     def xfer_sync_data(self):
         """
         Tranfer session sync files. Files are matched by last modified timestamp to the correct recording folder.
@@ -182,11 +388,7 @@ class TransferFiles():
         start = time.time()
         print("Transferring sync data.")
 
-        session_sync_files = []
-        for file in os.listdir(self.computer_names['sync']):
-            full_path = os.path.join(self.computer_names['sync'], file)
-            if (self.get_date_modified(full_path, '%Y-%m-%d') == self.date) & ('.h5' in full_path):
-                session_sync_files.append(full_path)
+        session_sync_files = [full_path for full_path in self.inventory.modified_on('sync', self.date) if '.h5' in full_path]
 
         if self.multiple_experiments==True:
             modified_sync_files_list = []
@@ -195,21 +397,24 @@ class TransferFiles():
                 if sync_timestamp.time() > self.experiment_timestamp:
                     modified_sync_files_list.append(sync_file)
             # self.session_sync_files = sorted(modified_sync_files_list)
-            self.session_sync_files = [(fullpath, datetime.fromtimestamp(os.stat(fullpath).st_ctime)) for fullpath in modified_sync_files_list]
+            self.session_sync_files = [(fullpath, datetime.fromtimestamp(self.inventory.stat(fullpath)['ctime'])) for fullpath in modified_sync_files_list]
         else:
-            self.session_sync_files = [(fullpath, datetime.fromtimestamp(os.stat(fullpath).st_ctime)) for fullpath in session_sync_files]
+            self.session_sync_files = [(fullpath, datetime.fromtimestamp(self.inventory.stat(fullpath)['ctime'])) for fullpath in session_sync_files]
             # self.session_sync_files = sorted(session_sync_files)
         self.session_sync_files.sort(key = lambda x: x[1])
 
-        for n, name in enumerate(sorted(glob2.glob(os.path.join(self.main_folder, 'recording*')))):
-            if len(glob2.glob(os.path.join(name, "*sync.h5"))) == 0:
-                shutil.copy(self.session_sync_files[n][0], name)
-                old = os.path.join(name, os.path.basename(self.session_sync_files[n][0]))
-                new = os.path.join(name, os.path.basename(self.session_sync_files[n][0]).split('.')[0] + "_sync.h5")
-                os.rename(old, new)
-                print('sync file transferred to {}'.format(os.path.basename(name)))
-            else:
-                print('{} already had a sync file'.format(os.path.basename(name)))
+        to_copy = {}
+        for folder in self.session_folders:
+            for n, name in enumerate(sorted(glob2.glob(os.path.join(folder, 'recording*')))):
+                if len(self.transferred_files(os.path.join(name, "*sync.h5"))) == 0:
+                    new = os.path.join(name, os.path.basename(self.session_sync_files[n][0]).split('.')[0] + "_sync.h5")
+                    to_copy.setdefault(self.session_sync_files[n][0], []).append(new)
+                else:
+                    print('{} already had a sync file'.format(self.short_name(name)))
+        for old, new_files in sorted(to_copy.items()):
+            self.scheduler.add('sync', [(old, new_files)], recording=os.path.basename(os.path.dirname(new_files[0])),
+                                message='\n'.join(['sync file transferred to {}'.format(self.short_name(os.path.dirname(new))) for new in new_files]))
+        self.submit()
 
         end = time.time()
         print("That took {} seconds".format(end-start))
@@ -222,10 +427,7 @@ class TransferFiles():
         print("Transferring opto data.")
 
         mod_date = datetime.strftime(datetime.strptime(self.date, "%Y-%m-%d"), "%y%m%d")
-        session_opto_files = []
-        for file in os.listdir(self.computer_names['stim']):
-            if mod_date in file:
-                session_opto_files.append(os.path.join(self.computer_names['stim'], file))
+        session_opto_files = self.inventory.match('stim', mod_date)
 
         if self.multiple_experiments==True:
             modified_opto_files_list = []
@@ -237,15 +439,18 @@ class TransferFiles():
         else:
             self.session_opto_files = sorted(session_opto_files)
 
-        for n, name in enumerate(sorted(glob2.glob(os.path.join(self.main_folder, 'recording*')))):
-            if len(glob2.glob(os.path.join(name, "*opto.pkl"))) == 0:
-                shutil.copy(self.session_opto_files[n], name)
-                old = os.path.join(name, os.path.basename(self.session_opto_files[n]))
-                new = os.path.join(name, os.path.basename(self.session_opto_files[n].split('_')[0] + "_{}.opto.pkl".format(self.mouse_id)))
-                os.rename(old, new)
-                print('opto file transferred to {}'.format(os.path.basename(name)))
-            else:
-                print('{} already had an opto file'.format(os.path.basename(name)))
+        to_copy = {}
+        for folder in self.session_folders:
+            for n, name in enumerate(sorted(glob2.glob(os.path.join(folder, 'recording*')))):
+                if len(self.transferred_files(os.path.join(name, "*opto.pkl"))) == 0:
+                    new = os.path.join(name, os.path.basename(self.session_opto_files[n].split('_')[0] + "_{}.opto.pkl".format(self.mouse_id)))
+                    to_copy.setdefault(self.session_opto_files[n], []).append(new)
+                else:
+                    print('{} already had an opto file'.format(self.short_name(name)))
+        for old, new_files in sorted(to_copy.items()):
+            self.scheduler.add('opto', [(old, new_files)], recording=os.path.basename(os.path.dirname(new_files[0])),
+                                message='\n'.join(['opto file transferred to {}'.format(self.short_name(os.path.dirname(new))) for new in new_files]))
+        self.submit()
 
         end = time.time()
         print("That took {} seconds".format(end-start))
@@ -258,29 +463,32 @@ class TransferFiles():
         print("Transferring videos.")
         mod_date = str(self.date).replace('-', '')
 
-        session_video_files = []
-        for file in os.listdir(self.computer_names['video_eye_beh']):
-            if mod_date in file:
-                session_video_files.append(os.path.join(self.computer_names['video_eye_beh'], file))
+        session_video_files = self.inventory.match('video_eye_beh', mod_date)
 
         beh_video_files = sorted([f for f in session_video_files if 'Behavior' in f])
         eye_video_files = sorted([f for f in session_video_files if 'Eye' in f])
 
-        for n, name in enumerate(sorted(glob2.glob(os.path.join(self.main_folder, 'recording*')))):
-            if (len(glob2.glob(os.path.join(name, "*Behavior*"))) == 0) | (len(glob2.glob(os.path.join(name, "*Eye*"))) == 0):
-                idx1 = n*2
-                idx2 = idx1+1
-                try:
-                    shutil.copy(beh_video_files[idx1], name)
-                    shutil.copy(beh_video_files[idx2], name)
-                    shutil.copy(eye_video_files[idx1], name)
-                    shutil.copy(eye_video_files[idx2], name)
-                    print("video files transferred to {}.".format(os.path.basename(name)))
-                except:
-                    print("no videos for {}".format(os.path.basename(name)))
-                    pass
-            else:
-                print('{} already had video files'.format(os.path.basename(name)))
+        to_copy = {}
+        for folder in self.session_folders:
+            for n, name in enumerate(sorted(glob2.glob(os.path.join(folder, 'recording*')))):
+                if (len(self.transferred_files(os.path.join(name, "*Behavior*"))) == 0) | (len(self.transferred_files(os.path.join(name, "*Eye*"))) == 0):
+                    idx1 = n*2
+                    idx2 = idx1+1
+                    try:
+                        videos = [beh_video_files[idx1], beh_video_files[idx2], eye_video_files[idx1], eye_video_files[idx2]]
+                        to_copy.setdefault(os.path.basename(name), {})
+                        for video in videos:
+                            to_copy[os.path.basename(name)].setdefault(video, []).append(os.path.join(name, os.path.basename(video)))
+                    except:
+                        print("no videos for {}".format(self.short_name(name)))
+                        pass
+                else:
+                    print('{} already had video files'.format(self.short_name(name)))
+        for recording, videos in sorted(to_copy.items()):
+            folders = sorted(set([os.path.dirname(new) for new_files in videos.values() for new in new_files]))
+            self.scheduler.add('videos', sorted(videos.items()), recording=recording,
+                                message='\n'.join(["video files transferred to {}.".format(self.short_name(name)) for name in folders]))
+        self.submit()
 
         end = time.time()
         print("That took {} seconds".format(end-start))
@@ -293,13 +501,11 @@ class TransferFiles():
         print("Transferring brain images.")
         mod_date = str(self.date).replace('-', '_')
 
-        session_img_files = []
-        for file in os.listdir(self.computer_names['video_brain_img']):
-            if mod_date in file:
-                session_img_files.append(os.path.join(self.computer_names['video_brain_img'], file))
+        session_img_files = self.inventory.match('video_brain_img', mod_date)
 
-        for file in session_img_files:
-            shutil.copy(file, self.main_folder)
+        self.scheduler.add('images', [(file, [os.path.join(folder, os.path.basename(file)) for folder in self.session_folders])
+                                        for file in session_img_files])
+        self.submit()
         end = time.time()
         print("That took {} seconds".format(end-start))
 
@@ -310,8 +516,9 @@ class TransferFiles():
         start = time.time()
         print("Transferring params file.")
         try:
-            param_file = glob2.glob(os.path.join(self.computer_names['video_sess_params'], '*{}*'.format(self.date)))[0]
-            shutil.copy(param_file, self.main_folder)
+            param_file = self.inventory.match('video_sess_params', self.date)[0]
+            self.scheduler.add('params', [(param_file, [os.path.join(folder, os.path.basename(param_file)) for folder in self.session_folders])])
+            self.submit()
             end = time.time()
             print("That took {} seconds".format(end-start))
         except:
@@ -327,6 +534,21 @@ if __name__ == "__main__":
     parser.add_argument('--destination', nargs="+", default=('dest_root', 'np2_data'))
     parser.add_argument('--openephys_folder',default='false')
     parser.add_argument('--path_to_files', default=None, type=str)
+    parser.add_argument('--n_threads', default=8, type=int)
+    parser.add_argument('--extra_destination', nargs="+", action='append', default=None,
+                        help="another destination written from the same read, a key and optional sub-folder, eg --extra_destination backup_drive; can be repeated")
+    parser.add_argument('--priorities', type=json.loads, default=None, help='JSON of category: priority, eg \'{"videos": 0}\'')
+    parser.add_argument('--max_mb_per_second', type=float, default=None)
+    parser.add_argument('--watch', action='store_true', help="follow the recordings while the session is running, then transfer the rest")
+    parser.add_argument('--idle_minutes', type=float, default=30.)
+    parser.add_argument('--verify', action='store_true', help="check the destination against the transfer manifest instead of transferring")
     args = parser.parse_args()
 
-    TransferFiles(args.date, args.mouse_id, args.destination, args.openephys_folder, args.path_to_files).run_it()
+    runner = TransferFiles(args.date, args.mouse_id, args.destination, args.openephys_folder, args.path_to_files, args.n_threads,
+                            extra_destinations=args.extra_destination, priorities=args.priorities, max_mb_per_second=args.max_mb_per_second)
+    if args.verify:
+        runner.verify_transfer()
+    else:
+        if args.watch:
+            runner.watch_ephys_data(idle_minutes=args.idle_minutes)
+        runner.run_it()
@@ -6,9 +6,13 @@ import time
 import sys
 import shutil
 import json
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from np2_ultra.tools import io, file_tools
 import np2_ultra.tools.analysis_tools as ant
+import np2_ultra.tools.waveform_tools as wt
+import np2_ultra.tools.signal_tools as st
 
 from allensdk.brain_observatory.ecephys.align_timestamps import barcode
 from allensdk.brain_observatory.ecephys.align_timestamps import channel_states as cs
@@ -23,15 +27,13 @@ class GetWaveforms():
     get_all_file_locations(recordings = recordings_to_run, probes = probes_to_run, pxi_dict = pxi_dict)
     waveform_extraction_params(use_json_params=use_json_params)
     run_it()
+    run_parallel()
     get_recording_sync_opto(recording)
-    get_recording_and_probe(recording, probe)
-    get_all_ks_files(recording, probe)
-    get_probe_sync_data(recording, probe)
-    get_waveforms(recording, probe)
-    get_opto_data()
-    save_data_dicts(recording, probe)
+    get_probes_to_run(recording)
+    make_probe_job(recording, probe)
+    record_failure(recording, probe, error)
     """
-    def __init__(self, date, mouse_id, probes_to_run='all', recordings_to_run='all', use_json_params=None, pxi_dict='default', opto_params='default'):
+    def __init__(self, date, mouse_id, probes_to_run='all', recordings_to_run='all', use_json_params=None, pxi_dict='default', opto_params='default', n_workers=1, n_jobs=1):
         """
         Parameters
         ----------
@@ -53,9 +55,20 @@ class GetWaveforms():
         opto_params: path, optional, default = 'default'
             Pass a path to a JSON containing a dictionary of opto PSTH parameters.
             Default option runs the file located at ../files/opto_params.json
+        n_workers: int, optional, default = 1
+            Number of worker processes used to extract waveforms for the good clusters of a probe.
+            Each worker opens its own memmap of the raw data and handles a disjoint set of clusters.
+        n_jobs: int, optional, default = 1
+            Number of recordings and recording/probe jobs to run at the same time, each in its own process.
+            Total processes used can be up to n_jobs * n_workers.
         """
         self.date = date
         self.mouse_id = mouse_id
+        self.n_workers = n_workers
+        self.n_jobs = n_jobs
+        self.recording_sync = {}
+        self.completed_jobs = []
+        self.failed_jobs = {}
         self.computer_names = io.read_computer_names()
 
         self.get_all_file_locations(recordings = recordings_to_run, probes = probes_to_run, pxi_dict = pxi_dict, opto_params = opto_params)
@@ -64,23 +77,122 @@ class GetWaveforms():
     def run_it(self):
         """
         Runs waveform extraction and saves dictionaries for recordings and probes specified.
+        A failure in one recording or recording/probe job is recorded in failed_jobs and does not stop the rest of the session.
         if __name__ == __main__ automatically calls this function.
         """
-        for recording in self.recording_dirs.keys():
-            self.get_recording_sync_opto(recording)
-
-            for probe in self.probe_data_dirs[recording].keys():
-                skipped_kilosort = self.get_files.get_kilosort_flag(recording, probe)
-                if skipped_kilosort==True:
-                    pass
-                else:
-                    print("--------Extracting waveforms: {} probe {} for {}--------".format(recording, probe, self.session_name))
-                    self.get_recording_and_probe(recording, probe)
-                    self.get_all_ks_files(recording, probe)
-                    self.get_probe_sync_data(recording, probe)
-                    self.get_waveforms(recording, probe)
-                    self.get_opto_data()
-                    self.save_data_dicts(recording, probe)
+        if self.n_jobs > 1:
+            self.run_parallel()
+        else:
+            for recording in self.recording_dirs.keys():
+                try:
+                    self.get_recording_sync_opto(recording)
+                except Exception:
+                    self.record_failure(recording, None, traceback.format_exc())
+                    continue
+
+                for probe in self.get_probes_to_run(recording):
+                    try:
+                        self.make_probe_job(recording, probe).run()
+                        self.completed_jobs.append((recording, probe))
+                    except Exception:
+                        self.record_failure(recording, probe, traceback.format_exc())
+
+        if len(self.failed_jobs) > 0:
+            print("--------{} job(s) failed for {}--------".format(len(self.failed_jobs), self.session_name))
+            for recording, probe in self.failed_jobs.keys():
+                print("{} probe {}".format(recording, probe))
+
+    def run_parallel(self):
+        """
+        Runs recordings and recording/probe jobs concurrently in up to n_jobs processes.
+        Probe jobs for a recording are queued as soon as that recording's sync and opto data are loaded.
+        Is called by run_it() when n_jobs > 1.
+        """
+        with ProcessPoolExecutor(max_workers=self.n_jobs) as executor:
+            sync_futures = {executor.submit(load_recording_sync_opto, self.recording_dirs[recording]): recording
+                            for recording in self.recording_dirs.keys()}
+            job_futures = {}
+            for future in as_completed(sync_futures):
+                recording = sync_futures[future]
+                try:
+                    self.recording_sync[recording] = future.result()
+                except Exception:
+                    self.record_failure(recording, None, traceback.format_exc())
+                    continue
+                for probe in self.get_probes_to_run(recording):
+                    try:
+                        job = self.make_probe_job(recording, probe)
+                    except Exception:
+                        self.record_failure(recording, probe, traceback.format_exc())
+                        continue
+                    job_futures[executor.submit(job.run)] = (recording, probe)
+
+            for future in as_completed(job_futures):
+                recording, probe = job_futures[future]
+                try:
+                    future.result()
+                    self.completed_jobs.append((recording, probe))
+                except Exception:
+                    self.record_failure(recording, probe, traceback.format_exc())
+
+    def get_probes_to_run(self, recording):
+        """
+        List the probes of a recording that have not been flagged to skip Kilosort.
+
+        Parameters
+        ----------
+        recording: str
+            The name of the recording being run, eg 'recording2'
+        """
+        return [probe for probe in self.probe_data_dirs[recording].keys() if self.get_files.get_kilosort_flag(recording, probe)==False]
+
+    def make_probe_job(self, recording, probe):
+        """
+        Create the ProbeJob that holds all state for one recording/probe combo.
+        get_recording_sync_opto(recording) must have been run first.
+
+        Parameters
+        ----------
+        recording: str
+            The name of the recording being run, eg 'recording2'
+        probe: str
+            The name of the probe being run, eg 'C'
+        """
+        noise_settings = None
+        if self.extraction_params.get('channel_noise', False):
+            raw_data_file, noise_settings = self.get_files.get_channel_noise_settings(recording, probe)
+        return ProbeJob(recording, probe,
+                        session_name = self.session_name,
+                        recording_dir = self.recording_dirs[recording],
+                        data_dir = self.probe_data_dirs[recording][probe],
+                        events_dir = self.events_dirs[recording][probe],
+                        raw_data_file = self.get_files.get_raw_data_file(recording, probe),
+                        analysis_dir = self.analysis_dir,
+                        recording_sync = self.recording_sync[recording],
+                        extraction_params = self.extraction_params,
+                        opto_params = self.opto_params,
+                        n_workers = self.n_workers,
+                        noise_settings = noise_settings)
+
+    def record_failure(self, recording, probe, error):
+        """
+        Store the traceback of a failed recording (probe = None) or recording/probe job in failed_jobs.
+
+        Parameters
+        ----------
+        recording: str
+            The name of the recording being run, eg 'recording2'
+        probe: str or None
+            The name of the probe being run, eg 'C'. None if the recording level step failed.
+        error: str
+            The formatted traceback.
+        """
+        self.failed_jobs[(recording, probe)] = error
+        if probe is None:
+            print("--------Failed loading sync/opto data for {}--------".format(recording))
+        else:
+            print("--------Failed extracting waveforms: {} probe {}--------".format(recording, probe))
+        print(error)
 
     def get_all_file_locations(self, recordings, probes, pxi_dict, opto_params):
         """
@@ -128,7 +240,19 @@ class GetWaveforms():
                                 'tot_waveforms': 200, #total waveforms
                                 'samples_per_spike': 90,
                                 'pre_samples': 30,
-                                'n_boots': 100
+                                'n_boots': 100,
+                                'channel_radius': None, #microns around the peak channel, None extracts every channel
+                                'random_seed': None, #seeds each cluster's bootstraps, None uses the global random state
+                                'strategy': 'random', #'random' reads each cluster's spikes, 'stream' reads the file once in time order
+                                'stream_chunk_samples': 300000, #samples per sequential read for the 'stream' strategy
+                                'stream_memory_mb': 1024, #accumulator memory open at once for the 'stream' strategy, clusters over it are streamed in further passes
+                                'snippet_block_size': 256, #distinct spikes read and accumulated at a time
+                                'accumulator_dtype': 'float64', #'float32' halves accumulator memory
+                                'highpass_hz': None, #high-pass cutoff before averaging, None averages the raw data
+                                'highpass_taps': 301, #FIR high-pass filter length
+                                'reference': 'median', #subtract the 'median' or 'mean' across channels before filtering, or None
+                                'preprocess_mode': 'on_the_fly', #'on_the_fly' filters snippets as they are read, 'cached' writes continuous_preprocessed.dat once
+                                'channel_noise': False #measure per-channel noise (a pass over the raw data) and add noise_SNR to each cluster
                                 }
         self.extraction_params = extraction_params
 
@@ -142,151 +266,244 @@ class GetWaveforms():
         recording: str
             The name of the recording being run, eg 'recording2'
         """
-        recording_folder = self.recording_dirs[recording]
+        self.recording_sync[recording] = load_recording_sync_opto(self.recording_dirs[recording])
 
-        sync_file = glob2.glob(os.path.join(recording_folder, '*sync.h5'))[0]
-        self.sync_dataset = Dataset(sync_file)
-        self.probe_sample_rate = 30000.
 
-        barcode_channel = self.sync_dataset._line_to_bit('barcode_ephys')
-        sample_freq_digital = self.sync_dataset.sample_freq
+def load_recording_sync_opto(recording_folder):
+    """
+    Load and unpack the sync barcodes and opto timestamp data for a recording.
 
-        on_events = self.sync_dataset.get_rising_edges(barcode_channel)
-        off_events = self.sync_dataset.get_falling_edges(barcode_channel)
-        on_times = on_events / sample_freq_digital
-        off_times = off_events / sample_freq_digital
+    Parameters
+    ----------
+    recording_folder: path
+        The recording directory containing the *sync.h5 and *opto.pkl files.
 
-        self.sync_barcode_times, self.sync_barcodes = barcode.extract_barcodes_from_times(on_times, off_times)
+    Returns
+    ----------
+    recording_sync: dict
+        probe_sample_rate, sync_barcode_times, sync_barcodes, opto_data and opto_on_times for the recording.
+    """
+    sync_file = glob2.glob(os.path.join(recording_folder, '*sync.h5'))[0]
+    sync_dataset = Dataset(sync_file)
 
-        opto_pkl = glob2.glob(os.path.join(recording_folder, '*opto.pkl'))[0]
-        self.opto_data = pd.read_pickle(opto_pkl)
-        self.opto_on_times,opto_off_times = ant.get_sync_line_data(self.sync_dataset,'stim_trial_opto')
+    barcode_channel = sync_dataset._line_to_bit('barcode_ephys')
+    sample_freq_digital = sync_dataset.sample_freq
 
-    def get_recording_and_probe(self, recording, probe):
-        """
-        Define recording and probe names for this loop of extraction.
-        Is run once per recording/probe combo.
+    on_events = sync_dataset.get_rising_edges(barcode_channel)
+    off_events = sync_dataset.get_falling_edges(barcode_channel)
+    on_times = on_events / sample_freq_digital
+    off_times = off_events / sample_freq_digital
 
-        Parameters
-        ----------
-        recording: str
-            The name of the recording being run, eg 'recording2'
-        probe: str
-            The name of the probe being run, eg 'C'
-        """
-        self.session_info = {'session_name': self.session_name,
-                           'probe_label': probe,
-                           'recording_number': recording}
+    sync_barcode_times, sync_barcodes = barcode.extract_barcodes_from_times(on_times, off_times)
 
+    opto_pkl = glob2.glob(os.path.join(recording_folder, '*opto.pkl'))[0]
+    opto_data = pd.read_pickle(opto_pkl)
+    opto_on_times, opto_off_times = ant.get_sync_line_data(sync_dataset, 'stim_trial_opto')
+    sync_dataset.close()
+
+    return {'probe_sample_rate': 30000.,
+            'sync_barcode_times': sync_barcode_times,
+            'sync_barcodes': sync_barcodes,
+            'opto_data': opto_data,
+            'opto_on_times': opto_on_times}
 
-    def get_all_ks_files(self, recording, probe):
-        '''
-        Get and read all relevant kilosort files.
-        Is run once per recording/probe combo.
 
+class ProbeJob():
+    """
+    Waveform extraction, opto PSTHs and saving for a single recording/probe combo.
+    All per-probe state lives on the job, so jobs can run in separate processes.
+
+    Methods
+    ----------
+    run()
+    get_session_info()
+    get_all_ks_files()
+    get_probe_sync_data()
+    get_channel_noise()
+    get_waveforms()
+    get_opto_data()
+    save_data_dicts()
+    """
+    def __init__(self, recording, probe, session_name, recording_dir, data_dir, events_dir, raw_data_file, analysis_dir,
+                        recording_sync, extraction_params, opto_params, n_workers=1, noise_settings=None):
+        """
         Parameters
         ----------
         recording: str
             The name of the recording being run, eg 'recording2'
         probe: str
             The name of the probe being run, eg 'C'
-        '''
-        data_dir = self.probe_data_dirs[recording][probe]
-        ks_file_dict = {'spike_clusters': 'spike_clusters.npy',
-                        'spike_times': 'spike_times.npy',
-                        'channel_map': 'channel_map.npy',}
-
-        timestamps_file = os.path.join(self.recording_dirs[recording], 'timestamps.npy')
-        self.recording_timestamp_zero  = np.load(timestamps_file)[0]
-        self.spike_times_opto, self.spike_times_wf= ant.fix_spike_times(os.path.join(data_dir, ks_file_dict['spike_times']),
-                                                                        timestamps_file,
-                                                                        data_dir)
-        self.clusters = np.load(os.path.join(data_dir, ks_file_dict['spike_clusters']))
-        self.channel_map = np.squeeze(np.load(os.path.join(data_dir, ks_file_dict['channel_map'])))
-
-        if self.clusters.size > self.spike_times_wf.size:
-            print('Cluster assignments outnumber spike times. Taking subset.')
-            self.clusters = self.clusters[:self.spike_times_wf.size]
+        session_name: str
+            The session ID in YYYY-MM-DD_NNNNNN format.
+        recording_dir: path
+            The recording directory, containing the copied timestamps.npy file.
+        data_dir: path
+            The probe's continuous data directory, containing the Kilosort output.
+        events_dir: path
+            The probe's TTL events directory.
+        raw_data_file: path
+            The probe's continuous.dat file.
+        analysis_dir: path
+            Top level directory for the session analysis files.
+        recording_sync: dict
+            Sync and opto data for the recording, see load_recording_sync_opto()
+        extraction_params: dict
+            Waveform extraction parameters, see GetWaveforms.waveform_extraction_params()
+        opto_params: dict
+            Opto PSTH parameters.
+        n_workers: int, optional, default = 1
+            Number of worker processes used for waveform extraction.
+        noise_settings: dict, optional, default = None
+            signal_tools.get_channel_noise() settings for raw_data_file, from GetFiles.get_channel_noise_settings(), so the
+            noise cache is shared with the Kilosort channel screen. Needed if extraction_params['channel_noise'] is set.
+        """
+        self.recording = recording
+        self.probe = probe
+        self.session_name = session_name
+        self.recording_dir = recording_dir
+        self.data_dir = data_dir
+        self.events_dir = events_dir
+        self.raw_data_file = raw_data_file
+        self.analysis_dir = analysis_dir
+        self.extraction_params = extraction_params
+        self.opto_params = opto_params
+        self.n_workers = n_workers
+        self.noise_settings = noise_settings
 
-        cluster_IDs = pd.read_csv(os.path.join(data_dir,'cluster_KSLabel.tsv'),sep='\t', index_col='cluster_id')
-        cluster_assignments = {}
-        for row in cluster_IDs.index:
-            cluster_assignments[str(row)] = cluster_IDs.loc[row, 'KSLabel']
+        self.probe_sample_rate = recording_sync['probe_sample_rate']
+        self.sync_barcode_times = recording_sync['sync_barcode_times']
+        self.sync_barcodes = recording_sync['sync_barcodes']
+        self.opto_data = recording_sync['opto_data']
+        self.opto_on_times = recording_sync['opto_on_times']
 
-        self.good_clusters = [int(c) for c in cluster_assignments.keys() if cluster_assignments[c]=='good']
+    def run(self):
+        """
+        Runs every step for the recording/probe combo and saves the data dictionary.
 
+        Returns
+        ----------
+        save_path: path
+            Location of the saved data dictionary.
+        """
+        print("--------Extracting waveforms: {} probe {} for {}--------".format(self.recording, self.probe, self.session_name))
+        self.get_session_info()
+        self.get_all_ks_files()
+        self.get_probe_sync_data()
+        self.get_channel_noise()
+        self.get_waveforms()
+        self.get_opto_data()
+        return self.save_data_dicts()
+
+    def get_session_info(self):
+        """
+        Define recording and probe names for this job.
+        """
+        self.session_info = {'session_name': self.session_name,
+                           'probe_label': self.probe,
+                           'recording_number': self.recording}
 
-    def get_waveforms(self, recording, probe):
+    def get_all_ks_files(self):
         '''
-        Creates a dictionary of wavefroms extracted according to waveform_extraction_params().
+        Open the Kilosort output as an ant.KilosortResults, which memory-maps each file as it is used and builds
+        spike_index (see ant.SpikeIndex) and the good cluster list (with any manual labels from phy) once.
         Is run once per recording/probe combo.
-
-        Parameters
-        ----------
-        recording: str
-            The name of the recording being run, eg 'recording2'
-        probe: str
-            The name of the probe being run, eg 'C'
         '''
-        data = self.get_files.get_raw_data(recording, probe).T
-        waveforms_dict = {}
-        for cluster_idx, cluster_num in enumerate(self.good_clusters):
-            print('Analyzing cluster {}, number {} of {}'.format(cluster_num, cluster_idx+1, len(self.good_clusters)))
+        self.ks_results = ant.KilosortResults(self.data_dir, timestamps_file=os.path.join(self.recording_dir, 'timestamps.npy'))
+        self.recording_timestamp_zero = self.ks_results.timestamp_zero
+        self.spike_times_wf = self.ks_results.spike_times
+        self.spike_times_opto = self.ks_results.aligned_spike_times
+        self.clusters = self.ks_results.spike_clusters
+        self.channel_map = self.ks_results.channel_map
+        self.spike_index = self.ks_results.spike_index
+        self.good_clusters = self.ks_results.good_clusters
+
+        if self.extraction_params.get('channel_radius') is not None:
+            self.templates = self.ks_results.templates
+            self.spike_templates = self.ks_results.spike_templates
+            self.channel_positions = self.ks_results.channel_positions
+
+
+    def get_channel_noise(self):
+        '''
+        Per-channel noise, saturation and dead/noisy channel flags for the probe, see signal_tools.get_channel_noise().
+        Measured once and cached next to the raw data, only if extraction_params['channel_noise'] is set, otherwise None.
+        Uses the same settings (and so the same cache) as GetFiles.get_channel_noise(), with the gain from settings.xml.
+        Is run once per recording/probe combo.
+        '''
+        if self.extraction_params.get('channel_noise', False)==False:
+            self.channel_noise = None
+            return
+        self.channel_noise = st.get_channel_noise(self.raw_data_file, **self.noise_settings)
 
-            in_cluster = np.where(self.clusters == cluster_num)[0]
+    def get_waveforms(self):
+        '''
+        Creates a dictionary of wavefroms extracted according to GetWaveforms.waveform_extraction_params().
+        Is run once per recording/probe combo.
+        '''
+        raw_data_file = self.raw_data_file
+        if self.extraction_params.get('highpass_hz') is not None and self.extraction_params.get('preprocess_mode') == 'cached':
+            raw_data_file = st.get_preprocessed_file(raw_data_file, self.extraction_params, sample_rate=self.probe_sample_rate)
+        use_neighbourhood = self.extraction_params.get('channel_radius') is not None
+
+        cluster_jobs = []
+        peak_channels = {}
+        for cluster_num in self.good_clusters:
+            in_cluster = self.spike_index.spikes_in_cluster(cluster_num)
             times_for_cluster = self.spike_times_wf[in_cluster]
-            waveform_boots = np.zeros((self.extraction_params['n_boots'],
-                                        self.extraction_params['samples_per_spike'],
-                                        self.extraction_params['n_channels']))
-
-            SNR_boots=np.zeros(waveform_boots.shape)
-
-            for i in range(self.extraction_params['n_boots']):
-                times_boot = ant.bootstrap_resample(times_for_cluster, n=self.extraction_params['tot_waveforms'])
-                waveforms = np.zeros((self.extraction_params['samples_per_spike'],
-                                    self.extraction_params['n_channels'],
-                                    self.extraction_params['tot_waveforms']))
-
-                bad_spikes = []
-                for wv_idx in range(0, self.extraction_params['tot_waveforms']):
-                    peak_time = times_boot[wv_idx][0]
-                    raw_waveform = data[int(peak_time-self.extraction_params['pre_samples']):int(peak_time+self.extraction_params['samples_per_spike']-self.extraction_params['pre_samples']),:]
-                    if raw_waveform.shape[0] < self.extraction_params['samples_per_spike']:
-                        bad_spikes.append(wv_idx)
-                        continue
-                    else:
-                        norm_waveform = raw_waveform - np.tile(raw_waveform[0,:],(self.extraction_params['samples_per_spike'],1))
-                        waveforms[:, :, wv_idx] = norm_waveform
-                if len(bad_spikes) > 0:
-                    waveforms = waveforms[:, :, np.setdiff1d(np.arange(self.extraction_params['tot_waveforms']), bad_spikes)]
-                SNR_boots[i,:,:]=ant.signaltonoise(waveforms, axis=2)
-                waveform_boots[i,:,:]=np.mean(waveforms,2)
+            channels = None
+            if use_neighbourhood:
+                peak_idx = wt.get_peak_channel(self.spike_templates[in_cluster], self.templates)
+                neighbour_idx = wt.get_channel_neighbourhood(peak_idx, self.channel_positions, self.extraction_params['channel_radius'])
+                channels = self.channel_map[neighbour_idx]
+                peak_channels[cluster_num] = self.channel_map[peak_idx]
+            cluster_jobs.append((cluster_num, times_for_cluster, channels))
+
+        random_seed = self.extraction_params.get('random_seed')
+        if self.n_workers > 1:
+            if random_seed is None:
+                random_seed = np.random.randint(2**31)
+            results = {}
+            with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                futures = [executor.submit(wt.extract_cluster_set, raw_data_file, cluster_jobs[n::self.n_workers],
+                                            self.extraction_params, random_seed) for n in range(self.n_workers)]
+                for future in futures:
+                    results.update(future.result())
+        else:
+            results = wt.extract_cluster_set(raw_data_file, cluster_jobs, self.extraction_params, random_seed)
 
-            waveforms_dict[str(cluster_num)] = {'waveform': np.squeeze(np.mean(waveform_boots,0))[:, self.channel_map],
-                                                'SNR': np.squeeze(np.mean(SNR_boots,0))[:, self.channel_map] }
+        if self.channel_noise is not None:
+            noise_counts = self.channel_noise['mad_uv'] / self.channel_noise['gain_factor']
+            noise_counts = np.where(noise_counts > 0, noise_counts, np.nan)
+        waveforms_dict = {}
+        for cluster_num, times_for_cluster, channels in cluster_jobs:
+            waveform, SNR = results[cluster_num]
+            if channels is None:
+                channels = self.channel_map
+                waveforms_dict[str(cluster_num)] = {'waveform': waveform[:, channels],
+                                                    'SNR': SNR[:, channels]}
+            else:
+                waveforms_dict[str(cluster_num)] = {'waveform': waveform,
+                                                    'SNR': SNR,
+                                                    'channels': channels,
+                                                    'peak_channel': peak_channels[cluster_num]}
+            if self.channel_noise is not None:
+                waveforms_dict[str(cluster_num)]['noise_SNR'] = np.ptp(waveforms_dict[str(cluster_num)]['waveform'], axis=0) / noise_counts[channels]
 
         for n, key in enumerate(waveforms_dict.keys()):
             k  = int(key)
-            in_cluster = np.where(self.clusters == k)[0]
+            in_cluster = self.spike_index.spikes_in_cluster(k)
             waveforms_dict[str(key)]['spike_times'] = np.squeeze(self.spike_times_wf[in_cluster]) / self.probe_sample_rate - self.probeShift
 
         self.waveforms_dict = waveforms_dict
 
 
-    def get_probe_sync_data(self, recording, probe):
+    def get_probe_sync_data(self):
         """
         Gets the probeshift timestamp from probe and sync barcodes.
         Is run once per recording/probe combo.
-
-        Parameters
-        ----------
-        recording: str
-            The name of the recording being run, eg 'recording2'
-        probe: str
-            The name of the probe being run, eg 'C'
         """
         # get barcodes from ephys data
-        events_folder = self.events_dirs[recording][probe]
+        events_folder = self.events_dir
         channel_states = np.load(os.path.join(events_folder,'channel_states.npy'))
         event_times = np.load(os.path.join(events_folder,'timestamps.npy'))
         event_times = event_times - self.recording_timestamp_zero
@@ -304,35 +521,76 @@ class GetWaveforms():
 
     def get_opto_data(self):
         """
-        Generates opto PSTHs.
+        Generates opto PSTHs for every good cluster, condition and level.
+        Each condition's trials are binned for all clusters in one call to ant.get_population_psth,
+        and the trial averages are stored as a dense array in opto_psth_tensor:
+            psth:
+                firing rate with shape (cluster, condition, level, bin), NaN padded where a condition has fewer bins
+            clusters, conditions, levels:
+                labels of the first three axes
+            times:
+                list of bin times for each condition
+            n_trials:
+                number of trials per (condition, level)
+        opto_response_dict keeps the nested stim/level/cluster layout, with each 'psth' a view into the dense array.
         Is run once per recording/probe combo.
         """
-        opto_response_dict = {}
-        for cond in np.unique(self.opto_data['opto_conditions']):
-            cond_dict = {}
-
+        spike_times = self.spike_times_wf.reshape(-1) / self.probe_sample_rate - self.probeShift
+        opto_conditions = np.asarray(self.opto_data['opto_conditions'])
+        opto_levels = np.asarray(self.opto_data['opto_levels'])
+        conditions = np.unique(opto_conditions)
+        levels = np.unique(opto_levels)
+
+        condition_params = []
+        condition_psths = []
+        condition_times = []
+        n_trials = np.zeros((conditions.size, levels.size), dtype=int)
+        for c, cond in enumerate(conditions):
             condition = self.opto_params['conditions'][str(cond)]
             params = {}
             for key in self.opto_params['parameters'][condition].keys():
                 params[key] = float(self.opto_params['parameters'][condition][key])
 
-            for level in np.unique(self.opto_data['opto_levels']):
-                level_dict = {}
-                for cluster in self.good_clusters:
-                    opto_trials = (self.opto_data['opto_conditions']==cond) & (self.opto_data['opto_levels']==level)
-                    psth,tp = ant.getPSTH(self.waveforms_dict[str(cluster)]['spike_times'],
-                                        self.opto_on_times[opto_trials]- params['pretime'],
-                                        params['window_dur'],
-                                        binSize=params['binsize'])
-                    level_dict[cluster] = {'psth': psth, 'times':tp}
-                cond_dict[level] = level_dict
+            cond_trials = np.where(opto_conditions==cond)[0]
+            trial_psths, tp = ant.get_population_psth(spike_times, self.spike_index, self.good_clusters,
+                                                    self.opto_on_times[cond_trials] - params['pretime'],
+                                                    params['window_dur'],
+                                                    binSize=params['binsize'])
+            level_psths = np.full((len(self.good_clusters), levels.size, tp.size), np.nan)
+            for l, level in enumerate(levels):
+                level_trials = opto_levels[cond_trials]==level
+                n_trials[c, l] = level_trials.sum()
+                if n_trials[c, l] > 0:
+                    level_psths[:, l, :] = trial_psths[:, level_trials, :].mean(axis=1)
+            condition_params.append(params)
+            condition_psths.append(level_psths)
+            condition_times.append(tp)
+
+        max_bins = max([tp.size for tp in condition_times]) if len(condition_times) > 0 else 0
+        psth_tensor = np.full((len(self.good_clusters), conditions.size, levels.size, max_bins), np.nan)
+        for c, level_psths in enumerate(condition_psths):
+            psth_tensor[:, c, :, :level_psths.shape[-1]] = level_psths
+        self.opto_psth_tensor = {'psth': psth_tensor,
+                                'clusters': np.array(self.good_clusters),
+                                'conditions': conditions,
+                                'levels': levels,
+                                'times': condition_times,
+                                'n_trials': n_trials}
+
+        opto_response_dict = {}
+        for c, cond in enumerate(conditions):
+            tp = condition_times[c]
+            cond_dict = {}
+            for l, level in enumerate(levels):
+                cond_dict[level] = {cluster: {'psth': psth_tensor[n, c, l, :tp.size], 'times': tp}
+                                    for n, cluster in enumerate(self.good_clusters)}
             cond_key = "stim_{}".format(cond)
             opto_response_dict[cond_key] = cond_dict
             opto_response_dict[cond_key]['stim_waveform'] = self.opto_data['opto_waveforms'][cond]
-            opto_response_dict[cond_key]['params'] = params
+            opto_response_dict[cond_key]['params'] = condition_params[c]
         self.opto_response_dict = opto_response_dict
 
-    def save_data_dicts(self, recording, probe):
+    def save_data_dicts(self):
         """
         Saves dictionary with processed session data with the following top level keys:
             extraction_params:
@@ -345,21 +603,32 @@ class GetWaveforms():
                 a list of clusters identified as 'good' by kilosort
             opto_data:
                 PSTHs and opto stim waveforms
+            opto_psth_tensor:
+                the same PSTHs as a dense (cluster, condition, level, bin) array, see get_opto_data()
 
         Is run once per recording/probe combo.
+
+        Returns
+        ----------
+        save_path: path
+            Location of the saved data dictionary.
         """
         save_dict = {'extraction_params': self.extraction_params,
                     'cluster_data': self.waveforms_dict,
                     'session_info': self.session_info,
                     'good_clusters': self.good_clusters,
-                    'opto_data': self.opto_response_dict}
+                    'opto_data': self.opto_response_dict,
+                    'opto_psth_tensor': self.opto_psth_tensor,
+                    'channel_noise': self.channel_noise}
 
         self.data_dict = save_dict
-        save_folder = os.path.join(self.analysis_dir, "probe{}".format(probe))
+        save_folder = os.path.join(self.analysis_dir, "probe{}".format(self.probe))
         if os.path.exists(save_folder)==False:
-            os.makedirs(save_folder)
-        pd.to_pickle(save_dict, os.path.join(save_folder, 'extracted_data_{}_probe{}.pkl'.format(recording, probe)))
+            os.makedirs(save_folder, exist_ok=True)
+        save_path = os.path.join(save_folder, 'extracted_data_{}_probe{}.pkl'.format(self.recording, self.probe))
+        pd.to_pickle(save_dict, save_path)
         print('data dictionary saved in {}'.format(save_folder))
+        return save_path
 
 
 if __name__ == "__main__":
@@ -371,7 +640,10 @@ if __name__ == "__main__":
     parser.add_argument('--recordings_to_run', nargs="+", default='all')
     parser.add_argument('--pxi_dict', default='default')
     parser.add_argument('--use_json_params', default=None)
+    parser.add_argument('--n_workers', type=int, default=1)
+    parser.add_argument('--n_jobs', type=int, default=1)
     args = parser.parse_args()
 
-    runner = GetWaveforms(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run, args.use_json_params, args.pxi_dict)
+    runner = GetWaveforms(args.date, args.mouse_id, args.probes_to_run, args.recordings_to_run, args.use_json_params, args.pxi_dict,
+                            n_workers=args.n_workers, n_jobs=args.n_jobs)
     runner.run_it()
@@ -14,6 +14,208 @@ def fix_spike_times(spike_times_file_path, timestamps_file, probe_data_dir):
     spike_times_old = np.load(os.path.join(probe_data_dir, 'spike_times_old.npy'))
     return spike_times, spike_times_old
 
+class SpikeIndex():
+    """
+    Spike-by-cluster index in compressed sparse row form, built once from Kilosort's spike_clusters.
+    Replaces scanning every spike with np.where(clusters == cluster) for each cluster.
+
+    Attributes
+    ----------
+    offsets: array
+        spike_order[offsets[c]:offsets[c+1]] are the spikes of cluster c.
+    spike_order: array
+        Spike indices sorted by cluster, in time order within each cluster.
+    counts: array
+        Number of spikes in each cluster, indexed by cluster number.
+
+    Methods
+    ----------
+    spikes_in_cluster(cluster_num)
+    """
+    def __init__(self, clusters):
+        """
+        Parameters
+        ----------
+        clusters: array
+            Cluster assignment of every spike (spike_clusters.npy).
+        """
+        clusters = np.asarray(clusters).reshape(-1)
+        self.spike_order = np.argsort(clusters, kind='stable')
+        self.counts = np.bincount(clusters)
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+
+    def spikes_in_cluster(self, cluster_num):
+        """
+        Parameters
+        ----------
+        cluster_num: int
+            The cluster number.
+
+        Returns
+        ----------
+        in_cluster: array
+            Indices of the cluster's spikes, in time order. Empty if the cluster has no spikes.
+        """
+        cluster_num = int(cluster_num)
+        if cluster_num < 0 or cluster_num >= self.counts.size:
+            return self.spike_order[:0]
+        return self.spike_order[self.offsets[cluster_num]:self.offsets[cluster_num+1]]
+
+class OffsetArray():
+    """
+    Read-only view of an array with a constant added, computed for only the elements that are indexed.
+    Used for spike times aligned to the start of the recording without loading or rewriting spike_times.npy.
+    """
+    def __init__(self, array, offset):
+        self.array = array
+        self.offset = offset
+        self.shape = array.shape
+        self.size = array.size
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, key):
+        return self.array[key] + self.offset
+
+    def __array__(self, dtype=None, copy=None):
+        aligned = np.asarray(self.array) + self.offset
+        return aligned if dtype is None else aligned.astype(dtype)
+
+class KilosortResults():
+    """
+    Kilosort/phy output of one probe, read on demand.
+    Every .npy output is memory-mapped the first time it is used, and derived structures (spike_index, labels,
+    good_clusters) are built once and kept.
+    Cluster labels are Kilosort's (cluster_KSLabel.tsv), overridden by any manual labels from phy (cluster_group.tsv).
+    Spike times aligned to the start of the recording are a lazy view (see OffsetArray), so spike_times.npy is never rewritten.
+    Folders where fix_spike_times() already rewrote spike_times.npy are read from spike_times_old.npy.
+
+    Attributes
+    ----------
+    spike_times: array
+        Spike times in samples from the start of the data file, as Kilosort wrote them.
+    aligned_spike_times: OffsetArray
+        spike_times plus the first sample number in timestamps.npy.
+    spike_clusters, spike_templates, amplitudes, templates, pc_features, pc_feature_ind, channel_map, channel_positions: array
+    spike_index: SpikeIndex
+    labels: dict
+        Cluster number: label, eg 'good', 'mua' or 'noise'.
+    good_clusters: list
+
+    Methods
+    ----------
+    load(name)
+    spikes_in_cluster(cluster_num)
+    """
+    def __init__(self, data_dir, timestamps_file=None):
+        """
+        Parameters
+        ----------
+        data_dir: path
+            Folder with the Kilosort output.
+        timestamps_file: path, optional, default = None
+            timestamps.npy of the recording, needed for aligned_spike_times and timestamp_zero.
+        """
+        self.data_dir = data_dir
+        self.timestamps_file = timestamps_file
+        self.arrays = {}
+        self.cache = {}
+
+    def load(self, name):
+        """
+        Memory-map one of the outputs, eg 'amplitudes' for amplitudes.npy. Kept for later calls.
+        """
+        if name not in self.arrays:
+            self.arrays[name] = np.load(os.path.join(self.data_dir, name + '.npy'), mmap_mode='r')
+        return self.arrays[name]
+
+    def cached(self, name, make):
+        if name not in self.cache:
+            self.cache[name] = make()
+        return self.cache[name]
+
+    @property
+    def spike_times(self):
+        if os.path.exists(os.path.join(self.data_dir, 'spike_times_old.npy')):
+            return self.load('spike_times_old')
+        return self.load('spike_times')
+
+    @property
+    def timestamp_zero(self):
+        return self.cached('timestamp_zero', lambda: np.load(self.timestamps_file, mmap_mode='r')[0])
+
+    @property
+    def aligned_spike_times(self):
+        return self.cached('aligned_spike_times', lambda: OffsetArray(self.spike_times, self.timestamp_zero))
+
+    @property
+    def spike_clusters(self):
+        def make():
+            clusters = self.load('spike_clusters').reshape(-1)
+            if clusters.size > self.spike_times.size:
+                print('Cluster assignments outnumber spike times. Taking subset.')
+                clusters = clusters[:self.spike_times.size]
+            return clusters
+        return self.cached('spike_clusters', make)
+
+    @property
+    def spike_templates(self):
+        return self.cached('spike_templates', lambda: self.load('spike_templates').reshape(-1)[:self.spike_clusters.size])
+
+    @property
+    def amplitudes(self):
+        return self.load('amplitudes')
+
+    @property
+    def templates(self):
+        return self.load('templates')
+
+    @property
+    def pc_features(self):
+        return self.load('pc_features')
+
+    @property
+    def pc_feature_ind(self):
+        return self.load('pc_feature_ind')
+
+    @property
+    def channel_map(self):
+        return self.cached('channel_map', lambda: np.squeeze(self.load('channel_map')))
+
+    @property
+    def channel_positions(self):
+        return self.load('channel_positions')
+
+    @property
+    def spike_index(self):
+        return self.cached('spike_index', lambda: SpikeIndex(self.spike_clusters))
+
+    def spikes_in_cluster(self, cluster_num):
+        return self.spike_index.spikes_in_cluster(cluster_num)
+
+    def read_labels(self, file_name):
+        labels = {}
+        path = os.path.join(self.data_dir, file_name)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                rows = [line.rstrip('\n').split('\t') for line in f if line.strip() != '']
+            for row in rows[1:]:
+                labels[int(row[0])] = row[1]
+        return labels
+
+    @property
+    def labels(self):
+        def make():
+            labels = self.read_labels('cluster_KSLabel.tsv')
+            labels.update(self.read_labels('cluster_group.tsv'))
+            return labels
+        return self.cached('labels', make)
+
+    @property
+    def good_clusters(self):
+        return self.cached('good_clusters', lambda: sorted([c for c, label in self.labels.items() if label == 'good']))
+
 def signaltonoise(a, axis=0, ddof=0):
     '''
     Created on Sat Sep 12 15:52:39 2020
@@ -47,21 +249,146 @@ def bootstrap_resample(X, n=None):
     X_resample = X[resample_i]
     return X_resample
 
-def getPSTH(spikes,startTimes,windowDur,binSize=0.01,avg=True):
+def getPSTH(spikes,startTimes,windowDur,binSize=0.01,avg=True,assume_sorted=False):
     '''
     Created on Sat Sep 12 15:52:39 2020
     author: svc_ccg
+
+    Each trial's window is found with np.searchsorted, so only the spikes inside the windows are binned,
+    and all trials are binned together with one np.bincount. Bin edges follow np.histogram (last bin closed).
+    Spike times are sorted first if they are not already in order, unless assume_sorted=True.
     '''
+    spikes = np.asarray(spikes).reshape(-1)
+    if (assume_sorted==False) and np.any(spikes[1:] < spikes[:-1]):
+        spikes = np.sort(spikes)
+    startTimes = np.asarray(startTimes).reshape(-1)
     bins = np.arange(0,windowDur+binSize,binSize)
-    counts = np.zeros((len(startTimes),bins.size-1))
-    for i,start in enumerate(startTimes):
-        counts[i] = np.histogram(spikes[(spikes>=start) & (spikes<=start+windowDur)]-start,bins)[0]
+    n_bins = bins.size-1
+
+    first = np.searchsorted(spikes, startTimes, side='left')
+    last = np.searchsorted(spikes, startTimes+windowDur, side='right')
+    n_in_window = np.maximum(last-first, 0)
+    trial = np.repeat(np.arange(startTimes.size), n_in_window)
+    window_offsets = np.cumsum(n_in_window) - n_in_window
+    spike_idx = np.arange(trial.size) - np.repeat(window_offsets, n_in_window) + np.repeat(first, n_in_window)
+
+    relative_times = spikes[spike_idx] - startTimes[trial]
+    bin_idx = np.searchsorted(bins, relative_times, side='right') - 1
+    bin_idx[relative_times == bins[-1]] = n_bins - 1
+    in_bins = (bin_idx >= 0) & (bin_idx < n_bins)
+    counts = np.bincount(trial[in_bins]*n_bins + bin_idx[in_bins], minlength=startTimes.size*n_bins)
+    counts = counts.reshape(startTimes.size, n_bins).astype(float)
     if avg:
         counts = counts.mean(axis=0)
     counts /= binSize
     t = bins[:-1]
     return counts,t
 
+def searchsorted_segments(values, order, segment_starts, segment_ends, targets, side='left'):
+    '''
+    np.searchsorted of many targets at once, each into its own sorted segment values[order[start:end]],
+    as a vectorized binary search over every target together. Only log2(longest segment) elements of each segment are read.
+
+    Parameters
+    ----------
+    values: array
+        Values being searched, eg spike times.
+    order: array
+        Index into values. values[order[start:end]] is sorted for every segment, eg spike_index.spike_order.
+    segment_starts, segment_ends: array
+        Start and end of each target's segment in order, broadcast against targets.
+    targets: array
+        Values to find.
+    side: str, optional, default = 'left'
+        As for np.searchsorted.
+
+    Returns
+    ----------
+    positions: array
+        Insertion position of each target in order (not relative to its segment start), shape of targets.
+    '''
+    lo, hi, targets = np.broadcast_arrays(segment_starts, segment_ends, targets)
+    index_dtype = np.int32 if order.size < 2**31 else np.int64
+    lo = lo.astype(index_dtype)
+    hi = hi.astype(index_dtype)
+    if lo.size == 0 or order.size == 0:
+        return lo
+    for step in range(int(np.max(hi - lo)).bit_length()):
+        mid = (lo + hi) >> 1
+        found = values[order[np.minimum(mid, order.size-1)]]
+        go_right = (found < targets) if side == 'left' else (found <= targets)
+        searching = lo < hi
+        lo = np.where(searching & go_right, mid + 1, lo)
+        hi = np.where(searching & ~go_right, mid, hi)
+    return lo
+
+def get_population_psth(spike_times, spike_index, cluster_ids, startTimes, windowDur, binSize=0.01):
+    '''
+    Trial by trial PSTHs for many clusters against the same trial start times in one pass, without a loop over clusters.
+    The edges of every (cluster, trial) window are found in the cluster's run of spike_index.spike_order with one
+    vectorized binary search over every window (see searchsorted_segments()), so past the search only the spikes inside
+    the windows are read.
+    These spikes are binned for every cluster and trial with a single np.bincount over (cluster, trial, bin).
+    Gives the same counts as getPSTH on each cluster's spikes.
+
+    Parameters
+    ----------
+    spike_times: array
+        Time (s) of every spike of the probe, in the same order as the spikes in spike_index.
+    spike_index: SpikeIndex
+        Spike-by-cluster index for the probe.
+    cluster_ids: list
+        Clusters to compute PSTHs for.
+    startTimes: array
+        Window start time (s) of each trial.
+    windowDur: float
+        Window duration (s).
+    binSize: float, optional, default = 0.01
+        Bin size (s).
+
+    Returns
+    ----------
+    counts: array
+        Firing rate (spikes/s) with shape (n_clusters, n_trials, n_bins).
+    t: array
+        Start time of each bin relative to the window start.
+    '''
+    spike_times = np.asarray(spike_times).reshape(-1)
+    startTimes = np.asarray(startTimes).reshape(-1)
+    bins = np.arange(0,windowDur+binSize,binSize)
+    n_bins = bins.size-1
+    n_clusters = len(cluster_ids)
+    n_trials = startTimes.size
+
+    # spike_order is in file order within each cluster, sort it by time within each cluster if the spikes aren't
+    order = spike_index.spike_order
+    if np.any(spike_times[1:] < spike_times[:-1]):
+        cluster_of_spike = np.repeat(np.arange(spike_index.counts.size), spike_index.counts)
+        order = order[np.lexsort((spike_times[order], cluster_of_spike))]
+
+    cluster_ids = np.asarray(cluster_ids, dtype=np.int64).reshape(-1)
+    in_range = (cluster_ids >= 0) & (cluster_ids < spike_index.counts.size)
+    safe_ids = np.where(in_range, cluster_ids, 0)
+    segment_starts = spike_index.offsets[safe_ids][:, np.newaxis]
+    segment_ends = np.where(in_range, spike_index.offsets[safe_ids+1], spike_index.offsets[safe_ids])[:, np.newaxis]
+    window_first = searchsorted_segments(spike_times, order, segment_starts, segment_ends, startTimes[np.newaxis, :], side='left')
+    window_last = searchsorted_segments(spike_times, order, segment_starts, segment_ends, startTimes[np.newaxis, :]+windowDur, side='right')
+
+    # gather the spikes in every (cluster, trial) window and bin them all at once
+    n_in_window = np.maximum(window_last - window_first, 0).reshape(-1)
+    window = np.repeat(np.arange(n_in_window.size), n_in_window)
+    window_offsets = np.cumsum(n_in_window) - n_in_window
+    spike_idx = np.arange(window.size) - np.repeat(window_offsets, n_in_window) + np.repeat(window_first.reshape(-1), n_in_window)
+
+    relative_times = spike_times[order[spike_idx]] - startTimes[window % max(n_trials, 1)]
+    bin_idx = np.searchsorted(bins, relative_times, side='right') - 1
+    bin_idx[relative_times == bins[-1]] = n_bins - 1
+    in_bins = (bin_idx >= 0) & (bin_idx < n_bins)
+    counts = np.bincount(window[in_bins]*n_bins + bin_idx[in_bins], minlength=n_clusters*n_trials*n_bins)
+    counts = counts.reshape(n_clusters, n_trials, n_bins).astype(float)
+    counts /= binSize
+    return counts, bins[:-1]
+
 def get_sync_line_data(syncDataset, line_label=None, channel=None):
     ''' Get rising and falling edge times for a particular line from the sync h5 file
 
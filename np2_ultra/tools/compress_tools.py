@@ -0,0 +1,329 @@
+import os
+import json
+import zlib
+import hashlib
+import struct
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from np2_ultra.tools.file_tools import RawRecording
+
+'''
+Lossless chunked compression for int16 probe data (continuous.dat -> continuous.cdat).
+
+File layout:
+    8 byte magic, uint64 header length, JSON header,
+    compressed chunks,
+    chunk offset index (uint64, n_chunks + 1 entries), uint64 position of the index.
+
+Each chunk holds chunk_samples samples of every channel. Samples are delta encoded along time per channel
+(wrapping int16 arithmetic, so decoding is exact), split into low and high byte planes, and compressed with zlib.
+'''
+
+MAGIC = b'NP2CDAT1'
+COMPRESSED_SUFFIX = '.cdat'
+
+
+def encode_chunk(chunk, level=1):
+    """
+    Compress one chunk of int16 data.
+
+    Parameters
+    ----------
+    chunk: array
+        int16 data with shape (n_samples, n_channels).
+    level: int, optional, default = 1
+        zlib compression level.
+
+    Returns
+    ----------
+    encoded: bytes
+    """
+    chunk = np.ascontiguousarray(chunk, dtype=np.int16)
+    delta = np.empty(chunk.shape, dtype=np.int16)
+    delta[:1] = chunk[:1]
+    np.subtract(chunk[1:], chunk[:-1], out=delta[1:])
+    byte_planes = np.ascontiguousarray(delta.T).view(np.uint8).reshape(-1, 2).T
+    return zlib.compress(byte_planes.tobytes(), level)
+
+def decode_chunk(encoded, n_samples, n_channels):
+    """
+    Decompress one chunk written by encode_chunk().
+
+    Parameters
+    ----------
+    encoded: bytes
+    n_samples: int
+        Number of samples in the chunk.
+    n_channels: int
+        Number of channels in the chunk.
+
+    Returns
+    ----------
+    chunk: array
+        int16 data with shape (n_samples, n_channels).
+    """
+    byte_planes = np.frombuffer(zlib.decompress(encoded), dtype=np.uint8).reshape(2, -1)
+    delta = np.empty((n_channels, n_samples), dtype=np.int16)
+    delta_bytes = delta.reshape(-1).view(np.uint8)
+    delta_bytes[0::2] = byte_planes[0]
+    delta_bytes[1::2] = byte_planes[1]
+    np.cumsum(delta, axis=1, dtype=np.int16, out=delta)
+    return delta.T
+
+def compress_file(raw_data_file, compressed_file=None, n_channels=384, chunk_samples=3000, level=1, n_threads=4):
+    """
+    Compress a continuous.dat file into the chunked format.
+
+    Parameters
+    ----------
+    raw_data_file: path
+        Path to the continuous.dat file.
+    compressed_file: path, optional, default = None
+        Output path. Default is the same path with a .cdat suffix.
+    n_channels: int, optional, default = 384
+        Number of channels interleaved in the file.
+    chunk_samples: int, optional, default = 3000
+        Samples per chunk. Smaller chunks make random access cheaper, larger chunks compress slightly better.
+    level: int, optional, default = 1
+        zlib compression level.
+    n_threads: int, optional, default = 4
+        Number of chunks compressed at the same time.
+
+    Returns
+    ----------
+    compressed_file: path
+    """
+    if compressed_file is None:
+        compressed_file = os.path.splitext(raw_data_file)[0] + COMPRESSED_SUFFIX
+    raw_data = np.memmap(raw_data_file, dtype='int16', mode='r')
+    n_samples = int(raw_data.size/n_channels)
+    raw_data = np.reshape(raw_data[:n_samples*n_channels], (n_samples, n_channels))
+
+    header = json.dumps({'n_channels': n_channels,
+                        'n_samples': n_samples,
+                        'chunk_samples': chunk_samples,
+                        'dtype': 'int16',
+                        'codec': 'delta-byteplane-zlib',
+                        'source_size': os.path.getsize(raw_data_file)}).encode()
+    chunk_starts = range(0, n_samples, chunk_samples)
+    offsets = []
+    with open(compressed_file, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            # submit a bounded window of chunks at a time so memory stays flat
+            window = 4*n_threads
+            for w in range(0, len(chunk_starts), window):
+                starts = chunk_starts[w:w+window]
+                futures = [executor.submit(encode_chunk, raw_data[s:s+chunk_samples], level) for s in starts]
+                for future in futures:
+                    offsets.append(f.tell())
+                    f.write(future.result())
+        offsets.append(f.tell())
+        index_position = f.tell()
+        f.write(np.asarray(offsets, dtype='<u8').tobytes())
+        f.write(struct.pack('<Q', index_position))
+    return compressed_file
+
+def decompress_file(compressed_file, raw_data_file=None, n_threads=4):
+    """
+    Decompress a .cdat file back into a continuous.dat file.
+
+    Parameters
+    ----------
+    compressed_file: path
+        Path to the .cdat file.
+    raw_data_file: path, optional, default = None
+        Output path. Default is the same path with a .dat suffix.
+    n_threads: int, optional, default = 4
+        Number of chunks decompressed at the same time.
+
+    Returns
+    ----------
+    raw_data_file: path
+    """
+    if raw_data_file is None:
+        raw_data_file = os.path.splitext(compressed_file)[0] + '.dat'
+    recording = CompressedRecording(compressed_file, cache_chunks=0)
+    chunk_nums = range(recording.n_chunks)
+    with open(raw_data_file, 'wb') as f:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            window = 4*n_threads
+            for w in range(0, len(chunk_nums), window):
+                futures = [executor.submit(decode_chunk, recording.read_encoded(c), recording.chunk_length(c), recording.n_channels)
+                           for c in chunk_nums[w:w+window]]
+                for future in futures:
+                    f.write(future.result().tobytes())
+    recording.close()
+    return raw_data_file
+
+
+def verify_compressed_file(compressed_file, raw_data_file, n_threads=4, buffer_chunks=16):
+    """
+    Check that a .cdat file decodes to exactly the bytes of a continuous.dat file, without writing the decoded data out.
+    Chunks are decoded in order on a thread pool while the raw file is read alongside them, and both streams are
+    hashed with SHA-1. The raw file must hold nothing past the samples in the .cdat file.
+
+    Parameters
+    ----------
+    compressed_file: path
+        Path to the .cdat file.
+    raw_data_file: path
+        Path to the continuous.dat file it should match.
+    n_threads: int, optional, default = 4
+        Number of chunks decoded at the same time.
+    buffer_chunks: int, optional, default = 16
+        Chunks hashed per read of the raw file.
+
+    Returns
+    ----------
+    matches: bool
+        True if the sizes and hashes of the decoded data and the raw file are the same.
+    """
+    recording = CompressedRecording(compressed_file, cache_chunks=0)
+    expected_size = recording.n_samples*recording.n_channels*recording.dtype.itemsize
+    if os.path.getsize(raw_data_file) != expected_size:
+        recording.close()
+        return False
+    decoded_hash = hashlib.sha1()
+    raw_hash = hashlib.sha1()
+    chunk_nums = range(recording.n_chunks)
+    with open(raw_data_file, 'rb') as raw:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for w in range(0, len(chunk_nums), buffer_chunks):
+                futures = [executor.submit(decode_chunk, recording.read_encoded(c), recording.chunk_length(c), recording.n_channels)
+                           for c in chunk_nums[w:w+buffer_chunks]]
+                n_bytes = 0
+                for future in futures:
+                    chunk = np.ascontiguousarray(future.result())
+                    decoded_hash.update(chunk)
+                    n_bytes += chunk.nbytes
+                raw_hash.update(raw.read(n_bytes))
+    recording.close()
+    return decoded_hash.digest() == raw_hash.digest()
+
+class CompressedRecording(RawRecording):
+    """
+    Random-access reader for a .cdat file that behaves like a RawRecording and its (n_samples, n_channels) memmap.
+    Only the chunks touched by a read are decoded, and recently decoded chunks are kept in a small cache.
+    Indexing supports slices and integer arrays of sample indices, eg recording[t0:t1, channels] or recording[sample_idx].
+
+    Methods
+    ----------
+    read_chunk(chunk_num)
+    close()
+    time_slice(t0, t1, channels=slice(None))
+    to_microvolts(raw)
+    """
+    def __init__(self, compressed_file, sample_rate=30000., gain_factor=0.19499999284744262695, cache_chunks=16):
+        """
+        Parameters
+        ----------
+        compressed_file: path
+            Path to the .cdat file.
+        sample_rate: float, optional, default = 30000.
+            Sample rate in Hz.
+        gain_factor: float, optional, default = 0.195
+            Microvolts per bit.
+        cache_chunks: int, optional, default = 16
+            Number of decoded chunks to keep in memory.
+        """
+        self.compressed_file = compressed_file
+        self.raw_data_file = compressed_file
+        self.sample_rate = float(sample_rate)
+        self.gain_factor = float(gain_factor)
+        self.cache_chunks = cache_chunks
+        self.cache = OrderedDict()
+
+        with open(compressed_file, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{} is not a compressed probe data file".format(compressed_file))
+            header_len = struct.unpack('<Q', f.read(8))[0]
+            self.header = json.loads(f.read(header_len).decode())
+            f.seek(-8, os.SEEK_END)
+            index_position = struct.unpack('<Q', f.read(8))[0]
+            f.seek(index_position)
+            self.chunk_offsets = np.frombuffer(f.read(), dtype='<u8')[:-1]
+
+        self.n_channels = self.header['n_channels']
+        self.n_samples = self.header['n_samples']
+        self.chunk_samples = self.header['chunk_samples']
+        self.n_chunks = self.chunk_offsets.size - 1
+        self.duration = self.n_samples / self.sample_rate
+        self.shape = (self.n_samples, self.n_channels)
+        self.dtype = np.dtype(self.header['dtype'])
+        self.data = self
+        self.file = open(compressed_file, 'rb')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['file'] = None
+        state['cache'] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = self
+        self.file = open(self.compressed_file, 'rb')
+
+    def read_chunk(self, chunk_num):
+        """
+        Decode one chunk, using the cache if it was decoded recently.
+
+        Parameters
+        ----------
+        chunk_num: int
+
+        Returns
+        ----------
+        chunk: array
+            int16 data with shape (chunk samples, n_channels).
+        """
+        if chunk_num in self.cache:
+            self.cache.move_to_end(chunk_num)
+            return self.cache[chunk_num]
+        chunk = decode_chunk(self.read_encoded(chunk_num), self.chunk_length(chunk_num), self.n_channels)
+        self.cache[chunk_num] = chunk
+        if len(self.cache) > self.cache_chunks:
+            self.cache.popitem(last=False)
+        return chunk
+
+    def read_encoded(self, chunk_num):
+        self.file.seek(int(self.chunk_offsets[chunk_num]))
+        return self.file.read(int(self.chunk_offsets[chunk_num+1] - self.chunk_offsets[chunk_num]))
+
+    def chunk_length(self, chunk_num):
+        return min(self.chunk_samples, self.n_samples - chunk_num*self.chunk_samples)
+
+    def close(self):
+        self.file.close()
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            rows, cols = key[0], key[1:]
+        else:
+            rows, cols = key, ()
+
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(self.n_samples)
+            if stop <= start:
+                decoded = np.zeros((0, self.n_channels), dtype=self.dtype)
+            else:
+                chunks = range(start // self.chunk_samples, (stop-1) // self.chunk_samples + 1)
+                decoded = np.concatenate([self.read_chunk(c) for c in chunks])
+                first = chunks[0]*self.chunk_samples
+                decoded = decoded[start-first:stop-first:step]
+            return decoded[(slice(None),) + cols]
+
+        rows = np.asarray(rows)
+        rows = np.where(rows < 0, rows + self.n_samples, rows)
+        if np.any((rows < 0) | (rows >= self.n_samples)):
+            raise IndexError("sample index out of range for {} samples".format(self.n_samples))
+        chunk_nums = np.unique(rows // self.chunk_samples)
+        decoded = np.concatenate([self.read_chunk(c) for c in chunk_nums])
+        position = np.searchsorted(chunk_nums, rows // self.chunk_samples)*self.chunk_samples + rows % self.chunk_samples
+        return decoded[(position,) + cols]
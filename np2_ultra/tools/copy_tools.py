@@ -0,0 +1,1246 @@
+import os
+import json
+import time
+import heapq
+import queue
+import shutil
+import fnmatch
+import hashlib
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_PRIORITIES = {'ephys': 0, 'sync': 1, 'opto': 2, 'params': 3, 'images': 4, 'videos': 5}
+
+
+def as_list(dst):
+    """
+    Destinations can be given as one path or a list of paths.
+    """
+    return [dst] if isinstance(dst, str) else list(dst)
+
+
+class CopyEngine():
+    """
+    Multi-threaded file copier for moving session data over the network.
+    Every file is split into chunks of chunk_size bytes, and chunks from all of the files in a batch are copied at the
+    same time by a pool of threads, each with its own file handles and a large buffer. Small files are a single chunk,
+    so a batch of small files is copied file-parallel and a single large continuous.dat is copied chunk-parallel.
+    Keeps running totals so aggregate throughput can be reported.
+    With a TransferManifest, every chunk is hashed as it is copied and recorded, so interrupted copies resume
+    from the chunks that are missing and completed files are skipped.
+    Any destination can be a list of paths: the source is read once and every block is handed to one writer thread per
+    destination through its own queue, so a slow destination only holds up the others once its queue is full.
+    Reads can be capped at a total rate across all threads, to leave bandwidth for the acquisition computers.
+
+    Methods
+    ----------
+    copy(src, dst)
+    copytree(src, dst)
+    copytrees(pairs, resume=False)
+    plan_trees(pairs, resume=False)
+    copy_files(pairs, copy_stat=True)
+    prepare_files(pairs)
+    finish_file(src, dst, copy_stat=True)
+    copy_chunk(src, dsts, chunk_num)
+    copy_range(src, dsts, offset, length)
+    manifest_for(dst)
+    report()
+    """
+    def __init__(self, n_threads=8, buffer_size=16*2**20, chunk_size=256*2**20, manifest=None, queue_blocks=4, max_bytes_per_second=None):
+        """
+        Parameters
+        ----------
+        n_threads: int, optional, default = 8
+            Number of chunks copied at the same time.
+        buffer_size: int, optional, default = 16 MB
+            Bytes per read and write call.
+        chunk_size: int, optional, default = 256 MB
+            Files larger than this are split into chunks of this many bytes that are copied in parallel.
+        manifest: TransferManifest or list, optional, default = None
+            Record and resume copies with this manifest. With several destination folders, pass one manifest per folder;
+            each destination file is recorded in the manifest whose folder contains it.
+        queue_blocks: int, optional, default = 4
+            Blocks of buffer_size bytes each destination's writer can fall behind the reader when copying to several destinations.
+        max_bytes_per_second: float, optional, default = None
+            Cap on the total read rate of all threads. None is uncapped.
+        """
+        self.n_threads = n_threads
+        self.buffer_size = buffer_size
+        self.chunk_size = chunk_size
+        if manifest is None:
+            self.manifests = []
+        elif isinstance(manifest, TransferManifest):
+            self.manifests = [manifest]
+        else:
+            self.manifests = list(manifest)
+        self.queue_blocks = queue_blocks
+        self.limiter = BandwidthLimiter(max_bytes_per_second) if max_bytes_per_second else None
+        self.lock = threading.Lock()
+        self.bytes_read = 0
+        self.bytes_copied = 0
+        self.files_copied = 0
+        self.files_skipped = 0
+        self.seconds = 0.
+
+    def manifest_for(self, dst):
+        """
+        Returns
+        ----------
+        manifest: TransferManifest
+            The manifest whose folder contains dst, or None.
+        """
+        dst = os.path.abspath(dst)
+        for manifest in self.manifests:
+            if dst.startswith(manifest.root + os.sep):
+                return manifest
+        return None
+
+    def copy_range(self, src, dsts, offset, length):
+        """
+        Copy length bytes starting at offset from src into the same place in every destination, which must already exist.
+        The source is read once. With more than one destination each gets its own writer thread and queue.
+
+        Returns
+        ----------
+        digest: str
+            SHA-1 hex digest of the bytes copied.
+        """
+        dsts = as_list(dsts)
+        chunk_hash = hashlib.sha1()
+        writers = []
+        errors = []
+
+        def write_blocks(f, blocks):
+            try:
+                while True:
+                    block = blocks.get()
+                    if block is None:
+                        return
+                    f.write(block)
+            except Exception as e:
+                errors.append(e)
+                # keep draining so the reader never blocks on a failed destination
+                while blocks.get() is not None:
+                    pass
+
+        outputs = [open(dst, 'r+b', buffering=0) for dst in dsts]
+        try:
+            for fout in outputs:
+                fout.seek(offset)
+            if len(outputs) > 1:
+                for fout in outputs:
+                    blocks = queue.Queue(maxsize=self.queue_blocks)
+                    writer = threading.Thread(target=write_blocks, args=(fout, blocks))
+                    writer.start()
+                    writers.append((writer, blocks))
+            with open(src, 'rb', buffering=0) as fin:
+                fin.seek(offset)
+                remaining = length
+                try:
+                    while remaining > 0:
+                        block = fin.read(min(self.buffer_size, remaining))
+                        if len(block) == 0:
+                            raise IOError("{} ended {} bytes early".format(src, remaining))
+                        if self.limiter is not None:
+                            self.limiter.consume(len(block))
+                        if len(writers) == 0:
+                            outputs[0].write(block)
+                        for writer, blocks in writers:
+                            blocks.put(block)
+                        chunk_hash.update(block)
+                        remaining -= len(block)
+                finally:
+                    for writer, blocks in writers:
+                        blocks.put(None)
+                    for writer, blocks in writers:
+                        writer.join()
+        finally:
+            for fout in outputs:
+                fout.close()
+        if len(errors) > 0:
+            raise errors[0]
+        with self.lock:
+            self.bytes_read += length
+            self.bytes_copied += length*len(dsts)
+        return chunk_hash.hexdigest()
+
+    def copy_chunk(self, src, dsts, chunk_num):
+        """
+        Copy chunk number chunk_num of src into every destination and record its hash in their manifests.
+        """
+        offset = chunk_num*self.chunk_size
+        digest = self.copy_range(src, dsts, offset, min(self.chunk_size, os.path.getsize(src) - offset))
+        for dst in as_list(dsts):
+            manifest = self.manifest_for(dst)
+            if manifest is not None:
+                manifest.finish_chunk(dst, chunk_num, digest)
+
+    def prepare_files(self, pairs):
+        """
+        Check the manifests and size the destination files of a batch, without copying anything.
+        New and restarted files are registered in their manifests, and the manifests saved, before their destinations are sized.
+
+        Parameters
+        ----------
+        pairs: list
+            (source file, destination file) tuples, the destination being a path or a list of paths.
+
+        Returns
+        ----------
+        plans: list
+            (source, destinations to finish, {chunk number: destinations needing it}) for every source with work left.
+            Destinations the manifest shows are complete are left out.
+        """
+        plans = []
+        to_size = []
+        for src, dst in pairs:
+            size = os.path.getsize(src)
+            n_chunks = -(-size // self.chunk_size)
+            to_finish = []
+            chunk_dsts = {}
+            for d in as_list(dst):
+                manifest = self.manifest_for(d)
+                if manifest is None:
+                    chunks, resume = range(n_chunks), False
+                else:
+                    chunks, resume = manifest.start_file(src, d, self.chunk_size)
+                    if manifest.is_complete(d):
+                        self.files_skipped += 1
+                        continue
+                if resume == False:
+                    to_size.append((d, size))
+                to_finish.append(d)
+                for c in chunks:
+                    chunk_dsts.setdefault(c, []).append(d)
+            if len(to_finish) > 0:
+                plans.append((src, to_finish, chunk_dsts))
+        # the manifests list every file as incomplete before any destination is created or truncated,
+        # so a copy killed at any point never leaves a full-size placeholder the manifest doesn't know about
+        if len(to_size) > 0:
+            for manifest in self.manifests:
+                manifest.save()
+        for d, size in to_size:
+            with open(d, 'wb') as f:
+                f.truncate(size)
+        return plans
+
+    def finish_file(self, src, dst, copy_stat=True):
+        """
+        Copy file metadata once every chunk of dst has been written, and mark it complete in its manifest.
+        """
+        if copy_stat:
+            shutil.copystat(src, dst)
+        else:
+            shutil.copymode(src, dst)
+        manifest = self.manifest_for(dst)
+        if manifest is not None:
+            manifest.finish_file(dst)
+        with self.lock:
+            self.files_copied += 1
+
+    def copy_files(self, pairs, copy_stat=True):
+        """
+        Copy a batch of files in parallel.
+
+        Parameters
+        ----------
+        pairs: list
+            (source file, destination file) tuples, the destination being a path or a list of paths.
+            Destination folders must exist. Existing destination files are overwritten, unless the manifest shows they are
+            complete (skipped) or partly copied from the same source (resumed). Completion is tracked per destination.
+        copy_stat: bool, optional, default = True
+            Copy modification times and permissions as well (like shutil.copy2). False only copies permissions (like shutil.copy).
+
+        Returns
+        ----------
+        destinations: list
+            The destinations, as passed in.
+        """
+        start = time.time()
+        try:
+            plans = self.prepare_files(pairs)
+            with ThreadPoolExecutor(max_workers=self.n_threads) as executor:
+                futures = []
+                for src, to_finish, chunk_dsts in plans:
+                    futures.extend([executor.submit(self.copy_chunk, src, chunk_dsts[c], c) for c in sorted(chunk_dsts)])
+                for future in futures:
+                    future.result()
+            for src, to_finish, chunk_dsts in plans:
+                for d in to_finish:
+                    self.finish_file(src, d, copy_stat)
+        finally:
+            for manifest in self.manifests:
+                manifest.save()
+        self.seconds += time.time() - start
+        return [dst for src, dst in pairs]
+
+    def copy(self, src, dst):
+        """
+        Parallel version of shutil.copy for one file. dst can be a folder, or a list of files or folders.
+
+        Returns
+        ----------
+        dst: path or list
+            The destination file(s).
+        """
+        dsts = [os.path.join(d, os.path.basename(src)) if os.path.isdir(d) else d for d in as_list(dst)]
+        if isinstance(dst, str):
+            dsts = dsts[0]
+        return self.copy_files([(src, dsts)], copy_stat=False)[0]
+
+    def plan_trees(self, pairs, resume=False):
+        """
+        Make the destination folders for copytrees() and list the files to copy.
+
+        Returns
+        ----------
+        file_pairs: list
+            (source file, [destination files]) tuples.
+        dir_pairs: list
+            (source folder, destination folder) tuples, for copying folder metadata once the files are in.
+        """
+        file_pairs = []
+        dir_pairs = []
+        for src, dst in pairs:
+            dsts = as_list(dst)
+            for d in dsts:
+                if os.path.exists(d) and resume==False:
+                    raise FileExistsError("{} already exists".format(d))
+            for root, dirs, file_names in os.walk(src):
+                dst_roots = [os.path.join(d, os.path.relpath(root, src)) for d in dsts]
+                for dst_root in dst_roots:
+                    os.makedirs(dst_root, exist_ok=resume)
+                    dir_pairs.append((root, dst_root))
+                file_pairs.extend([(os.path.join(root, f), [os.path.join(r, f) for r in dst_roots]) for f in file_names])
+        return file_pairs, dir_pairs
+
+    def copytrees(self, pairs, resume=False):
+        """
+        Parallel version of shutil.copytree for several folders at once, all files sharing one pool of threads.
+
+        Parameters
+        ----------
+        pairs: list
+            (source folder, destination folder) tuples, the destination being a path or a list of paths.
+            Destination folders must not exist yet.
+        resume: bool, optional, default = False
+            Allow destination folders to exist already, to finish an interrupted copy recorded in the manifest.
+
+        Returns
+        ----------
+        destinations: list
+            The destination folders, as passed in.
+        """
+        file_pairs, dir_pairs = self.plan_trees(pairs, resume)
+        self.copy_files(file_pairs, copy_stat=True)
+        for src, dst in dir_pairs:
+            shutil.copystat(src, dst)
+        return [dst for src, dst in pairs]
+
+    def copytree(self, src, dst):
+        """
+        Parallel version of shutil.copytree. dst must not exist yet.
+        """
+        return self.copytrees([(src, dst)])[0]
+
+    def report(self):
+        """
+        Print the files, bytes and aggregate throughput copied so far.
+        """
+        rate = self.bytes_copied / self.seconds / 1e6 if self.seconds > 0 else 0.
+        print("Copied {} files, {:.2f} GB in {:.0f} s ({:.0f} MB/s)".format(self.files_copied, self.bytes_copied/1e9, self.seconds, rate))
+        if self.bytes_copied > self.bytes_read:
+            print("Read {:.2f} GB from the source for {:.2f} GB written".format(self.bytes_read/1e9, self.bytes_copied/1e9))
+        if self.files_skipped > 0:
+            print("Skipped {} files already copied according to the manifest".format(self.files_skipped))
+
+
+class BandwidthLimiter():
+    """
+    Token bucket shared by all copy threads. consume() sleeps as needed to hold the average rate at bytes_per_second,
+    allowing bursts of up to one second's worth of bytes.
+    """
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = float(bytes_per_second)
+        self.lock = threading.Lock()
+        self.tokens = self.bytes_per_second
+        self.last = time.time()
+
+    def consume(self, n_bytes):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.bytes_per_second, self.tokens + (now - self.last)*self.bytes_per_second)
+            self.last = now
+            self.tokens -= n_bytes
+            wait = -self.tokens / self.bytes_per_second if self.tokens < 0 else 0.
+        if wait > 0:
+            time.sleep(wait)
+
+
+class TransferScheduler():
+    """
+    Priority queue of copy batches for one CopyEngine. Batches are added by category (eg 'ephys', 'videos'), and run()
+    copies the chunks of all batches with a shared pool of threads, always starting the chunk of the highest priority
+    (lowest number) category next, so large low priority files only use threads the high priority data doesn't need.
+    Batches can belong to a recording. Once every batch of a recording in the ready categories has landed, the
+    recording is put on the ready queue and passed to the on_ready callbacks, so processing can start before the
+    rest of the session has been copied.
+
+    Methods
+    ----------
+    add(category, pairs, recording=None, copy_stat=False, dir_pairs=(), message=None)
+    expect(recording)
+    run()
+    """
+    def __init__(self, copier, priorities=None, ready_categories=('ephys', 'sync'), on_ready=None):
+        """
+        Parameters
+        ----------
+        copier: CopyEngine
+        priorities: dict, optional, default = None
+            Category: priority, lower first. Updates DEFAULT_PRIORITIES. Unknown categories go last.
+        ready_categories: tuple, optional, default = ('ephys', 'sync')
+            Categories that must have landed before a recording is ready.
+        on_ready: function, optional, default = None
+            Called with the recording name when it is ready, from a copy thread.
+        """
+        self.copier = copier
+        self.priorities = dict(DEFAULT_PRIORITIES)
+        if priorities is not None:
+            self.priorities.update(priorities)
+        self.ready_categories = ready_categories
+        self.on_ready = [] if on_ready is None else [on_ready]
+        self.ready = queue.Queue()
+        self.batches = []
+        self.waiting = {}
+        self.announced = set()
+        self.lock = threading.Lock()
+
+    def add(self, category, pairs, recording=None, copy_stat=False, dir_pairs=(), message=None):
+        """
+        Queue a batch of files to copy.
+
+        Parameters
+        ----------
+        category: str
+            Key in priorities.
+        pairs: list
+            (source file, destination file or files) tuples, as for CopyEngine.copy_files().
+        recording: str, optional, default = None
+            Recording the batch belongs to, for the ready queue.
+        copy_stat: bool, optional, default = False
+            Copy file modification times as well as permissions.
+        dir_pairs: list, optional, default = ()
+            (source folder, destination folder) tuples whose metadata is copied once the batch is done.
+        message: str, optional, default = None
+            Printed once the batch is done.
+        """
+        self.batches.append({'category': category,
+                            'priority': self.priorities.get(category, max(self.priorities.values()) + 1),
+                            'pairs': list(pairs),
+                            'recording': recording,
+                            'copy_stat': copy_stat,
+                            'dir_pairs': list(dir_pairs),
+                            'message': message})
+        if recording is not None:
+            self.waiting[recording] = self.waiting.get(recording, 0) + (1 if category in self.ready_categories else 0)
+
+    def expect(self, recording):
+        """
+        Register a recording that may have nothing left to copy, so the next run() still puts it on the ready queue.
+        """
+        self.waiting.setdefault(recording, 0)
+
+    def announce(self, recording):
+        with self.lock:
+            ready = self.waiting[recording] == 0 and recording not in self.announced
+            if ready:
+                self.announced.add(recording)
+        if ready:
+            self.ready.put(recording)
+            for callback in self.on_ready:
+                callback(recording)
+
+    def batch_done(self, batch):
+        for src, dst in batch['dir_pairs']:
+            shutil.copystat(src, dst)
+        if batch['message'] is not None:
+            with self.lock:
+                print(batch['message'])
+        recording = batch['recording']
+        if recording is None or batch['category'] not in self.ready_categories:
+            return
+        with self.lock:
+            self.waiting[recording] -= 1
+        self.announce(recording)
+
+    def run(self):
+        """
+        Copy every queued batch, highest priority first, and empty the queue.
+        """
+        start = time.time()
+        batches, self.batches = sorted(self.batches, key=lambda b: b['priority']), []
+        heap = []
+        files_left = {}
+        chunks_left = {}
+        errors = []
+        try:
+            for b, batch in enumerate(batches):
+                # every batch is sized before any bytes are copied; prepare_files() saves the manifests first,
+                # so placeholders left by an interruption are recorded as incomplete and copied again on the next run
+                plans = self.copier.prepare_files(batch['pairs'])
+                files_left[b] = len(plans)
+                for f, (src, to_finish, chunk_dsts) in enumerate(plans):
+                    chunks_left[(b, f)] = [len(chunk_dsts), src, to_finish]
+                    for c in sorted(chunk_dsts):
+                        heapq.heappush(heap, (batch['priority'], b, f, c, src, chunk_dsts[c]))
+            # batches with nothing left to copy are done straight away
+            for b, batch in enumerate(batches):
+                if files_left[b] == 0:
+                    self.batch_done(batch)
+            # recordings whose ephys and sync landed in an earlier run only have lower priority files queued
+            for recording in list(self.waiting.keys()):
+                self.announce(recording)
+            for (b, f), (n_chunks, src, to_finish) in list(chunks_left.items()):
+                if n_chunks == 0:
+                    heapq.heappush(heap, (batches[b]['priority'], b, f, -1, src, []))
+
+            def work():
+                while True:
+                    with self.lock:
+                        if len(heap) == 0 or len(errors) > 0:
+                            return
+                        priority, b, f, c, src, dsts = heapq.heappop(heap)
+                    try:
+                        if c >= 0:
+                            self.copier.copy_chunk(src, dsts, c)
+                        with self.lock:
+                            chunks_left[(b, f)][0] -= 1
+                            file_done = chunks_left[(b, f)][0] <= 0
+                        if file_done:
+                            for d in chunks_left[(b, f)][2]:
+                                self.copier.finish_file(src, d, batches[b]['copy_stat'])
+                            with self.lock:
+                                files_left[b] -= 1
+                                batch_done = files_left[b] == 0
+                            if batch_done:
+                                self.batch_done(batches[b])
+                    except Exception as e:
+                        errors.append(e)
+                        return
+
+            workers = [threading.Thread(target=work) for n in range(self.copier.n_threads)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            for manifest in self.copier.manifests:
+                manifest.save()
+        self.copier.seconds += time.time() - start
+        if len(errors) > 0:
+            raise errors[0]
+
+
+class TailFollower():
+    """
+    Copy files that are still being written (eg continuous.dat during a recording) by repeatedly copying the bytes appended
+    since the last poll. Chunk hashes are computed while the bytes stream past, the same way CopyEngine does.
+    A file that hasn't grown for settle_seconds is finalized: its first head_bytes are copied again, since some writers
+    rewrite a header on close (the shape in an .npy header), its metadata is copied and its manifest entries are completed.
+    A finalized file that starts growing again is followed again. A file that shrinks is copied again from the start.
+
+    Methods
+    ----------
+    poll(pairs)
+    finalize(src)
+    follow_file(src, dsts)
+    """
+    def __init__(self, copier, settle_seconds=60., head_bytes=4096):
+        """
+        Parameters
+        ----------
+        copier: CopyEngine
+            Supplies the threads, buffer size, chunk size, bandwidth cap and manifests.
+        settle_seconds: float, optional, default = 60.
+            Seconds without growth before a file is finalized.
+        head_bytes: int, optional, default = 4096
+            Bytes at the start of each file that are checked again when it is finalized.
+        """
+        self.copier = copier
+        self.settle_seconds = settle_seconds
+        self.head_bytes = head_bytes
+        self.state = {}
+
+    def new_state(self, dsts):
+        for d in dsts:
+            with open(d, 'wb'):
+                pass
+        return {'dsts': dsts, 'offset': 0, 'digests': [], 'hasher': hashlib.sha1(), 'head': b'',
+                'last_growth': time.time(), 'final': False}
+
+    def follow_file(self, src, dsts):
+        """
+        Copy whatever has been appended to src since the last call.
+
+        Returns
+        ----------
+        n_bytes: int
+            Bytes copied.
+        """
+        dsts = as_list(dsts)
+        state = self.state.get(src)
+        size = os.path.getsize(src)
+        if state is None or size < state['offset']:
+            state = self.new_state(dsts)
+            self.state[src] = state
+            for d in dsts:
+                manifest = self.copier.manifest_for(d)
+                if manifest is not None:
+                    manifest.record_file(src, d, self.copier.chunk_size, None, complete=False)
+        if size == state['offset']:
+            return 0
+
+        chunk_size = self.copier.chunk_size
+        outputs = [open(d, 'r+b', buffering=0) for d in dsts]
+        try:
+            with open(src, 'rb', buffering=0) as fin:
+                fin.seek(state['offset'])
+                for fout in outputs:
+                    fout.seek(state['offset'])
+                remaining = size - state['offset']
+                while remaining > 0:
+                    block = fin.read(min(self.copier.buffer_size, remaining))
+                    if len(block) == 0:
+                        break
+                    if self.copier.limiter is not None:
+                        self.copier.limiter.consume(len(block))
+                    for fout in outputs:
+                        fout.write(block)
+                    if len(state['head']) < self.head_bytes:
+                        state['head'] += block[:self.head_bytes - len(state['head'])]
+                    # split the block at chunk boundaries so the digests match CopyEngine's
+                    position = 0
+                    while position < len(block):
+                        take = min(len(block) - position, chunk_size - state['offset'] % chunk_size)
+                        state['hasher'].update(block[position:position+take])
+                        position += take
+                        state['offset'] += take
+                        if state['offset'] % chunk_size == 0:
+                            state['digests'].append(state['hasher'].hexdigest())
+                            state['hasher'] = hashlib.sha1()
+                    remaining -= len(block)
+        finally:
+            for fout in outputs:
+                fout.close()
+        copied = size - remaining
+        state['last_growth'] = time.time()
+        state['final'] = False
+        with self.copier.lock:
+            self.copier.bytes_read += copied
+            self.copier.bytes_copied += copied*len(dsts)
+        return copied
+
+    def finalize(self, src):
+        """
+        Check the head of a followed file again, copy its metadata and complete its manifest entries.
+        """
+        state = self.state[src]
+        digests = list(state['digests'])
+        if state['offset'] % self.copier.chunk_size != 0:
+            digests.append(state['hasher'].hexdigest())
+        with open(src, 'rb') as f:
+            head = f.read(len(state['head']))
+        if head != state['head']:
+            for d in state['dsts']:
+                with open(d, 'r+b') as f:
+                    f.write(head)
+            state['head'] = head
+            chunk_hash = hashlib.sha1()
+            with open(state['dsts'][0], 'rb') as f:
+                chunk_hash.update(f.read(min(self.copier.chunk_size, state['offset'])))
+            digests[0] = chunk_hash.hexdigest()
+            if len(state['digests']) > 0:
+                state['digests'][0] = digests[0]
+            else:
+                state['hasher'] = chunk_hash.copy()
+        for d in state['dsts']:
+            shutil.copystat(src, d)
+            manifest = self.copier.manifest_for(d)
+            if manifest is not None:
+                manifest.record_file(src, d, self.copier.chunk_size, digests, complete=True)
+        state['final'] = True
+
+    def poll(self, pairs):
+        """
+        Follow every (source, destination or destinations) pair once, in parallel, and finalize files that have settled.
+
+        Returns
+        ----------
+        n_bytes: int
+            Bytes copied in this poll.
+        growing: int
+            Number of files that are not finalized yet.
+        """
+        with ThreadPoolExecutor(max_workers=self.copier.n_threads) as executor:
+            futures = [executor.submit(self.follow_file, src, dst) for src, dst in pairs]
+            n_bytes = sum([future.result() for future in futures])
+        now = time.time()
+        growing = 0
+        for src, dst in pairs:
+            state = self.state[src]
+            if state['final'] == False:
+                if now - state['last_growth'] >= self.settle_seconds and os.path.getsize(src) == state['offset']:
+                    self.finalize(src)
+                else:
+                    growing += 1
+        for manifest in self.copier.manifests:
+            manifest.save()
+        return n_bytes, growing
+
+
+class TransferManifest():
+    """
+    JSON record of files copied into a destination folder: source path, size and modification time, and the SHA-1 hash of
+    every chunk, computed while the chunk was copied. Paths are stored relative to the manifest's folder.
+    The manifest is saved every few seconds during a copy, so an interrupted copy can resume from the chunks that are missing,
+    and a destination can later be checked against the recorded hashes without reading the source again.
+
+    Methods
+    ----------
+    start_file(src, dst, chunk_size)
+    record_file(src, dst, chunk_size, chunk_hashes, complete)
+    is_complete(dst)
+    unfinished(paths)
+    finish_chunk(dst, chunk_num, digest)
+    finish_file(dst)
+    incomplete_files()
+    rename(old, new)
+    save()
+    verify(n_threads=8, buffer_size=16*2**20)
+    """
+    def __init__(self, manifest_file, save_interval=5.):
+        """
+        Parameters
+        ----------
+        manifest_file: path
+            The manifest JSON. It is read if it exists.
+        save_interval: float, optional, default = 5.
+            Minimum seconds between saves while chunks are being copied.
+        """
+        self.manifest_file = manifest_file
+        self.root = os.path.dirname(os.path.abspath(manifest_file))
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.last_save = time.time()
+        self.files = {}
+        if os.path.exists(manifest_file):
+            with open(manifest_file, 'r') as f:
+                self.files = json.load(f)['files']
+
+    def key(self, dst):
+        return os.path.relpath(os.path.abspath(dst), self.root).replace(os.sep, '/')
+
+    def start_file(self, src, dst, chunk_size):
+        """
+        Register a file about to be copied.
+
+        Returns
+        ----------
+        chunks: list
+            Chunk numbers still to copy. Empty if the file is already complete.
+        resume: bool
+            True if the destination already holds some of the chunks and should not be truncated.
+        """
+        src_stat = os.stat(src)
+        n_chunks = -(-src_stat.st_size // chunk_size)
+        with self.lock:
+            entry = self.files.get(self.key(dst))
+            same_source = entry is not None and entry['source'] == src and entry['size'] == src_stat.st_size and \
+                            entry['mtime'] == src_stat.st_mtime
+            if same_source and os.path.exists(dst) and os.path.getsize(dst) == src_stat.st_size:
+                if entry['complete']:
+                    return [], True
+                if entry['chunk_size'] == chunk_size:
+                    return [c for c, digest in enumerate(entry['chunk_hashes']) if digest is None], True
+            self.files[self.key(dst)] = {'source': src,
+                                        'size': src_stat.st_size,
+                                        'mtime': src_stat.st_mtime,
+                                        'chunk_size': chunk_size,
+                                        'chunk_hashes': [None]*n_chunks,
+                                        'hash': None,
+                                        'complete': False}
+        return list(range(n_chunks)), False
+
+    def record_file(self, src, dst, chunk_size, chunk_hashes, complete):
+        """
+        Write a whole entry for a file copied some other way (eg followed while it was growing), using the source's current size and mtime.
+        """
+        src_stat = os.stat(src)
+        n_chunks = -(-src_stat.st_size // chunk_size)
+        if chunk_hashes is None or len(chunk_hashes) != n_chunks:
+            chunk_hashes = [None]*n_chunks
+        with self.lock:
+            self.files[self.key(dst)] = {'source': src,
+                                        'size': src_stat.st_size,
+                                        'mtime': src_stat.st_mtime,
+                                        'chunk_size': chunk_size,
+                                        'chunk_hashes': list(chunk_hashes),
+                                        'hash': None,
+                                        'complete': False}
+        if complete:
+            self.finish_file(dst)
+
+    def is_complete(self, dst):
+        entry = self.files.get(self.key(dst))
+        return entry is not None and entry['complete']
+
+    def unfinished(self, paths):
+        """
+        Returns
+        ----------
+        unfinished: list
+            The paths without a complete entry, ie files that were never recorded as copied or whose copy was interrupted.
+        """
+        return [path for path in paths if self.is_complete(path) == False]
+
+    def finish_chunk(self, dst, chunk_num, digest):
+        with self.lock:
+            self.files[self.key(dst)]['chunk_hashes'][chunk_num] = digest
+            save = time.time() - self.last_save > self.save_interval
+        if save:
+            self.save()
+
+    def finish_file(self, dst):
+        """
+        Mark a file complete once every chunk has a hash. The file hash is the SHA-1 of its chunk hashes.
+        """
+        with self.lock:
+            entry = self.files[self.key(dst)]
+            if any(digest is None for digest in entry['chunk_hashes']):
+                raise IOError("{} is missing chunks".format(dst))
+            entry['hash'] = hashlib.sha1(''.join(entry['chunk_hashes']).encode()).hexdigest()
+            entry['complete'] = True
+
+    def incomplete_files(self):
+        """
+        Returns
+        ----------
+        incomplete: list
+            Files in the manifest (relative paths) that were started but not finished.
+        """
+        return [k for k, entry in self.files.items() if entry['complete'] == False]
+
+    def rename(self, old, new):
+        """
+        Update the entries under a file or folder that was renamed at the destination.
+        """
+        old_key, new_key = self.key(old), self.key(new)
+        if old_key == new_key:
+            return
+        with self.lock:
+            for key in list(self.files.keys()):
+                if key == old_key or key.startswith(old_key + '/'):
+                    self.files[new_key + key[len(old_key):]] = self.files.pop(key)
+        self.save()
+
+    def save(self):
+        """
+        Write the manifest, via a temporary file so an interruption never leaves a truncated manifest.
+        """
+        with self.lock:
+            temp_file = self.manifest_file + '.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump({'files': self.files}, f)
+            os.replace(temp_file, self.manifest_file)
+            self.last_save = time.time()
+
+    def verify(self, n_threads=8, buffer_size=16*2**20):
+        """
+        Re-read every file in the manifest at the destination and compare chunk hashes. The source is not read.
+
+        Parameters
+        ----------
+        n_threads: int, optional, default = 8
+            Number of chunks hashed at the same time.
+        buffer_size: int, optional, default = 16 MB
+            Bytes per read call.
+
+        Returns
+        ----------
+        problems: dict
+            Relative path: description, for every file that is missing, the wrong size, incomplete or has a chunk that doesn't match.
+        """
+        def hash_chunk(path, offset, length):
+            chunk_hash = hashlib.sha1()
+            with open(path, 'rb', buffering=0) as f:
+                f.seek(offset)
+                remaining = length
+                while remaining > 0:
+                    block = f.read(min(buffer_size, remaining))
+                    if len(block) == 0:
+                        break
+                    chunk_hash.update(block)
+                    remaining -= len(block)
+            return chunk_hash.hexdigest()
+
+        problems = {}
+        checks = []
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            for key, entry in self.files.items():
+                path = os.path.join(self.root, *key.split('/'))
+                if entry['complete'] == False:
+                    problems[key] = 'incomplete copy'
+                elif os.path.exists(path) == False:
+                    problems[key] = 'missing'
+                elif os.path.getsize(path) != entry['size']:
+                    problems[key] = 'size {} does not match {}'.format(os.path.getsize(path), entry['size'])
+                else:
+                    for c, digest in enumerate(entry['chunk_hashes']):
+                        offset = c*entry['chunk_size']
+                        future = executor.submit(hash_chunk, path, offset, min(entry['chunk_size'], entry['size'] - offset))
+                        checks.append((key, c, digest, future))
+            for key, c, digest, future in checks:
+                if future.result() != digest:
+                    problems[key] = 'chunk {} does not match'.format(c)
+        return problems
+
+
+class SourceInventory():
+    """
+    Cached listing of the acquisition computers' shares, so each share is listed once per run instead of once per lookup,
+    and not at all when it hasn't changed since the last run.
+    Each share is scanned with os.scandir, keeping the name, size, modification and creation time of every entry.
+    Lookups by a date token in the file name, or by modification date, are indexed.
+    With a cache_file the listing is kept between runs: a share whose folder modification time hasn't changed is not listed
+    again, and when it has changed only new entries, and entries modified recently enough that they may still be growing, are stat'd.
+
+    Methods
+    ----------
+    refresh(share)
+    entries(share)
+    match(share, token)
+    modified_on(share, date)
+    stat(path)
+    save()
+    """
+    def __init__(self, shares, cache_file=None, restat_window=86400.):
+        """
+        Parameters
+        ----------
+        shares: dict
+            Share name: folder, eg {'sync': computer_names['sync']}.
+        cache_file: path, optional, default = None
+            JSON file to keep the listing in between runs.
+        restat_window: float, optional, default = 86400.
+            Entries modified less than this many seconds before the previous scan are stat'd again on refresh.
+        """
+        self.shares = shares
+        self.cache_file = cache_file
+        self.restat_window = restat_window
+        self.listings = {}
+        self.token_index = {}
+        self.date_index = {}
+        self.scanned = set()
+        if cache_file is not None and os.path.exists(cache_file):
+            try:
+                with open(cache_file, 'r') as f:
+                    cached = json.load(f)
+                self.listings = {share: listing for share, listing in cached.items() if share in shares and listing['folder'] == shares[share]}
+            except ValueError:
+                print("{} is not readable, listing the shares again".format(cache_file))
+
+    def refresh(self, share):
+        """
+        Bring the listing of one share up to date.
+
+        Returns
+        ----------
+        entries: dict
+            Entry name: {'path', 'size', 'mtime', 'ctime', 'is_dir'}.
+        """
+        folder = self.shares[share]
+        folder_mtime = os.stat(folder).st_mtime
+        scan_time = time.time()
+        listing = self.listings.get(share)
+        if listing is not None and listing['folder_mtime'] == folder_mtime:
+            self.scanned.add(share)
+            return listing['entries']
+
+        old_entries = listing['entries'] if listing is not None else {}
+        last_scan = listing['scan_time'] if listing is not None else 0.
+        entries = {}
+        with os.scandir(folder) as it:
+            for entry in it:
+                old = old_entries.get(entry.name)
+                if old is not None and old['mtime'] < last_scan - self.restat_window:
+                    entries[entry.name] = old
+                    continue
+                stat = entry.stat()
+                entries[entry.name] = {'path': entry.path,
+                                        'size': stat.st_size,
+                                        'mtime': stat.st_mtime,
+                                        'ctime': stat.st_ctime,
+                                        'is_dir': entry.is_dir()}
+        self.listings[share] = {'folder': folder, 'folder_mtime': folder_mtime, 'scan_time': scan_time, 'entries': entries}
+        self.token_index.pop(share, None)
+        self.date_index.pop(share, None)
+        self.scanned.add(share)
+        return entries
+
+    def entries(self, share):
+        """
+        The listing of a share, refreshed the first time it is used in this run.
+        """
+        if share not in self.scanned:
+            return self.refresh(share)
+        return self.listings[share]['entries']
+
+    def match(self, share, token):
+        """
+        Returns
+        ----------
+        paths: list
+            Sorted paths of the entries in share whose name contains token, eg a date in the share's naming format.
+        """
+        entries = self.entries(share)
+        index = self.token_index.setdefault(share, {})
+        if token not in index:
+            index[token] = sorted([entry['path'] for name, entry in entries.items() if token in name])
+        return index[token]
+
+    def modified_on(self, share, date):
+        """
+        Returns
+        ----------
+        paths: list
+            Sorted paths of the entries in share last modified on date (YYYY-MM-DD, local time).
+        """
+        entries = self.entries(share)
+        if share not in self.date_index:
+            index = {}
+            for name, entry in entries.items():
+                day = datetime.strftime(datetime.fromtimestamp(entry['mtime']), '%Y-%m-%d')
+                index.setdefault(day, []).append(entry['path'])
+            self.date_index[share] = {day: sorted(paths) for day, paths in index.items()}
+        return self.date_index[share].get(date, [])
+
+    def stat(self, path):
+        """
+        Returns
+        ----------
+        entry: dict
+            The listing entry for a path directly inside one of the shares, or None if it isn't in the inventory.
+        """
+        folder, name = os.path.split(path)
+        for share, share_folder in self.shares.items():
+            if os.path.normpath(share_folder) == os.path.normpath(folder):
+                return self.entries(share).get(name)
+        return None
+
+    def save(self):
+        """
+        Write the listings to cache_file, if there is one.
+        """
+        if self.cache_file is None:
+            return
+        temp_file = self.cache_file + '.tmp'
+        with open(temp_file, 'w') as f:
+            json.dump(self.listings, f)
+        os.replace(temp_file, self.cache_file)
+
+
+class ScratchCache():
+    """
+    Local scratch copies of folders that live on the network, eg a probe's raw data folder while Kilosort runs on it.
+    stage() copies a folder's files, or only those matching a list of patterns, to scratch_dir (only the files that changed
+    since they were last staged), and prefetch() does the same in the background, so the next folder can be copied while the current one is in use.
+    sync_back() copies files that were added or changed in the scratch copy back to the network folder.
+    Staged folders stay in scratch_dir for reuse until space is needed: the least recently used folders are removed
+    to keep the total under budget_bytes. Folders that are in use (staged and not yet released) are never removed.
+    The cache index is kept in scratch_dir/scratch_index.json, so cached folders are reused between runs.
+
+    Methods
+    ----------
+    stage(key, src_dir, files=None)
+    prefetch(key, src_dir, files=None)
+    sync_back(key, dst_dir)
+    release(key)
+    evict(n_bytes)
+    save()
+    """
+    def __init__(self, scratch_dir, budget_bytes, copier=None):
+        """
+        Parameters
+        ----------
+        scratch_dir: path
+            Local folder (eg on an SSD) to keep staged copies in. Made if it doesn't exist.
+        budget_bytes: int
+            Space staged folders may take up in scratch_dir.
+        copier: CopyEngine, optional, default = None
+            Used for copying in and out. Default is a CopyEngine with 4 threads.
+        """
+        self.scratch_dir = scratch_dir
+        self.budget_bytes = budget_bytes
+        self.copier = copier if copier is not None else CopyEngine(n_threads=4)
+        self.index_file = os.path.join(scratch_dir, 'scratch_index.json')
+        self.lock = threading.Lock()
+        self.staging = {}
+        self.in_use = set()
+        self.prefetcher = ThreadPoolExecutor(max_workers=1)
+        self.entries = {}
+        os.makedirs(scratch_dir, exist_ok=True)
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as f:
+                self.entries = {key: entry for key, entry in json.load(f).items() if os.path.isdir(entry['local'])}
+
+    def local_dir(self, key):
+        return os.path.join(self.scratch_dir, key)
+
+    def used_bytes(self):
+        return sum([entry['bytes'] for entry in self.entries.values()])
+
+    def copy_in(self, key, src_dir, files=None):
+        local = self.local_dir(key)
+        entry = self.entries.get(key, {'src': src_dir, 'local': local, 'files': {}, 'bytes': 0})
+        sources = {}
+        with os.scandir(src_dir) as it:
+            for f in it:
+                if f.is_file() and (files is None or any([fnmatch.fnmatch(f.name, pattern) for pattern in files])):
+                    stat = f.stat()
+                    sources[f.name] = [stat.st_size, stat.st_mtime]
+        if files is not None:
+            # files staged or synced into the copy before that aren't selected now, so the copy holds only what was asked for
+            for name in [name for name in entry['files'] if name not in sources]:
+                if os.path.exists(os.path.join(local, name)):
+                    os.remove(os.path.join(local, name))
+                entry['files'].pop(name)
+        to_copy = [name for name, stat in sources.items()
+                    if entry['files'].get(name) != stat or os.path.exists(os.path.join(local, name))==False]
+        n_bytes = sum([sources[name][0] for name in to_copy])
+        with self.lock:
+            if self.evict(n_bytes, keep=key) == False:
+                self.in_use.discard(key)
+                print("Not enough scratch space for {}, using it where it is".format(src_dir))
+                return src_dir
+            entry['bytes'] += n_bytes
+            entry['last_used'] = time.time()
+            self.entries[key] = entry
+        os.makedirs(local, exist_ok=True)
+        start = time.time()
+        self.copier.copy_files([(os.path.join(src_dir, name), os.path.join(local, name)) for name in to_copy], copy_stat=True)
+        with self.lock:
+            entry['files'].update({name: sources[name] for name in to_copy})
+            entry['bytes'] = sum([os.path.getsize(os.path.join(local, f)) for f in os.listdir(local)])
+        self.save()
+        if len(to_copy) > 0:
+            print("Staged {:.2f} GB of {} to {} in {:.0f} s".format(n_bytes/1e9, src_dir, local, time.time()-start))
+        return local
+
+    def stage(self, key, src_dir, files=None):
+        """
+        Copy a folder to scratch, or wait for its prefetch to finish, and mark it in use.
+
+        Parameters
+        ----------
+        key: str
+            Name for the staged copy, unique within scratch_dir.
+        src_dir: path
+            Folder to stage. Only the files directly in it are copied.
+        files: list, optional, default = None
+            fnmatch patterns of the file names to copy, eg ['continuous.dat', 'chan*.mat']. Default copies every file.
+            Files from an earlier staging of key that don't match are removed from the scratch copy.
+
+        Returns
+        ----------
+        local_dir: path
+            The scratch copy of src_dir, or src_dir itself if it doesn't fit in the budget.
+        """
+        with self.lock:
+            self.in_use.add(key)
+            future = self.staging.get(key)
+        if future is not None:
+            return future.result()
+        return self.copy_in(key, src_dir, files)
+
+    def prefetch(self, key, src_dir, files=None):
+        """
+        Start staging a folder in the background, marking it in use. Does nothing if it is already being staged.
+        See stage() for files.
+        """
+        with self.lock:
+            if key in self.staging:
+                return
+            self.in_use.add(key)
+            future = self.prefetcher.submit(self.copy_in, key, src_dir, files)
+            self.staging[key] = future
+        future.add_done_callback(lambda f, key=key: self.staging.pop(key, None))
+
+    def sync_back(self, key, dst_dir):
+        """
+        Copy files that were added or changed in the scratch copy (eg Kilosort outputs) back to dst_dir.
+
+        Returns
+        ----------
+        synced: list
+            Names of the files copied back. Empty if the folder was never staged (see stage()).
+        """
+        if key not in self.entries:
+            return []
+        entry = self.entries[key]
+        changed = []
+        with os.scandir(entry['local']) as it:
+            for f in it:
+                if f.is_file():
+                    stat = f.stat()
+                    if entry['files'].get(f.name) != [stat.st_size, stat.st_mtime]:
+                        changed.append((f.name, [stat.st_size, stat.st_mtime]))
+        self.copier.copy_files([(os.path.join(entry['local'], name), os.path.join(dst_dir, name)) for name, stat in changed], copy_stat=True)
+        with self.lock:
+            entry['files'].update(dict(changed))
+            entry['bytes'] = sum([os.path.getsize(os.path.join(entry['local'], f)) for f in os.listdir(entry['local'])])
+            entry['last_used'] = time.time()
+        self.save()
+        return [name for name, stat in changed]
+
+    def release(self, key):
+        """
+        Mark a staged folder as no longer in use, so it can be removed when space is needed.
+        """
+        with self.lock:
+            self.in_use.discard(key)
+
+    def evict(self, n_bytes, keep=None):
+        """
+        Remove least recently used folders that aren't in use until n_bytes more fit in the budget.
+        Call with the lock held.
+
+        Returns
+        ----------
+        fits: bool
+            False if n_bytes still don't fit once every folder that isn't in use has been removed.
+        """
+        for key in sorted(self.entries, key=lambda k: self.entries[k]['last_used']):
+            if self.used_bytes() + n_bytes <= self.budget_bytes:
+                break
+            if key in self.in_use or key == keep:
+                continue
+            shutil.rmtree(self.entries[key]['local'], ignore_errors=True)
+            print("Removed {} from scratch ({:.2f} GB)".format(self.entries[key]['local'], self.entries[key]['bytes']/1e9))
+            self.entries.pop(key)
+        fits = self.used_bytes() + n_bytes <= self.budget_bytes
+        if fits == False:
+            print("{:.2f} GB over the scratch budget of {:.2f} GB".format((self.used_bytes() + n_bytes - self.budget_bytes)/1e9, self.budget_bytes/1e9))
+        return fits
+
+    def save(self):
+        """
+        Write the cache index to scratch_dir.
+        """
+        with self.lock:
+            temp_file = self.index_file + '.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(temp_file, self.index_file)
@@ -0,0 +1,460 @@
+import os
+import json
+import time
+import queue
+import threading
+from datetime import datetime
+from concurrent.futures import Future, ThreadPoolExecutor
+
+'''
+Warm MATLAB engines for running Kilosort.
+
+Starting MATLAB and setting up its path takes tens of seconds, so an EngineService starts its engines once and keeps them
+running, and jobs (a MATLAB script in a folder) are queued to whichever engine is free. get_service() returns one service
+per process, so every RunKilosort in a process (eg one per recording) shares the same warm engines.
+
+Engines started by a process quit with it, so a process that sorts one session (eg process_session.py) pays MATLAB startup
+once per session. That is small next to sorting a session, but to skip it, start the MATLAB sessions once outside Python,
+run matlab.engine.shareEngine in each, and pass connect_shared=True (--shared_engine on the command line). The service then
+connects to those sessions and only disconnects from them when it shuts down, so they stay warm for the next session.
+
+Engines come from a backend: MatlabBackend uses the MATLAB Engine API for Python, imported only when an engine is started,
+and FakeMatlabBackend stands in for MATLAB so the queue can be run without it.
+
+JobScheduler runs a set of jobs on a service in parallel, one per engine or GPU, with retries, and keeps the state of
+every job in a JSON file.
+'''
+
+
+class MatlabBackend():
+    """
+    Starts MATLAB engines with the MATLAB Engine API for Python.
+
+    Methods
+    ----------
+    start()
+    is_alive(engine)
+    stop(engine)
+    """
+    def __init__(self, connect_shared=False):
+        """
+        Parameters
+        ----------
+        connect_shared: bool, optional, default = False
+            Connect to a MATLAB session already shared with matlab.engine.shareEngine, if there is one, instead of starting a new one.
+            Connected sessions are disconnected from, not quit, by stop(), so they stay running for the next process.
+        """
+        self.connect_shared = connect_shared
+        self.lock = threading.Lock()
+        self.connected = {}
+
+    def start(self):
+        import matlab.engine
+        if self.connect_shared:
+            with self.lock:
+                names = [name for name in matlab.engine.find_matlab() if name not in self.connected.values()]
+                if len(names) > 0:
+                    engine = matlab.engine.connect_matlab(names[0])
+                    self.connected[id(engine)] = names[0]
+                    return engine
+            print("no free shared MATLAB session, starting one that quits with this process")
+        return matlab.engine.start_matlab()
+
+    def is_alive(self, engine):
+        try:
+            engine.eval('1;', nargout=0)
+            return True
+        except Exception:
+            return False
+
+    def stop(self, engine):
+        with self.lock:
+            shared = self.connected.pop(id(engine), None) is not None
+        try:
+            if shared:
+                engine.exit()
+            else:
+                engine.quit()
+        except Exception:
+            pass
+
+
+class FakeEngine():
+    """
+    Stand-in for a MATLAB engine. Calling a script by name records the call, waits run_seconds and, with write_outputs,
+    writes an empty rez.mat to the folder named on the script's rootZ line, like Kilosort would.
+    Scripts listed in fail_scripts raise an error instead.
+    """
+    def __init__(self, run_seconds=0., write_outputs=True, fail_scripts=()):
+        self.run_seconds = run_seconds
+        self.write_outputs = write_outputs
+        self.fail_scripts = fail_scripts
+        self.path = []
+        self.folder = os.getcwd()
+        self.calls = []
+        self.alive = True
+
+    def addpath(self, folder, nargout=0):
+        self.path.append(folder)
+
+    def cd(self, folder, nargout=0):
+        self.folder = folder
+
+    def eval(self, expression, nargout=0):
+        if self.alive == False:
+            raise RuntimeError("engine has stopped")
+
+    def quit(self):
+        self.alive = False
+
+    def __getattr__(self, script):
+        if script.startswith('__'):
+            raise AttributeError(script)
+
+        def run_script(nargout=0):
+            self.calls.append((self.folder, script))
+            time.sleep(self.run_seconds)
+            if script in self.fail_scripts:
+                raise RuntimeError("{} failed".format(script))
+            if self.write_outputs:
+                with open(os.path.join(self.folder, script + '.m'), 'r') as f:
+                    root_lines = [l for l in f.readlines() if l.startswith('rootZ =')]
+                if len(root_lines) > 0:
+                    root = root_lines[0].split("'")[1]
+                    open(os.path.join(root, 'rez.mat'), 'wb').close()
+        return run_script
+
+
+class FakeMatlabBackend():
+    """
+    Backend of FakeEngines, for running the job queue without MATLAB.
+
+    Methods
+    ----------
+    start()
+    is_alive(engine)
+    stop(engine)
+    """
+    def __init__(self, start_seconds=0., run_seconds=0., write_outputs=True, fail_scripts=()):
+        """
+        Parameters
+        ----------
+        start_seconds: float, optional, default = 0.
+            Time each engine takes to start.
+        run_seconds: float, optional, default = 0.
+            Time each script takes to run.
+        write_outputs: bool, optional, default = True
+            Write an empty rez.mat to each script's rootZ folder.
+        fail_scripts: tuple, optional, default = ()
+            Script names that raise an error.
+        """
+        self.start_seconds = start_seconds
+        self.run_seconds = run_seconds
+        self.write_outputs = write_outputs
+        self.fail_scripts = fail_scripts
+        self.engines = []
+
+    def start(self):
+        time.sleep(self.start_seconds)
+        engine = FakeEngine(self.run_seconds, self.write_outputs, self.fail_scripts)
+        self.engines.append(engine)
+        return engine
+
+    def is_alive(self, engine):
+        return engine.alive
+
+    def stop(self, engine):
+        engine.quit()
+
+
+BACKENDS = {'matlab': MatlabBackend, 'fake': FakeMatlabBackend}
+
+
+class EngineService():
+    """
+    Pool of warm engines with a job queue. Each engine has its own thread, which starts the engine as soon as the service
+    is created and then runs queued jobs one at a time. Folders are added to an engine's path the first time one of its jobs uses them.
+    An engine that has died after a failed job is replaced before the next job.
+
+    Methods
+    ----------
+    submit(folder, script, description=None)
+    run(folder, script, description=None)
+    shutdown(wait=True)
+    """
+    def __init__(self, backend='matlab', n_engines=1):
+        """
+        Parameters
+        ----------
+        backend: str or backend object, optional, default = 'matlab'
+            'matlab', 'fake', or an object with start(), is_alive(engine) and stop(engine) methods.
+        n_engines: int, optional, default = 1
+            Number of engines kept running, ie jobs run at the same time.
+        """
+        self.backend = BACKENDS[backend]() if isinstance(backend, str) else backend
+        self.n_engines = n_engines
+        self.jobs = queue.Queue()
+        self.jobs_run = 0
+        self.lock = threading.Lock()
+        self.workers = [threading.Thread(target=self.work, daemon=True) for n in range(n_engines)]
+        for worker in self.workers:
+            worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def start_engine(self):
+        start = time.time()
+        engine = self.backend.start()
+        print("started engine in {:.1f} s".format(time.time()-start))
+        return engine
+
+    def work(self):
+        # start straight away, so the engine is warm by the time the first job arrives
+        try:
+            engine = self.start_engine()
+        except Exception as e:
+            print("engine failed to start, retrying with the first job: {}".format(e))
+            engine = None
+        path = set()
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                if engine is not None:
+                    self.backend.stop(engine)
+                return
+            folder, script, description, future = job
+            if future.set_running_or_notify_cancel() == False:
+                continue
+            try:
+                if engine is None:
+                    engine = self.start_engine()
+                    path = set()
+                if folder not in path:
+                    engine.addpath(folder, nargout=0)
+                    path.add(folder)
+                engine.cd(folder, nargout=0)
+                getattr(engine, script)(nargout=0)
+                future.set_result(description)
+            except Exception as e:
+                future.set_exception(e)
+                if engine is not None and self.backend.is_alive(engine) == False:
+                    print("engine stopped responding, a new one will be started")
+                    engine = None
+            with self.lock:
+                self.jobs_run += 1
+
+    def submit(self, folder, script, description=None):
+        """
+        Queue a script to run.
+
+        Parameters
+        ----------
+        folder: path
+            Folder holding the script. It is added to the engine's path and made the current folder.
+        script: str
+            Script name, without .m.
+        description: str, optional, default = None
+            Returned by the future once the script has run.
+
+        Returns
+        ----------
+        future: concurrent.futures.Future
+            Raises the script's error, if it fails, from result().
+        """
+        future = Future()
+        self.jobs.put((folder, script, description, future))
+        return future
+
+    def run(self, folder, script, description=None):
+        """
+        submit() and wait for the script to finish.
+        """
+        return self.submit(folder, script, description).result()
+
+    def shutdown(self, wait=True):
+        """
+        Stop the engines once the queued jobs are done.
+        """
+        for worker in self.workers:
+            self.jobs.put(None)
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+
+class JobScheduler():
+    """
+    Run jobs on an EngineService, several at a time, with retries and a JSON record of every job's state.
+    Each job writes its own script when it starts, so jobs never share a script, and is given a GPU device number
+    from gpu_devices (or None) so no two running jobs use the same GPU.
+    Job states are 'queued', 'running', 'retrying', 'done' and 'failed'. Errors are kept with the time of each attempt.
+
+    Methods
+    ----------
+    add(job_id, folder, write_script, finish=None, **info)
+    run()
+    failures()
+    save()
+    """
+    def __init__(self, service, jobs_file=None, n_parallel=None, gpu_devices=None, max_attempts=2):
+        """
+        Parameters
+        ----------
+        service: EngineService
+        jobs_file: path, optional, default = None
+            JSON file job states are written to. Jobs from earlier runs already in the file are kept.
+        n_parallel: int, optional, default = None
+            Jobs run at the same time. Default is the number of GPU devices if given, otherwise the service's number of engines.
+        gpu_devices: list, optional, default = None
+            GPU device numbers to hand out, one per running job.
+        max_attempts: int, optional, default = 2
+            Attempts per job before it is marked failed.
+        """
+        self.service = service
+        self.jobs_file = jobs_file
+        if n_parallel is None:
+            n_parallel = len(gpu_devices) if gpu_devices is not None else service.n_engines
+        self.n_parallel = n_parallel
+        self.gpus = queue.Queue()
+        for device in (gpu_devices if gpu_devices is not None else [None]*n_parallel):
+            self.gpus.put(device)
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.scripts = {}
+        self.finishers = {}
+        self.history = {}
+        if jobs_file is not None and os.path.exists(jobs_file):
+            with open(jobs_file, 'r') as f:
+                self.history = json.load(f)
+
+    def add(self, job_id, folder, write_script, finish=None, **info):
+        """
+        Queue a job.
+
+        Parameters
+        ----------
+        job_id: str
+            Unique name for the job.
+        folder: path
+            Folder the job's script is written to.
+        write_script: function
+            Called with the GPU device number (or None) as the job starts. Writes the script into folder and returns its name.
+        finish: function, optional, default = None
+            Called with no arguments once the script has run without error, eg to copy outputs somewhere.
+            An error here counts as a failed attempt.
+        info:
+            Anything else to record with the job, eg recording and probe.
+        """
+        job = {'state': 'queued', 'attempts': 0, 'errors': [], 'gpu_device': None, 'seconds': None, 'folder': folder}
+        job.update(info)
+        self.jobs[job_id] = job
+        self.scripts[job_id] = write_script
+        self.finishers[job_id] = finish
+
+    def set_state(self, job_id, **changes):
+        with self.lock:
+            self.jobs[job_id].update(changes)
+        self.save()
+
+    def run_job(self, job_id):
+        job = self.jobs[job_id]
+        while True:
+            device = self.gpus.get()
+            start = time.time()
+            try:
+                self.set_state(job_id, state='running', attempts=job['attempts'] + 1, gpu_device=device)
+                script = self.scripts[job_id](device)
+                self.service.run(job['folder'], script, job_id)
+                if self.finishers[job_id] is not None:
+                    self.finishers[job_id]()
+                self.set_state(job_id, state='done', seconds=time.time()-start)
+                return True
+            except Exception as e:
+                with self.lock:
+                    job['errors'].append({'time': datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S'),
+                                            'attempt': job['attempts'],
+                                            'gpu_device': device,
+                                            'error': '{}: {}'.format(type(e).__name__, e)})
+                failed = job['attempts'] >= self.max_attempts
+                self.set_state(job_id, state='failed' if failed else 'retrying', seconds=time.time()-start)
+                print("{} failed on attempt {}: {}".format(job_id, job['attempts'], e))
+                if failed:
+                    return False
+            finally:
+                self.gpus.put(device)
+
+    def run(self):
+        """
+        Run every queued job and wait for them to finish.
+
+        Returns
+        ----------
+        jobs: dict
+            Job id: job record.
+        """
+        to_run = [job_id for job_id, job in self.jobs.items() if job['state'] in ['queued', 'retrying']]
+        self.save()
+        with ThreadPoolExecutor(max_workers=self.n_parallel) as executor:
+            list(executor.map(self.run_job, to_run))
+        return self.jobs
+
+    def failures(self):
+        """
+        Returns
+        ----------
+        failures: dict
+            Job id: job record, for jobs that failed every attempt.
+        """
+        return {job_id: job for job_id, job in self.jobs.items() if job['state'] == 'failed'}
+
+    def save(self):
+        """
+        Write the job states to jobs_file, if there is one.
+        """
+        if self.jobs_file is None:
+            return
+        with self.lock:
+            records = dict(self.history)
+            records.update(self.jobs)
+            temp_file = self.jobs_file + '.tmp'
+            with open(temp_file, 'w') as f:
+                json.dump(records, f, indent=1)
+            os.replace(temp_file, self.jobs_file)
+
+
+services = {}
+
+def get_service(backend='matlab', n_engines=1, connect_shared=False):
+    """
+    The process's EngineService for a backend, started the first time it is asked for and kept warm afterwards.
+
+    Parameters
+    ----------
+    backend: str, optional, default = 'matlab'
+        'matlab' or 'fake'.
+    n_engines: int, optional, default = 1
+        Number of engines, used when the service is started.
+    connect_shared: bool, optional, default = False
+        For 'matlab', connect to shared MATLAB sessions instead of starting new ones, see MatlabBackend.
+        Used when the service is started.
+
+    Returns
+    ----------
+    service: EngineService
+    """
+    if backend not in services:
+        backend_object = MatlabBackend(connect_shared=connect_shared) if backend == 'matlab' else backend
+        services[backend] = EngineService(backend_object, n_engines=n_engines)
+    return services[backend]
+
+def shutdown_services():
+    """
+    Stop the engines of every service started by get_service(). Shared MATLAB sessions are disconnected from and keep running.
+    """
+    for backend in list(services.keys()):
+        services.pop(backend).shutdown()
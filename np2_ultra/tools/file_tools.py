@@ -8,6 +8,127 @@ import json
 import np2_ultra.tools.io as io
 
 
+class RawRecording():
+    """
+    Read-only access to a probe's raw binary data (continuous.dat) as a (n_samples, n_channels) memmap.
+    Slicing is done directly on the memmap, so contiguous time windows and channel ranges are zero-copy views.
+
+    Methods
+    ----------
+    time_slice(t0, t1, channels=slice(None))
+    to_microvolts(raw)
+    """
+    def __init__(self, raw_data_file, n_channels=384, sample_rate=30000., gain_factor=0.19499999284744262695, dtype='int16'):
+        """
+        Parameters
+        ----------
+        raw_data_file: path
+            Path to the continuous.dat file.
+        n_channels: int, optional, default = 384
+            Number of channels interleaved in the file.
+        sample_rate: float, optional, default = 30000.
+            Sample rate in Hz.
+        gain_factor: float, optional, default = 0.195
+            Microvolts per bit.
+        dtype: str, optional, default = 'int16'
+            Sample data type.
+        """
+        self.raw_data_file = raw_data_file
+        self.n_channels = int(n_channels)
+        self.sample_rate = float(sample_rate)
+        self.gain_factor = float(gain_factor)
+        raw_data = np.memmap(raw_data_file, dtype=dtype, mode='r')
+        self.n_samples = int(raw_data.size/self.n_channels)
+        self.data = np.reshape(raw_data[:self.n_samples*self.n_channels], (self.n_samples, self.n_channels))
+        self.duration = self.n_samples / self.sample_rate
+        self.shape = self.data.shape
+        self.dtype = self.data.dtype
+
+    def __len__(self):
+        return self.n_samples
+
+    def __getitem__(self, key):
+        """
+        Index in samples, eg recording[t0:t1, channels]
+        """
+        return self.data[key]
+
+    def time_slice(self, t0, t1, channels=slice(None)):
+        """
+        Data between two times in seconds.
+
+        Parameters
+        ----------
+        t0: float
+            Start time (s) from the start of the file.
+        t1: float
+            End time (s) from the start of the file.
+        channels: slice or array, optional, default = all channels
+            Channels to return. A slice returns a zero-copy view.
+
+        Returns
+        ----------
+        raw: array
+            Raw data with shape (n_samples, n_channels).
+        """
+        s0 = max(int(round(t0*self.sample_rate)), 0)
+        s1 = min(int(round(t1*self.sample_rate)), self.n_samples)
+        return self.data[s0:s1, channels]
+
+    def to_microvolts(self, raw):
+        """
+        Convert raw counts to microvolts using the gain factor.
+
+        Parameters
+        ----------
+        raw: array
+            Raw data counts.
+
+        Returns
+        ----------
+        microvolts: array
+            float32 array of the data in microvolts.
+        """
+        return np.asarray(raw, dtype=np.float32) * np.float32(self.gain_factor)
+
+
+def open_recording(raw_data_file, n_channels=384, sample_rate=30000., gain_factor=0.19499999284744262695):
+    """
+    Open raw probe data as a RawRecording, or as a CompressedRecording if the file is a compressed .cdat file.
+
+    Parameters
+    ----------
+    raw_data_file: path
+        Path to the continuous.dat or continuous.cdat file.
+    n_channels: int, optional, default = 384
+        Number of channels interleaved in an uncompressed file. Compressed files store their own channel count.
+    sample_rate: float, optional, default = 30000.
+        Sample rate in Hz.
+    gain_factor: float, optional, default = 0.195
+        Microvolts per bit.
+    """
+    from np2_ultra.tools import compress_tools
+    if raw_data_file.endswith(compress_tools.COMPRESSED_SUFFIX):
+        return compress_tools.CompressedRecording(raw_data_file, sample_rate=sample_rate, gain_factor=gain_factor)
+    return RawRecording(raw_data_file, n_channels=n_channels, sample_rate=sample_rate, gain_factor=gain_factor)
+
+
+def read_sidecar_metadata(data_file):
+    """
+    Metadata JSON written next to a derived data file (eg lfp.dat -> lfp.json).
+
+    Returns
+    ----------
+    metadata: dict or None
+        None if there is no metadata file.
+    """
+    metadata_file = os.path.splitext(data_file)[0] + '.json'
+    if os.path.exists(metadata_file)==False:
+        return None
+    with open(metadata_file, 'r') as f:
+        return json.load(f)
+
+
 class GetFiles():
     def __init__(self, session_date, mouse_id, probes="all", recordings="all",
                         pxi_dict='default', opto_params='default', verbose=False):
@@ -109,22 +230,63 @@ class GetFiles():
         except IndexError:
             print("This session doesn't appear to have a params file.")
 
-    def get_gain_factor(self):
+    def get_gain_factor(self, band=None):
         """SESSION-WIDE
-        gain_factor: probe gain factor as float"""
+        gain_factor: probe gain factor as float
+        band: str, optional, default = None
+            'spike' or 'lfp' to only average the gains of AP or LFP channels. None averages every channel."""
+        prefix = {None: '', 'spike': 'AP', 'lfp': 'LFP'}[band]
         try:
             xml_file = os.path.join(self.session_dir, "settings.xml")
             tree = ET.parse(xml_file)
             root = tree.getroot()
             gains = []
             for n, c in enumerate(root[1][0][0]):
-                g = root[1][0][0][n].get('gain')
-                gains.append(float(g))
+                if str(c.get('name')).startswith(prefix):
+                    g = root[1][0][0][n].get('gain')
+                    gains.append(float(g))
             self.gain_factor = np.mean(gains)
         except:
             self.gain_factor = 0.19499999284744262695
+        if np.isnan(self.gain_factor):
+            self.gain_factor = 0.19499999284744262695
         if self.verbose==True:
             print("Gain factor returned as gain_factor.")
+        return self.gain_factor
+
+    def get_channel_count(self, band='spike'):
+        """SESSION-WIDE
+        n_channels: number of channels per probe in the band as int, read from settings.xml (default 384)
+        band: str, optional, default = 'spike'
+            'spike' for AP channels or 'lfp' for LFP channels."""
+        prefix = {'spike': 'AP', 'lfp': 'LFP'}[band]
+        try:
+            xml_file = os.path.join(self.session_dir, "settings.xml")
+            root = ET.parse(xml_file).getroot()
+            names = set([c.get('name') for c in root[1][0][0] if str(c.get('name')).startswith(prefix)])
+            n_channels = len(names)
+        except:
+            n_channels = 0
+        if n_channels == 0:
+            n_channels = 384
+        return n_channels
+
+    def get_sample_rate(self, recording, band='spike'):
+        """
+        sample_rate: sample rate of the band in Hz, read from the recording's structure.oebin if there is one
+        recording: str in format "recordingN" where N is the recording number
+        band: str, optional, default = 'spike'
+            'spike' or 'lfp'
+        """
+        default_rates = {'spike': 30000., 'lfp': 2500.}
+        try:
+            with open(os.path.join(self.recording_dirs[recording], "structure.oebin"), 'r') as f:
+                oebin = json.load(f)
+            suffix = {'spike': '.0', 'lfp': '.1'}[band]
+            rates = [c['sample_rate'] for c in oebin['continuous'] if c['folder_name'].strip('/').endswith(suffix)]
+            return float(rates[0])
+        except:
+            return default_rates[band]
 
     def get_data_dict(self, recording, probe):
         """
@@ -142,22 +304,107 @@ class GetFiles():
             print("There is no analysis file for this recording/probe combo.")
             return
 
-    def get_raw_data(self, recording, probe, band='spike'):
+    def get_raw_data_file(self, recording, probe, band='spike'):
         """
         recording: str in format "recordingN" where N is the recording number
         probe: str in format of a capital letter indicating the probe cartridge position
-        raw_data: raw data as a numpy memmap array
+        band: str, optional, default = 'spike'
+            'spike' for the AP band folder, 'lfp' for the LFP band folder given by pxi_dict['lfp']
+        raw_data_file: path to the continuous.dat file for the recording/probe combo,
+            or to continuous.cdat if the data has only been kept in compressed form.
+            Probes without an LFP band folder (ultra probes) use the lfp.dat made by scripts/lfp.py in the AP band folder.
         """
-        if self.probe_data_dirs==False:
+        if 'probe_data_dirs' not in dir(self):
             self.get_probe_dirs("all")
-        if band=='spike':
-            data_dir = self.probe_data_dirs[recording][probe]
-        elif band=='lfp':
-            data_dir = os.path.join()
+        data_dir = self.probe_data_dirs[recording][probe]
+        if band=='lfp':
+            lfp_dir = data_dir[:-2] + self.pxi_dict['lfp'][probe]
+            if os.path.exists(lfp_dir)==False:
+                return os.path.join(data_dir, "lfp.dat")
+            data_dir = lfp_dir
         raw_data_file = os.path.join(data_dir, "continuous.dat")
-        rawData = np.memmap(raw_data_file,dtype='int16',mode='r')
-        raw_data = np.reshape(rawData, (int(rawData.size/384), 384)).T
-        return raw_data
+        compressed_file = os.path.join(data_dir, "continuous.cdat")
+        if (os.path.exists(raw_data_file)==False) and os.path.exists(compressed_file):
+            return compressed_file
+        return raw_data_file
+
+    def get_raw_recording(self, recording, probe, band='spike'):
+        """
+        recording: str in format "recordingN" where N is the recording number
+        probe: str in format of a capital letter indicating the probe cartridge position
+        band: str, optional, default = 'spike'
+            'spike' or 'lfp'
+        raw_recording: RawRecording (or CompressedRecording) with channel count and gain from settings.xml and the band's sample rate,
+            or from the metadata JSON of a derived file such as lfp.dat
+        """
+        raw_data_file = self.get_raw_data_file(recording, probe, band=band)
+        if os.path.exists(raw_data_file)==False:
+            raise FileNotFoundError("No {} band data for {} probe {} at {}".format(band, recording, probe, raw_data_file))
+        metadata = read_sidecar_metadata(raw_data_file)
+        if metadata is not None:
+            return open_recording(raw_data_file,
+                                n_channels=metadata['n_channels'],
+                                sample_rate=metadata['sample_rate'],
+                                gain_factor=metadata['gain_factor'])
+        return open_recording(raw_data_file,
+                            n_channels=self.get_channel_count(band=band),
+                            sample_rate=self.get_sample_rate(recording, band=band),
+                            gain_factor=self.get_gain_factor(band=band))
+
+    def get_raw_data(self, recording, probe, band='spike'):
+        """
+        recording: str in format "recordingN" where N is the recording number
+        probe: str in format of a capital letter indicating the probe cartridge position
+        band: str, optional, default = 'spike'
+            'spike' or 'lfp'
+        raw_data: raw data as a numpy memmap array with shape (n_channels, n_samples).
+            Compressed data is fully decoded into memory, use get_raw_recording() to read windows instead.
+        """
+        raw_recording = self.get_raw_recording(recording, probe, band=band)
+        if raw_recording.data is raw_recording:
+            return raw_recording[:].T
+        return raw_recording.data.T
+
+    def get_kilosort_results(self, recording, probe):
+        """
+        recording: str in format "recordingN" where N is the recording number
+        probe: str in format of a capital letter indicating the probe cartridge position
+        ks_results: KilosortResults for the probe's Kilosort output, with spike times aligned to the recording's timestamps.npy,
+            see analysis_tools.KilosortResults. Outputs are memory-mapped as they are used.
+        """
+        from np2_ultra.tools import analysis_tools
+        return analysis_tools.KilosortResults(self.probe_data_dirs[recording][probe],
+                                            timestamps_file=os.path.join(self.recording_dirs[recording], 'timestamps.npy'))
+
+    def get_channel_noise(self, recording, probe, band='spike', overwrite=False):
+        """
+        recording: str in format "recordingN" where N is the recording number
+        probe: str in format of a capital letter indicating the probe cartridge position
+        band: str, optional, default = 'spike'
+            'spike' or 'lfp'
+        overwrite: bool, optional, default = False
+            Remeasure even if a cached result exists.
+        noise: per-channel noise (RMS and MAD in microvolts), saturation counts and dead/noisy channel flags as a dictionary,
+            cached next to the raw data, see signal_tools.get_channel_noise()
+        """
+        from np2_ultra.tools import signal_tools
+        raw_data_file, noise_settings = self.get_channel_noise_settings(recording, probe, band=band)
+        return signal_tools.get_channel_noise(raw_data_file, overwrite=overwrite, **noise_settings)
+
+    def get_channel_noise_settings(self, recording, probe, band='spike'):
+        """
+        recording: str in format "recordingN" where N is the recording number
+        probe: str in format of a capital letter indicating the probe cartridge position
+        band: str, optional, default = 'spike'
+            'spike' or 'lfp'
+        raw_data_file, noise_settings: the data file and the signal_tools.get_channel_noise() keyword arguments get_channel_noise()
+            uses for it. Every caller measuring noise on the file should pass the same settings, which are part of the cache key.
+        """
+        raw_recording = self.get_raw_recording(recording, probe, band=band)
+        return raw_recording.raw_data_file, {'n_channels': raw_recording.n_channels,
+                                            'sample_rate': raw_recording.sample_rate,
+                                            'gain_factor': raw_recording.gain_factor,
+                                            'highpass_hz': 300. if band=='spike' else 10.}
 
     def get_events_dir(self, probes, lfp=False):
         '''
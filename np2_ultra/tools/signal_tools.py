@@ -0,0 +1,529 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from np2_ultra.tools.file_tools import open_recording, read_sidecar_metadata
+
+
+def design_lowpass(cutoff_hz, sample_rate, num_taps):
+    """
+    Linear-phase FIR low-pass filter (Hamming windowed sinc) with unit gain at DC.
+
+    Parameters
+    ----------
+    cutoff_hz: float
+        Cutoff frequency in Hz.
+    sample_rate: float
+        Sample rate of the data being filtered in Hz.
+    num_taps: int
+        Filter length. Forced to be odd so the group delay is a whole number of samples.
+
+    Returns
+    ----------
+    taps: array
+        float32 filter coefficients.
+    """
+    num_taps = int(num_taps) | 1
+    n = np.arange(num_taps) - (num_taps-1)/2
+    taps = np.sinc(2*cutoff_hz/sample_rate*n) * np.hamming(num_taps)
+    return (taps/taps.sum()).astype(np.float32)
+
+def read_padded(data, start, stop):
+    """
+    Read samples start:stop of a (n_samples, n_channels) array, repeating the first or last sample for any part
+    of the window that falls outside the data.
+
+    Returns
+    ----------
+    window: array
+        float32 data with shape (stop-start, n_channels).
+    """
+    n_samples = data.shape[0]
+    window = np.asarray(data[max(start, 0):min(stop, n_samples)], dtype=np.float32)
+    if start < 0 or stop > n_samples:
+        window = np.pad(window, ((max(-start, 0), max(stop-n_samples, 0)), (0, 0)), mode='edge')
+    return window
+
+def decimate_chunk(window, taps, decimation, n_out):
+    """
+    Low-pass filter and decimate one block of data, computing only the output samples that are kept.
+    Output sample k is centred on window sample k*decimation + half the filter length, so reading the input
+    with an overlap of half the filter length on each side gives the same result as filtering the whole file at once.
+
+    The filter is split into blocks of `decimation` taps. Every block of input samples is multiplied by every
+    block of taps in one matrix product, and output sample k is the sum of input block k+b times tap block b.
+
+    Parameters
+    ----------
+    window: array
+        float32 input with shape ((n_out-1)*decimation + taps.size, n_channels), see read_padded().
+    taps: array
+        FIR filter from design_lowpass().
+    decimation: int
+        Integer decimation factor.
+    n_out: int
+        Number of output samples.
+
+    Returns
+    ----------
+    decimated: array
+        int16 data with shape (n_out, n_channels).
+    """
+    n_blocks = -(-taps.size // decimation)
+    tap_blocks = np.zeros(n_blocks*decimation, dtype=np.float32)
+    tap_blocks[:taps.size] = taps
+    tap_blocks = tap_blocks.reshape(n_blocks, decimation)
+    n_rows = (n_out + n_blocks - 1)*decimation
+    if window.shape[0] < n_rows:
+        window = np.pad(window, ((0, n_rows - window.shape[0]), (0, 0)), mode='constant')
+    window_blocks = window[:n_rows].reshape(n_out + n_blocks - 1, decimation, window.shape[1])
+    products = np.matmul(tap_blocks, window_blocks)
+    decimated = products[:n_out, 0].copy()
+    for b in range(1, n_blocks):
+        decimated += products[b:b+n_out, b]
+    return np.clip(np.round(decimated), -32768, 32767).astype(np.int16)
+
+def process_in_chunks(data, out_file, chunks, process, n_threads=4, description='Processed'):
+    """
+    Run a chunk function over a (n_samples, n_channels) array on a thread pool and write the int16 results to out_file in order.
+    Only a bounded window of chunks is in memory at a time.
+
+    Parameters
+    ----------
+    data: array
+        Input data with shape (n_samples, n_channels).
+    out_file: path
+        Output binary file.
+    chunks: list
+        (start, stop, args) for each chunk. Samples start:stop are read with read_padded() and passed to process(window, *args).
+    process: function
+        Function returning the int16 output of one chunk.
+    n_threads: int, optional, default = 4
+        Number of chunks processed at the same time.
+    description: str, optional, default = 'Processed'
+        Verb used in progress messages.
+    """
+    with open(out_file, 'wb') as f:
+        with ThreadPoolExecutor(max_workers=n_threads) as executor:
+            window = 2*n_threads
+            for w in range(0, len(chunks), window):
+                futures = []
+                for start, stop, args in chunks[w:w+window]:
+                    # reads stay on this thread, compressed recordings share one file handle
+                    futures.append(executor.submit(process, read_padded(data, start, stop), *args))
+                for future in futures:
+                    f.write(future.result().tobytes())
+                print('{} {:.0f}% of chunks for {}'.format(description, 100*min(w+window, len(chunks))/len(chunks), out_file))
+
+def decimate_file(raw_data_file, lfp_file=None, n_channels=384, sample_rate=30000., gain_factor=0.19499999284744262695,
+                    target_rate=2500., cutoff_hz=1000., taps_per_phase=24, chunk_seconds=0.5, n_threads=4):
+    """
+    Make a low sample rate LFP file from wideband probe data, reading the input in overlapping chunks so memory use stays flat.
+    Writes int16 data in the same units as the input to lfp_file, and its metadata to a JSON file with the same name.
+
+    Parameters
+    ----------
+    raw_data_file: path
+        Path to continuous.dat (or continuous.cdat).
+    lfp_file: path, optional, default = None
+        Output path. Default is lfp.dat in the same folder as raw_data_file.
+    n_channels: int, optional, default = 384
+        Number of channels in the input file.
+    sample_rate: float, optional, default = 30000.
+        Input sample rate in Hz.
+    gain_factor: float, optional, default = 0.195
+        Microvolts per bit, copied into the metadata.
+    target_rate: float, optional, default = 2500.
+        Approximate output sample rate in Hz. The decimation factor is round(sample_rate/target_rate).
+    cutoff_hz: float, optional, default = 1000.
+        Low-pass cutoff in Hz, below the output Nyquist frequency.
+    taps_per_phase: int, optional, default = 24
+        Filter length in units of the decimation factor. Longer filters have a sharper cutoff.
+    chunk_seconds: float, optional, default = 0.5
+        Seconds of output computed per chunk.
+    n_threads: int, optional, default = 4
+        Number of chunks filtered at the same time.
+
+    Returns
+    ----------
+    lfp_file: path
+    """
+    if lfp_file is None:
+        lfp_file = os.path.join(os.path.dirname(raw_data_file), 'lfp.dat')
+    recording = open_recording(raw_data_file, n_channels=n_channels, sample_rate=sample_rate, gain_factor=gain_factor)
+    decimation = int(round(sample_rate/target_rate))
+    lfp_rate = sample_rate/decimation
+    if cutoff_hz >= lfp_rate/2:
+        raise ValueError("cutoff_hz ({}) must be below the output Nyquist frequency ({})".format(cutoff_hz, lfp_rate/2))
+    taps = design_lowpass(cutoff_hz, sample_rate, taps_per_phase*decimation)
+    half = (taps.size-1)//2
+    n_out = int(np.ceil(recording.n_samples/decimation))
+    chunk_out = max(int(chunk_seconds*lfp_rate), 1)
+    chunks = [(k*decimation - half, (min(k+chunk_out, n_out)-1)*decimation + half + 1, (taps, decimation, min(k+chunk_out, n_out)-k))
+                for k in range(0, n_out, chunk_out)]
+    process_in_chunks(recording.data, lfp_file, chunks, decimate_chunk, n_threads=n_threads, description='Decimated')
+
+    metadata = {'source_file': raw_data_file,
+                'n_channels': recording.n_channels,
+                'n_samples': n_out,
+                'sample_rate': lfp_rate,
+                'source_sample_rate': sample_rate,
+                'decimation': decimation,
+                'cutoff_hz': cutoff_hz,
+                'num_taps': int(taps.size),
+                'dtype': 'int16',
+                'gain_factor': gain_factor}
+    with open(os.path.splitext(lfp_file)[0] + '.json', 'w') as f:
+        json.dump(metadata, f, indent=4)
+    return lfp_file
+
+def design_highpass(cutoff_hz, sample_rate, num_taps):
+    """
+    Linear-phase FIR high-pass filter, made by spectral inversion of design_lowpass(). Zero gain at DC.
+
+    Parameters
+    ----------
+    cutoff_hz: float
+        Cutoff frequency in Hz.
+    sample_rate: float
+        Sample rate of the data being filtered in Hz.
+    num_taps: int
+        Filter length. Forced to be odd.
+
+    Returns
+    ----------
+    taps: array
+        float32 filter coefficients.
+    """
+    taps = -design_lowpass(cutoff_hz, sample_rate, num_taps)
+    taps[(taps.size-1)//2] += 1
+    return taps
+
+
+def channel_median(data):
+    """
+    Median across the last axis. A single partition is much faster than np.median.
+    """
+    n = data.shape[-1]
+    k = n//2
+    partitioned = np.partition(data, k, axis=-1)
+    if n % 2:
+        return partitioned[..., k]
+    return 0.5*(partitioned[..., :k].max(axis=-1) + partitioned[..., k])
+
+class Preprocessor():
+    """
+    Common referencing across channels followed by a high-pass filter along time, for spike waveforms.
+    Both steps only use nearby samples, so data read with `margin` extra samples on each side gives the same result
+    as preprocessing the whole file. The filter is linear phase and its delay is removed, so waveform shapes are not phase distorted.
+    Referencing comes first so that only the channels being kept have to be filtered.
+
+    Methods
+    ----------
+    apply(window, channels=None)
+    """
+    def __init__(self, highpass_hz=300., sample_rate=30000., num_taps=301, reference='median', block_samples=128):
+        """
+        Parameters
+        ----------
+        highpass_hz: float, optional, default = 300.
+            High-pass cutoff in Hz.
+        sample_rate: float, optional, default = 30000.
+            Sample rate in Hz.
+        num_taps: int, optional, default = 301
+            FIR filter length.
+        reference: str, optional, default = 'median'
+            'median' or 'mean' subtracts the median or mean across channels from every sample, None skips referencing.
+        block_samples: int, optional, default = 128
+            Output samples computed per matrix product when filtering.
+        """
+        if reference not in ('median', 'mean', None):
+            raise ValueError("reference must be 'median', 'mean' or None, not {}".format(reference))
+        self.taps = design_highpass(highpass_hz, sample_rate, num_taps)
+        self.margin = (self.taps.size-1)//2
+        self.reference = reference
+        # block_samples outputs of the convolution as one (block_samples, block_samples + taps - 1) matrix,
+        # which runs much faster as a BLAS product than an FFT for filters this short
+        self.block_samples = block_samples
+        self.toeplitz = np.zeros((block_samples, block_samples + self.taps.size - 1), dtype=np.float32)
+        for i in range(block_samples):
+            self.toeplitz[i, i:i+self.taps.size] = self.taps[::-1]
+
+    def apply(self, window, channels=None):
+        """
+        Parameters
+        ----------
+        window: array
+            Data with time on the second to last axis and channels on the last axis, eg (n_samples, n_channels) or
+            (n_snippets, n_samples, n_channels). Must include `margin` samples either side of the samples wanted.
+        channels: array, optional, default = None
+            Channels to return. Every channel is used for the reference. None returns every channel.
+
+        Returns
+        ----------
+        preprocessed: array
+            float32 data with 2*margin fewer samples than window.
+        """
+        window = np.asarray(window, dtype=np.float32)
+        if self.reference == 'median':
+            window = window - channel_median(window)[..., np.newaxis]
+        elif self.reference == 'mean':
+            window = window - window.mean(axis=-1, keepdims=True)
+        if channels is not None:
+            window = window[..., np.asarray(channels)]
+
+        n_out = window.shape[-2] - 2*self.margin
+        filtered = np.empty(window.shape[:-2] + (n_out, window.shape[-1]), dtype=np.float32)
+        for b in range(0, n_out, self.block_samples):
+            n = min(self.block_samples, n_out - b)
+            filtered[..., b:b+n, :] = np.matmul(self.toeplitz[:n, :n+self.taps.size-1], window[..., b:b+n+self.taps.size-1, :])
+        return filtered
+
+def get_preprocessor(extraction_params, sample_rate=30000.):
+    """
+    Preprocessor for waveform extraction, or None if extraction_params['highpass_hz'] is not set.
+
+    Parameters
+    ----------
+    extraction_params: dict
+        Waveform extraction parameters, see GetWaveforms.waveform_extraction_params()
+    sample_rate: float, optional, default = 30000.
+        Sample rate in Hz.
+    """
+    if extraction_params.get('highpass_hz') is None:
+        return None
+    return Preprocessor(highpass_hz=extraction_params['highpass_hz'],
+                        sample_rate=sample_rate,
+                        num_taps=extraction_params.get('highpass_taps', 301),
+                        reference=extraction_params.get('reference', 'median'))
+
+def preprocess_chunk(window, preprocessor):
+    """
+    Preprocess one chunk of data for preprocess_file(), rounded back to int16.
+    """
+    return np.clip(np.round(preprocessor.apply(window)), -32768, 32767).astype(np.int16)
+
+def preprocess_file(raw_data_file, preprocessed_file=None, n_channels=384, sample_rate=30000., gain_factor=0.19499999284744262695,
+                    highpass_hz=300., num_taps=301, reference='median', chunk_seconds=1., n_threads=4):
+    """
+    Write a high-pass filtered, common referenced copy of wideband probe data, reading the input in overlapping chunks.
+    Output is int16 in the same units as the input, with its settings and the source file's size and modification time in a
+    JSON file with the same name. Both are written to temporary files and moved into place once complete, the JSON last,
+    so an interrupted run never leaves a partial file with valid metadata.
+
+    Parameters
+    ----------
+    raw_data_file: path
+        Path to continuous.dat (or continuous.cdat).
+    preprocessed_file: path, optional, default = None
+        Output path. Default is continuous_preprocessed.dat in the same folder as raw_data_file.
+    n_channels: int, optional, default = 384
+        Number of channels in the input file.
+    sample_rate: float, optional, default = 30000.
+        Sample rate in Hz.
+    gain_factor: float, optional, default = 0.195
+        Microvolts per bit, copied into the metadata.
+    highpass_hz, num_taps, reference:
+        see Preprocessor
+    chunk_seconds: float, optional, default = 1.
+        Seconds of data preprocessed per chunk.
+    n_threads: int, optional, default = 4
+        Number of chunks preprocessed at the same time.
+
+    Returns
+    ----------
+    preprocessed_file: path
+    """
+    if preprocessed_file is None:
+        preprocessed_file = os.path.join(os.path.dirname(raw_data_file), 'continuous_preprocessed.dat')
+    metadata_file = os.path.splitext(preprocessed_file)[0] + '.json'
+    source_stat = os.stat(raw_data_file)
+    recording = open_recording(raw_data_file, n_channels=n_channels, sample_rate=sample_rate, gain_factor=gain_factor)
+    preprocessor = Preprocessor(highpass_hz=highpass_hz, sample_rate=sample_rate, num_taps=num_taps, reference=reference)
+    chunk_samples = max(int(chunk_seconds*sample_rate), 1)
+    chunks = [(s - preprocessor.margin, min(s+chunk_samples, recording.n_samples) + preprocessor.margin, (preprocessor,))
+                for s in range(0, recording.n_samples, chunk_samples)]
+    process_in_chunks(recording.data, preprocessed_file + '.tmp', chunks, preprocess_chunk, n_threads=n_threads, description='Preprocessed')
+
+    metadata = {'source_file': raw_data_file,
+                'source_size': source_stat.st_size,
+                'source_mtime': source_stat.st_mtime,
+                'n_channels': recording.n_channels,
+                'n_samples': recording.n_samples,
+                'sample_rate': sample_rate,
+                'highpass_hz': highpass_hz,
+                'num_taps': int(preprocessor.taps.size),
+                'reference': reference,
+                'dtype': 'int16',
+                'gain_factor': gain_factor}
+    with open(metadata_file + '.tmp', 'w') as f:
+        json.dump(metadata, f, indent=4)
+    if os.path.exists(metadata_file):
+        os.remove(metadata_file)
+    os.replace(preprocessed_file + '.tmp', preprocessed_file)
+    os.replace(metadata_file + '.tmp', metadata_file)
+    return preprocessed_file
+
+def get_preprocessed_file(raw_data_file, extraction_params, sample_rate=30000., gain_factor=0.19499999284744262695, n_threads=4):
+    """
+    Path to the cached preprocessed copy of raw_data_file for the settings in extraction_params.
+    The copy is (re)made if it does not exist, was made with different settings or from a different version of raw_data_file
+    (size or modification time), or doesn't hold the source's number of samples.
+
+    Parameters
+    ----------
+    raw_data_file: path
+        Path to continuous.dat (or continuous.cdat).
+    extraction_params: dict
+        Waveform extraction parameters, see GetWaveforms.waveform_extraction_params()
+    sample_rate: float, optional, default = 30000.
+    gain_factor: float, optional, default = 0.195
+    n_threads: int, optional, default = 4
+
+    Returns
+    ----------
+    preprocessed_file: path
+    """
+    preprocessed_file = os.path.join(os.path.dirname(raw_data_file), 'continuous_preprocessed.dat')
+    settings = {'highpass_hz': extraction_params['highpass_hz'],
+                'num_taps': int(extraction_params.get('highpass_taps', 301)) | 1,
+                'reference': extraction_params.get('reference', 'median')}
+    metadata = read_sidecar_metadata(preprocessed_file)
+    if os.path.exists(preprocessed_file) and metadata is not None:
+        source_stat = os.stat(raw_data_file)
+        recording = open_recording(raw_data_file, n_channels=extraction_params['n_channels'], sample_rate=sample_rate)
+        key = dict(settings, source_size=source_stat.st_size, source_mtime=source_stat.st_mtime, n_samples=recording.n_samples,
+                    n_channels=recording.n_channels)
+        if hasattr(recording, 'close'):
+            recording.close()
+        if all(metadata.get(k) == v for k, v in key.items()) and \
+                os.path.getsize(preprocessed_file) == metadata['n_samples']*metadata['n_channels']*np.dtype('int16').itemsize:
+            return preprocessed_file
+    print('Making preprocessed copy of {}'.format(raw_data_file))
+    return preprocess_file(raw_data_file, preprocessed_file, n_channels=extraction_params['n_channels'], sample_rate=sample_rate,
+                            gain_factor=gain_factor, n_threads=n_threads, **settings)
+
+def chunk_noise_stats(window, preprocessor, saturation_level):
+    """
+    Noise and saturation statistics of one chunk for channel_noise_stats().
+
+    Returns
+    ----------
+    stats: tuple
+        (sum of squares, number of samples, MAD noise, saturated sample count), each per channel.
+    """
+    saturated = np.sum(np.abs(window[preprocessor.margin:window.shape[0]-preprocessor.margin]) >= saturation_level, axis=0)
+    series = np.ascontiguousarray(preprocessor.apply(window).T)
+    mad = channel_median(np.abs(series - channel_median(series)[:, np.newaxis])) / 0.6745
+    return np.sum(series.astype(np.float64)**2, axis=1), series.shape[1], mad, saturated
+
+def channel_noise_stats(raw_data_file, n_channels=384, sample_rate=30000., gain_factor=0.19499999284744262695, highpass_hz=300.,
+                        n_chunks=40, chunk_seconds=0.5, saturation_level=32000, dead_fraction=0.1, noisy_factor=5., n_threads=4):
+    """
+    Per-channel noise, saturation and dead/noisy channel flags from chunks spread evenly through a recording.
+    Each chunk is high-pass filtered (no referencing) before the noise is measured.
+
+    Parameters
+    ----------
+    raw_data_file: path
+        Path to continuous.dat (or continuous.cdat).
+    n_channels: int, optional, default = 384
+        Number of channels in the file.
+    sample_rate: float, optional, default = 30000.
+        Sample rate in Hz.
+    gain_factor: float, optional, default = 0.195
+        Microvolts per bit, used for the noise in microvolts.
+    highpass_hz: float, optional, default = 300.
+        High-pass cutoff applied before measuring noise.
+    n_chunks: int, optional, default = 40
+        Number of chunks sampled.
+    chunk_seconds: float, optional, default = 0.5
+        Length of each chunk.
+    saturation_level: int, optional, default = 32000
+        Raw samples with an absolute value at or above this count as saturated.
+    dead_fraction: float, optional, default = 0.1
+        Channels with MAD noise below this fraction of the probe's median MAD noise are flagged dead.
+    noisy_factor: float, optional, default = 5.
+        Channels with MAD noise above this multiple of the probe's median MAD noise are flagged noisy.
+    n_threads: int, optional, default = 4
+        Number of chunks processed at the same time.
+
+    Returns
+    ----------
+    noise: dict
+        rms_uv, mad_uv: noise per channel in microvolts. MAD noise is the median over chunks of median(|x - median(x)|)/0.6745.
+        saturated_samples, saturated_fraction: raw samples at or beyond saturation_level per channel.
+        dead_channels, noisy_channels: boolean flags per channel.
+        plus the gain factor and settings used, and the number of seconds sampled.
+    """
+    recording = open_recording(raw_data_file, n_channels=n_channels, sample_rate=sample_rate, gain_factor=gain_factor)
+    preprocessor = Preprocessor(highpass_hz=highpass_hz, sample_rate=sample_rate, reference=None)
+    chunk_samples = min(max(int(chunk_seconds*sample_rate), 1), recording.n_samples)
+    n_chunks = max(min(n_chunks, recording.n_samples // chunk_samples), 1)
+    chunk_starts = np.linspace(0, recording.n_samples - chunk_samples, n_chunks).astype(np.int64)
+
+    results = []
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        window = 2*n_threads
+        for w in range(0, n_chunks, window):
+            futures = []
+            for start in chunk_starts[w:w+window]:
+                # reads stay on this thread, compressed recordings share one file handle
+                data = read_padded(recording.data, start - preprocessor.margin, start + chunk_samples + preprocessor.margin)
+                futures.append(executor.submit(chunk_noise_stats, data, preprocessor, saturation_level))
+            results.extend([future.result() for future in futures])
+
+    sum_squares = np.sum([r[0] for r in results], axis=0)
+    n_samples = np.sum([r[1] for r in results])
+    mad = np.median([r[2] for r in results], axis=0)
+    saturated = np.sum([r[3] for r in results], axis=0)
+    median_mad = np.median(mad)
+    return {'rms_uv': np.sqrt(sum_squares/n_samples) * recording.gain_factor,
+            'mad_uv': mad * recording.gain_factor,
+            'saturated_samples': saturated,
+            'saturated_fraction': saturated / n_samples,
+            'dead_channels': mad < dead_fraction*median_mad,
+            'noisy_channels': mad > noisy_factor*median_mad,
+            'seconds_sampled': n_samples / sample_rate,
+            'gain_factor': recording.gain_factor,
+            'highpass_hz': highpass_hz,
+            'saturation_level': saturation_level,
+            'dead_fraction': dead_fraction,
+            'noisy_factor': noisy_factor}
+
+def get_channel_noise(raw_data_file, overwrite=False, **kwargs):
+    """
+    channel_noise_stats() for a recording, cached in a sidecar JSON (continuous_noise.json) next to the data.
+    The cache is reused while the data file's size and modification time and the settings are unchanged.
+
+    Parameters
+    ----------
+    raw_data_file: path
+        Path to continuous.dat (or continuous.cdat).
+    overwrite: bool, optional, default = False
+        Recompute even if the cache is valid.
+    **kwargs:
+        Passed to channel_noise_stats().
+
+    Returns
+    ----------
+    noise: dict
+        see channel_noise_stats(). Per-channel values are numpy arrays.
+    """
+    cache_file = os.path.join(os.path.dirname(raw_data_file), os.path.splitext(os.path.basename(raw_data_file))[0] + '_noise.json')
+    file_stat = os.stat(raw_data_file)
+    key = {'source_size': file_stat.st_size, 'source_mtime': file_stat.st_mtime, 'settings': kwargs}
+    if overwrite==False and os.path.exists(cache_file):
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+        if cached.get('key') == key:
+            return {k: np.asarray(v) if isinstance(v, list) else v for k, v in cached['noise'].items()}
+
+    print('Measuring channel noise for {}'.format(raw_data_file))
+    noise = channel_noise_stats(raw_data_file, **kwargs)
+    with open(cache_file, 'w') as f:
+        json.dump({'key': key,
+                    'noise': {k: v.tolist() if isinstance(v, np.ndarray) else v for k, v in noise.items()}}, f)
+    return noise
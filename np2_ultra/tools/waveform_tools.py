@@ -0,0 +1,508 @@
+import numpy as np
+
+import np2_ultra.tools.analysis_tools as ant
+import np2_ultra.tools.signal_tools as st
+from np2_ultra.tools.file_tools import open_recording
+
+
+def get_snippet_starts(spike_times, extraction_params, n_samples):
+    """
+    Convert spike peak times into snippet start samples and flag snippets that fall off either end of the recording.
+
+    Parameters
+    ----------
+    spike_times: array
+        Spike peak times in samples, any shape.
+    extraction_params: dict
+        Waveform extraction parameters, see GetWaveforms.waveform_extraction_params()
+    n_samples: int
+        Number of samples in the raw data.
+
+    Returns
+    ----------
+    starts: array
+        Start sample of each snippet, same shape as spike_times. Out of bounds snippets are clipped to 0.
+    valid: array
+        Boolean array, True where the full snippet is inside the recording.
+    """
+    starts = np.asarray(spike_times).astype(np.int64) - extraction_params['pre_samples']
+    valid = (starts >= 0) & (starts + extraction_params['samples_per_spike'] <= n_samples)
+    starts = np.where(valid, starts, 0)
+    return starts, valid
+
+def get_peak_channel(cluster_spike_templates, templates):
+    """
+    Find the channel with the largest template amplitude for a cluster.
+
+    Parameters
+    ----------
+    cluster_spike_templates: array
+        Kilosort template assignment (spike_templates.npy) of every spike in the cluster.
+    templates: array
+        Kilosort templates (templates.npy), shape (n_templates, n_timepoints, n_sorted_channels).
+
+    Returns
+    ----------
+    peak_idx: int
+        Index of the peak channel into channel_map/channel_positions.
+    """
+    template_id = np.argmax(np.bincount(np.asarray(cluster_spike_templates).reshape(-1)))
+    template = templates[template_id]
+    return int(np.argmax(template.max(0) - template.min(0)))
+
+def get_channel_neighbourhood(peak_idx, channel_positions, radius):
+    """
+    Get the sorted channels within a radius of the peak channel.
+
+    Parameters
+    ----------
+    peak_idx: int
+        Index of the peak channel into channel_positions, see get_peak_channel()
+    channel_positions: array
+        Kilosort channel_positions.npy, shape (n_sorted_channels, 2) in microns.
+    radius: float
+        Radius in microns around the peak channel.
+
+    Returns
+    ----------
+    neighbour_idx: array
+        Indices into channel_map/channel_positions of every channel within the radius, in channel_map order.
+    """
+    distance = np.sqrt(np.sum((channel_positions - channel_positions[peak_idx])**2, axis=1))
+    return np.where(distance <= radius)[0]
+
+def draw_bootstrap_spikes(spike_times, extraction_params, n_samples):
+    """
+    Draw every bootstrap resample for a cluster and reduce the draws to the distinct spikes that need reading.
+    Draws use the global numpy random state in the same order as ant.bootstrap_resample called once per bootstrap.
+
+    Parameters
+    ----------
+    spike_times: array
+        Spike times (in samples) of the cluster.
+    extraction_params: dict
+        Waveform extraction parameters, see GetWaveforms.waveform_extraction_params()
+    n_samples: int
+        Number of samples in the raw data.
+
+    Returns
+    ----------
+    starts: array
+        Snippet start sample of each distinct drawn spike, in time order.
+    valid: array
+        Boolean array, True where the distinct spike's snippet is inside the recording.
+    inverse: array
+        Index into starts of every draw, shape (n_boots, tot_waveforms).
+    """
+    n_boots = extraction_params['n_boots']
+    n_draws = extraction_params['tot_waveforms']
+
+    spike_times = np.asarray(spike_times).reshape(-1)
+    times_boot = ant.bootstrap_resample(spike_times, n=n_boots*n_draws)
+    unique_times, inverse = np.unique(times_boot, return_inverse=True)
+    starts, valid = get_snippet_starts(unique_times, extraction_params, n_samples)
+    return starts, valid, inverse.reshape(n_boots, n_draws)
+
+def read_snippets(data, starts, samples_per_spike, channels=None, preprocessor=None):
+    """
+    Read fixed length snippets from the raw data in a single fancy-indexed read.
+
+    Parameters
+    ----------
+    data: array
+        Raw data with shape (n_samples, n_channels).
+    starts: array
+        Start sample of each snippet.
+    samples_per_spike: int
+        Length of each snippet in samples.
+    channels: array, optional, default = None
+        Raw data channels to read. None reads every channel.
+    preprocessor: signal_tools.Preprocessor, optional, default = None
+        If given, each snippet is read with preprocessor.margin extra samples on either side (repeating the first or last
+        sample at the ends of the recording) across every channel, then referenced and high-pass filtered.
+
+    Returns
+    ----------
+    snippets: array
+        Snippets with shape starts.shape + (samples_per_spike, n_channels), in the dtype of data (float32 if preprocessed).
+    """
+    if preprocessor is not None:
+        margin = preprocessor.margin
+        sample_idx = np.asarray(starts)[..., np.newaxis] + np.arange(-margin, samples_per_spike + margin)
+        return preprocessor.apply(data[np.clip(sample_idx, 0, data.shape[0]-1)], channels=channels)
+    sample_idx = np.asarray(starts)[..., np.newaxis] + np.arange(samples_per_spike)
+    if channels is None:
+        return data[sample_idx]
+    return data[sample_idx[..., np.newaxis], np.asarray(channels)]
+
+class BootstrapAccumulator():
+    """
+    Running (Welford-style) per-bootstrap mean and variance for one cluster, so the full stack of snippets is never held in memory.
+    Snippets can be added in any order and in any number of blocks. Each block's weighted statistics are merged into
+    the running statistics with the parallel form of Welford's algorithm (Chan et al.), which stays stable in float32.
+    Each distinct spike is weighted by the number of times every bootstrap drew it.
+
+    Methods
+    ----------
+    add(snippet_idx, snippets)
+    finalize()
+    """
+    def __init__(self, valid, inverse, n_channels, samples_per_spike, dtype='float64'):
+        """
+        Parameters
+        ----------
+        valid: array
+            Boolean array of distinct spikes whose snippet is inside the recording, see draw_bootstrap_spikes()
+        inverse: array
+            Index of every draw into the distinct spikes, shape (n_boots, tot_waveforms), see draw_bootstrap_spikes()
+        n_channels: int
+            Number of channels in each snippet.
+        samples_per_spike: int
+            Length of each snippet in samples.
+        dtype: str, optional, default = 'float64'
+            Accumulation precision. 'float32' halves accumulator memory.
+        """
+        self.dtype = np.dtype(dtype)
+        n_boots = inverse.shape[0]
+        boot_rows = np.repeat(np.arange(n_boots), inverse.shape[1])
+        draws = inverse.reshape(-1)
+        keep = valid[draws]
+        self.weights = np.zeros((n_boots, valid.size), dtype=self.dtype)
+        np.add.at(self.weights, (boot_rows[keep], draws[keep]), 1)
+
+        self.shape = (samples_per_spike, n_channels)
+        self.count = np.zeros((n_boots, 1), dtype=self.dtype)
+        self.mean = np.zeros((n_boots, samples_per_spike*n_channels), dtype=self.dtype)
+        self.M2 = np.zeros(self.mean.shape, dtype=self.dtype)
+
+    def add(self, snippet_idx, snippets):
+        """
+        Add a block of raw snippets to every bootstrap that drew them.
+
+        Parameters
+        ----------
+        snippet_idx: array
+            Index of each snippet into the distinct spikes.
+        snippets: array
+            Raw snippets, shape (len(snippet_idx), samples_per_spike, n_channels).
+        """
+        waveforms = snippets.astype(self.dtype)
+        waveforms -= waveforms[:, :1, :]
+        waveforms = waveforms.reshape(waveforms.shape[0], -1)
+        weights = self.weights[:, snippet_idx]
+
+        # statistics of the block, shifted by its unweighted mean for stability
+        shift = waveforms.mean(0)
+        waveforms -= shift
+        block_count = weights.sum(1, keepdims=True)
+        safe_count = np.where(block_count == 0, 1, block_count)
+        block_mean = (weights @ waveforms) / safe_count
+        block_M2 = weights @ waveforms**2 - block_count * block_mean**2
+        block_mean += shift
+
+        # merge into the running statistics
+        total = self.count + block_count
+        safe_total = np.where(total == 0, 1, total)
+        delta = block_mean - self.mean
+        self.mean += delta * (block_count / safe_total)
+        self.M2 += block_M2 + delta**2 * (self.count * block_count / safe_total)
+        self.count = total
+
+    def finalize(self):
+        """
+        Returns
+        ----------
+        waveform: array
+            Mean baseline-subtracted waveform across bootstraps, shape (samples_per_spike, n_channels).
+        SNR: array
+            Mean signal to noise ratio across bootstraps, shape (samples_per_spike, n_channels).
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(self.count == 0, np.nan, self.mean)
+            sd = np.sqrt(np.maximum(self.M2 / self.count, 0))
+            SNR = np.where(sd == 0, 0, mean/sd)
+        return np.mean(mean, 0).reshape(self.shape), np.mean(SNR, 0).reshape(self.shape)
+
+def extract_bootstrap_waveforms(data, spike_times, extraction_params, channels=None, preprocessor=None):
+    """
+    Bootstrap averaged waveform and SNR for a single cluster.
+    Each distinct spike drawn by the bootstraps is read from the raw data once, in time order, in blocks of
+    extraction_params['snippet_block_size'] snippets. Every block is added to a BootstrapAccumulator,
+    so memory scales with the output and the block size rather than with tot_waveforms.
+    Draws use the global numpy random state in the same order as ant.bootstrap_resample called once per bootstrap.
+
+    Parameters
+    ----------
+    data: array
+        Raw data with shape (n_samples, n_channels), eg the transpose of GetFiles.get_raw_data()
+    spike_times: array
+        Spike times (in samples) of the cluster.
+    extraction_params: dict
+        Waveform extraction parameters, see GetWaveforms.waveform_extraction_params()
+    channels: array, optional, default = None
+        Only read and average these raw data channels. None uses every channel.
+    preprocessor: signal_tools.Preprocessor, optional, default = None
+        Reference and high-pass filter snippets before averaging, see read_snippets()
+
+    Returns
+    ----------
+    waveform: array
+        Mean baseline-subtracted waveform across bootstraps, shape (samples_per_spike, n_channels).
+    SNR: array
+        Mean signal to noise ratio across bootstraps, shape (samples_per_spike, n_channels).
+    """
+    samples_per_spike = extraction_params['samples_per_spike']
+    block_size = extraction_params.get('snippet_block_size', 256)
+
+    starts, valid, inverse = draw_bootstrap_spikes(spike_times, extraction_params, data.shape[0])
+    n_channels = data.shape[1] if channels is None else len(channels)
+    accumulator = BootstrapAccumulator(valid, inverse, n_channels, samples_per_spike,
+                                        dtype=extraction_params.get('accumulator_dtype', 'float64'))
+
+    snippet_idx = np.where(valid)[0]
+    for block in range(0, snippet_idx.size, block_size):
+        block_idx = snippet_idx[block:block+block_size]
+        accumulator.add(block_idx, read_snippets(data, starts[block_idx], samples_per_spike, channels=channels, preprocessor=preprocessor))
+
+    return accumulator.finalize()
+
+def get_accumulator_bytes(n_channels, extraction_params):
+    """
+    Memory taken by the running mean and M2 arrays of one cluster's BootstrapAccumulator.
+
+    Parameters
+    ----------
+    n_channels: int
+        Number of channels extracted for the cluster.
+    extraction_params: dict
+        Waveform extraction parameters, see GetWaveforms.waveform_extraction_params()
+    """
+    itemsize = np.dtype(extraction_params.get('accumulator_dtype', 'float64')).itemsize
+    return 2 * extraction_params['n_boots'] * extraction_params['samples_per_spike'] * n_channels * itemsize
+
+def batch_stream_clusters(cluster_jobs, draws, n_channels, extraction_params):
+    """
+    Split clusters into passes over the raw data so the accumulators that are open at any one time in a pass fit in
+    extraction_params['stream_memory_mb']. An accumulator is only open from the chunk holding its cluster's first
+    snippet to the chunk holding its last (see stream_cluster_batch()), so clusters whose spikes span different parts
+    of the recording share a pass. Clusters are packed into the first pass with room, in order of their first snippet.
+
+    Parameters
+    ----------
+    cluster_jobs: list
+        List of (cluster_num, spike_times, channels) tuples, see extract_bootstrap_waveforms()
+    draws: list
+        (starts, valid, inverse) of each cluster, see draw_bootstrap_spikes()
+    n_channels: int
+        Number of channels in the raw data, used for clusters extracted on every channel.
+    extraction_params: dict
+        Waveform extraction parameters, see GetWaveforms.waveform_extraction_params()
+
+    Returns
+    ----------
+    batches: list
+        Lists of indices into cluster_jobs, one per pass. Every pass has at least one cluster.
+    """
+    budget = extraction_params.get('stream_memory_mb', 1024) * 2**20
+    chunk_samples = extraction_params.get('stream_chunk_samples', 300000)
+    spans = []
+    for n, (starts, valid, inverse) in enumerate(draws):
+        valid_starts = starts[valid]
+        if valid_starts.size == 0:
+            spans.append((-1, -1, n))
+        else:
+            spans.append((int(valid_starts.min()) // chunk_samples, int(valid_starts.max()) // chunk_samples, n))
+
+    batches = []
+    open_accumulators = []
+    for first_chunk, last_chunk, n in sorted(spans):
+        channels = cluster_jobs[n][2]
+        cluster_bytes = get_accumulator_bytes(n_channels if channels is None else len(channels), extraction_params)
+        for batch, still_open in zip(batches, open_accumulators):
+            still_open[:] = [(end, size) for end, size in still_open if end >= first_chunk]
+            if len(still_open) == 0 or sum([size for end, size in still_open]) + cluster_bytes <= budget:
+                break
+        else:
+            batch, still_open = [], []
+            batches.append(batch)
+            open_accumulators.append(still_open)
+        batch.append(n)
+        still_open.append((last_chunk, cluster_bytes))
+    return [sorted(batch) for batch in batches]
+
+def stream_extract_waveforms(data, cluster_jobs, extraction_params, random_seed=None, preprocessor=None):
+    """
+    Bootstrap averaged waveforms and SNR for a set of clusters from time-ordered passes over the raw data.
+    Snippet start samples for every cluster are sorted, and the data is read in large sequential chunks
+    (extraction_params['stream_chunk_samples'], overlapping by one snippet so none are split across chunk edges).
+    Each snippet is added to its cluster's BootstrapAccumulator. Chunks without any snippets are skipped.
+    Each cluster's accumulator is made at its first snippet and finalized after its last, and clusters are split into
+    passes so the accumulators open at any one time stay within extraction_params['stream_memory_mb']
+    (see batch_stream_clusters()).
+
+    Parameters
+    ----------
+    data: array
+        Raw data with shape (n_samples, n_channels).
+    cluster_jobs: list
+        List of (cluster_num, spike_times, channels) tuples, see extract_bootstrap_waveforms()
+    extraction_params: dict
+        Waveform extraction parameters, see GetWaveforms.waveform_extraction_params()
+    random_seed: int, optional, default = None
+        see extract_cluster_set()
+    preprocessor: signal_tools.Preprocessor, optional, default = None
+        If given, every chunk is read with preprocessor.margin extra samples on either side and preprocessed as a whole.
+
+    Returns
+    ----------
+    results: dict
+        Dictionary of cluster_num: (waveform, SNR)
+    """
+    draws = []
+    for n, (cluster_num, spike_times, channels) in enumerate(cluster_jobs):
+        if random_seed is not None:
+            np.random.seed([random_seed, cluster_num])
+        draws.append(draw_bootstrap_spikes(spike_times, extraction_params, data.shape[0]))
+
+    batches = batch_stream_clusters(cluster_jobs, draws, data.shape[1], extraction_params)
+    results = {}
+    for b, batch in enumerate(batches):
+        if len(batches) > 1:
+            print('Streaming pass {} of {}, {} clusters'.format(b+1, len(batches), len(batch)))
+        results.update(stream_cluster_batch(data, [cluster_jobs[n] for n in batch], [draws[n] for n in batch],
+                                            extraction_params, preprocessor=preprocessor))
+    return results
+
+def stream_cluster_batch(data, cluster_jobs, draws, extraction_params, preprocessor=None):
+    """
+    One time-ordered pass over the raw data for a batch of clusters, see stream_extract_waveforms().
+
+    Parameters
+    ----------
+    data: array
+        Raw data with shape (n_samples, n_channels).
+    cluster_jobs: list
+        List of (cluster_num, spike_times, channels) tuples, see extract_bootstrap_waveforms()
+    draws: list
+        (starts, valid, inverse) of each cluster, see draw_bootstrap_spikes()
+    extraction_params: dict
+        Waveform extraction parameters, see GetWaveforms.waveform_extraction_params()
+    preprocessor: signal_tools.Preprocessor, optional, default = None
+        see stream_extract_waveforms()
+
+    Returns
+    ----------
+    results: dict
+        Dictionary of cluster_num: (waveform, SNR)
+    """
+    samples_per_spike = extraction_params['samples_per_spike']
+    chunk_samples = extraction_params.get('stream_chunk_samples', 300000)
+    n_samples = data.shape[0]
+
+    request_starts = []
+    request_cluster = []
+    request_idx = []
+    for n, (starts, valid, inverse) in enumerate(draws):
+        request_starts.append(starts[valid])
+        request_cluster.append(np.full(valid.sum(), n))
+        request_idx.append(np.where(valid)[0])
+
+    order = np.argsort(np.concatenate(request_starts), kind='stable')
+    request_starts = np.concatenate(request_starts)[order]
+    request_cluster = np.concatenate(request_cluster)[order]
+    request_idx = np.concatenate(request_idx)[order]
+    last_request = np.full(len(cluster_jobs), -1)
+    last_request[request_cluster] = np.arange(request_cluster.size)
+
+    def make_accumulator(n):
+        starts, valid, inverse = draws[n]
+        channels = cluster_jobs[n][2]
+        return BootstrapAccumulator(valid, inverse, data.shape[1] if channels is None else len(channels), samples_per_spike,
+                                    dtype=extraction_params.get('accumulator_dtype', 'float64'))
+
+    results = {}
+    accumulators = {}
+    for chunk_start in range(0, n_samples, chunk_samples):
+        first, last = np.searchsorted(request_starts, [chunk_start, chunk_start+chunk_samples])
+        if first == last:
+            continue
+        chunk_end = min(chunk_start+chunk_samples+samples_per_spike, n_samples)
+        if preprocessor is None:
+            chunk = np.asarray(data[chunk_start:chunk_end])
+        else:
+            chunk = preprocessor.apply(st.read_padded(data, chunk_start-preprocessor.margin, chunk_end+preprocessor.margin))
+        chunk_starts = request_starts[first:last] - chunk_start
+        chunk_clusters = request_cluster[first:last]
+        chunk_idx = request_idx[first:last]
+        for n in np.unique(chunk_clusters):
+            in_cluster = chunk_clusters == n
+            snippets = read_snippets(chunk, chunk_starts[in_cluster], samples_per_spike, channels=cluster_jobs[n][2])
+            if n not in accumulators:
+                accumulators[n] = make_accumulator(n)
+            accumulators[n].add(chunk_idx[in_cluster], snippets)
+            # the cluster's last snippet has been read, so its accumulator can go
+            if last_request[n] < last:
+                results[cluster_jobs[n][0]] = accumulators.pop(n).finalize()
+        print('Streamed {:.0f}% of raw data'.format(100*min(chunk_start+chunk_samples, n_samples)/n_samples))
+
+    # clusters without any snippets inside the recording
+    for n in np.where(last_request < 0)[0]:
+        results[cluster_jobs[n][0]] = make_accumulator(n).finalize()
+    return results
+
+def open_raw_data(raw_data_file, n_channels=384):
+    """
+    Open a continuous.dat file as a read-only memmap with shape (n_samples, n_channels).
+    A compressed continuous.cdat file is opened as a CompressedRecording, which is indexed the same way.
+
+    Parameters
+    ----------
+    raw_data_file: path
+        Path to the continuous.dat or continuous.cdat file.
+    n_channels: int, optional, default = 384
+        Number of channels interleaved in the file.
+    """
+    return open_recording(raw_data_file, n_channels=n_channels).data
+
+def extract_cluster_set(raw_data_file, cluster_jobs, extraction_params, random_seed=None):
+    """
+    Extract bootstrap waveforms for a set of clusters from one probe.
+    Opens its own memmap of the raw data, so it can be used as the target of a worker process.
+    extraction_params['strategy'] chooses between reading each cluster's snippets at random ('random', the default)
+    and a single time-ordered pass over the file for all of the clusters ('stream', see stream_extract_waveforms()).
+    If extraction_params['highpass_hz'] is set and extraction_params['preprocess_mode'] is 'on_the_fly', snippets are
+    referenced and high-pass filtered as they are read (see signal_tools.Preprocessor). In 'cached' mode the caller
+    passes the preprocessed copy made by signal_tools.get_preprocessed_file() instead.
+
+    Parameters
+    ----------
+    raw_data_file: path
+        Path to the probe's continuous.dat file.
+    cluster_jobs: list
+        List of (cluster_num, spike_times, channels) tuples, see extract_bootstrap_waveforms()
+    extraction_params: dict
+        Waveform extraction parameters, see GetWaveforms.waveform_extraction_params()
+    random_seed: int, optional, default = None
+        If given, the random state is reseeded with (random_seed, cluster_num) before every cluster,
+        so results do not depend on how clusters are split between workers.
+        If None, the current global random state is used.
+
+    Returns
+    ----------
+    results: dict
+        Dictionary of cluster_num: (waveform, SNR)
+    """
+    data = open_raw_data(raw_data_file, extraction_params['n_channels'])
+    preprocessor = None
+    if extraction_params.get('preprocess_mode', 'on_the_fly') == 'on_the_fly':
+        preprocessor = st.get_preprocessor(extraction_params)
+    if extraction_params.get('strategy', 'random') == 'stream':
+        return stream_extract_waveforms(data, cluster_jobs, extraction_params, random_seed=random_seed, preprocessor=preprocessor)
+
+    results = {}
+    for n, (cluster_num, spike_times, channels) in enumerate(cluster_jobs):
+        print('Analyzing cluster {}, number {} of {}'.format(cluster_num, n+1, len(cluster_jobs)))
+        if random_seed is not None:
+            np.random.seed([random_seed, cluster_num])
+        results[cluster_num] = extract_bootstrap_waveforms(data, spike_times, extraction_params, channels=channels, preprocessor=preprocessor)
+    return results
@@ -0,0 +1,25 @@
+import numpy as np
+import pytest
+
+import np2_ultra.tools.analysis_tools as ant
+
+
+@pytest.mark.parametrize('shuffle', [False, True])
+def test_population_psth_matches_getPSTH_per_cluster(shuffle):
+    rng = np.random.RandomState(0)
+    spike_times = np.sort(rng.uniform(0, 100, 20000))
+    if shuffle:
+        spike_times[::50] = rng.uniform(0, 100, spike_times[::50].size)
+    spike_index = ant.SpikeIndex(rng.randint(0, 40, spike_times.size))
+    cluster_ids = [3, 0, 39, 17, 500]
+    startTimes = rng.uniform(0, 98, 60)
+    # windows starting and ending exactly on spikes
+    startTimes[:3] = spike_times[spike_index.spikes_in_cluster(3)[:3]]
+    startTimes[3] = spike_times[spike_index.spikes_in_cluster(0)[5]] - 0.5
+
+    counts, t = ant.get_population_psth(spike_times, spike_index, cluster_ids, startTimes, 0.5, binSize=0.01)
+    assert counts.shape == (len(cluster_ids), startTimes.size, t.size)
+    for n, cluster in enumerate(cluster_ids):
+        expected, expected_t = ant.getPSTH(spike_times[spike_index.spikes_in_cluster(cluster)], startTimes, 0.5, binSize=0.01, avg=False)
+        np.testing.assert_array_equal(counts[n], expected)
+        np.testing.assert_array_equal(t, expected_t)
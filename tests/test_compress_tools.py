@@ -0,0 +1,34 @@
+import numpy as np
+
+import np2_ultra.tools.compress_tools as ct
+
+
+def write_raw(path, n_samples=10000, n_channels=8):
+    data = np.random.RandomState(2).randint(-300, 300, size=(n_samples, n_channels)).astype(np.int16)
+    data.tofile(str(path))
+    return data
+
+
+def test_round_trip_verifies(tmp_path):
+    raw_data_file = tmp_path / 'continuous.dat'
+    data = write_raw(raw_data_file)
+    compressed_file = ct.compress_file(str(raw_data_file), n_channels=8, chunk_samples=700, n_threads=2)
+    assert ct.verify_compressed_file(compressed_file, str(raw_data_file), n_threads=2, buffer_chunks=3)
+
+    decoded_file = ct.decompress_file(compressed_file, str(tmp_path / 'decoded.dat'), n_threads=2)
+    np.testing.assert_array_equal(np.fromfile(decoded_file, dtype=np.int16).reshape(data.shape), data)
+    assert ct.verify_compressed_file(compressed_file, decoded_file)
+
+
+def test_verify_catches_changed_and_truncated_data(tmp_path):
+    raw_data_file = tmp_path / 'continuous.dat'
+    data = write_raw(raw_data_file)
+    compressed_file = ct.compress_file(str(raw_data_file), n_channels=8, chunk_samples=700)
+
+    changed = data.copy()
+    changed[9000, 3] += 1
+    changed.tofile(str(tmp_path / 'changed.dat'))
+    assert not ct.verify_compressed_file(compressed_file, str(tmp_path / 'changed.dat'))
+
+    data[:-1].tofile(str(tmp_path / 'truncated.dat'))
+    assert not ct.verify_compressed_file(compressed_file, str(tmp_path / 'truncated.dat'))
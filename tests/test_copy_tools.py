@@ -0,0 +1,51 @@
+import os
+
+import np2_ultra.tools.copy_tools as ctl
+
+
+def write_files(folder, names):
+    os.makedirs(str(folder), exist_ok=True)
+    for name in names:
+        with open(os.path.join(str(folder), name), 'wb') as f:
+            f.write(os.urandom(1000))
+
+
+def test_stage_copies_only_selected_files(tmp_path):
+    src_dir = tmp_path / 'probe'
+    write_files(src_dir, ['continuous.dat', 'chanMap.mat', 'continuous.cdat', 'lfp.dat', 'spike_times.npy'])
+    scratch = ctl.ScratchCache(str(tmp_path / 'scratch'), 1e6)
+
+    local = scratch.stage('probe', str(src_dir))
+    assert len(os.listdir(local)) == 5
+    scratch.release('probe')
+
+    local = scratch.stage('probe', str(src_dir), files=['continuous.dat', 'chan*.mat'])
+    assert sorted(os.listdir(local)) == ['chanMap.mat', 'continuous.dat']
+    assert sorted(scratch.entries['probe']['files']) == ['chanMap.mat', 'continuous.dat']
+    assert scratch.entries['probe']['bytes'] == 2000
+
+    write_files(local, ['rez.mat'])
+    assert scratch.sync_back('probe', str(src_dir)) == ['rez.mat']
+    assert os.path.exists(os.path.join(str(src_dir), 'rez.mat'))
+
+
+def test_manifest_lists_files_before_they_are_sized(tmp_path):
+    src_dir = tmp_path / 'acq'
+    write_files(src_dir, ['continuous.dat', 'sync.h5'])
+    dst_dir = tmp_path / 'dest'
+    os.makedirs(str(dst_dir))
+    manifest_file = str(dst_dir / 'transfer_manifest.json')
+    copier = ctl.CopyEngine(n_threads=2, manifest=[ctl.TransferManifest(manifest_file)])
+    pairs = [(str(src_dir / name), str(dst_dir / name)) for name in ['continuous.dat', 'sync.h5']]
+
+    copier.prepare_files(pairs)
+    # as if the copy was killed here: the placeholders are on disk, and the saved manifest knows they aren't finished
+    on_disk = ctl.TransferManifest(manifest_file)
+    assert all([os.path.getsize(dst) == 1000 for src, dst in pairs])
+    assert sorted(on_disk.incomplete_files()) == ['continuous.dat', 'sync.h5']
+
+    ctl.CopyEngine(n_threads=2, manifest=[on_disk]).copy_files(pairs)
+    assert ctl.TransferManifest(manifest_file).unfinished([dst for src, dst in pairs]) == []
+    for src, dst in pairs:
+        with open(src, 'rb') as a, open(dst, 'rb') as b:
+            assert a.read() == b.read()
@@ -0,0 +1,74 @@
+import os
+import json
+
+import np2_ultra.tools.engine_tools as et
+
+
+def script_writer(folder, script, root=None):
+    def write_script(gpu_device):
+        with open(os.path.join(folder, script + '.m'), 'w') as f:
+            if root is not None:
+                f.write("rootZ = '{}';\n".format(root))
+            f.write("gpuDevice({});\n".format(gpu_device))
+        return script
+    return write_script
+
+
+class CrashingBackend(et.FakeMatlabBackend):
+    """
+    Engines stop responding once a script has failed, like a MATLAB session that crashed.
+    """
+    def is_alive(self, engine):
+        return engine.alive and (len(engine.calls) == 0 or engine.calls[-1][1] not in self.fail_scripts)
+
+
+def test_service_runs_jobs_on_warm_engines(tmp_path):
+    backend = et.FakeMatlabBackend(run_seconds=0.05, write_outputs=False)
+    folders = [str(tmp_path / name) for name in ['a', 'b']]
+    with et.EngineService(backend, n_engines=2) as service:
+        futures = [service.submit(folders[n % 2], 'script_{}'.format(n), description=n) for n in range(6)]
+        assert [future.result() for future in futures] == list(range(6))
+    assert len(backend.engines) == 2
+    assert service.jobs_run == 6
+    assert sorted([call for engine in backend.engines for call in engine.calls]) == \
+            sorted([(folders[n % 2], 'script_{}'.format(n)) for n in range(6)])
+    for engine in backend.engines:
+        assert len(engine.path) == len(set(engine.path))
+        assert engine.alive == False
+
+
+def test_scheduler_retries_and_records_failures(tmp_path):
+    backend = et.FakeMatlabBackend(fail_scripts=('ks_bad',))
+    jobs_file = str(tmp_path / 'kilosort_jobs.json')
+    roots = {name: str(tmp_path / name) for name in ['good', 'bad']}
+    for root in roots.values():
+        os.makedirs(root)
+    finished = []
+    with et.EngineService(backend, n_engines=2) as service:
+        scheduler = et.JobScheduler(service, jobs_file=jobs_file, gpu_devices=[1, 2], max_attempts=2)
+        for name, root in roots.items():
+            scheduler.add(name, str(tmp_path), script_writer(str(tmp_path), 'ks_' + name, root),
+                            finish=lambda name=name: finished.append(name), probe=name)
+        jobs = scheduler.run()
+
+    assert jobs['good']['state'] == 'done' and jobs['good']['attempts'] == 1
+    assert os.path.exists(os.path.join(roots['good'], 'rez.mat'))
+    assert jobs['bad']['state'] == 'failed' and jobs['bad']['attempts'] == 2
+    assert [error['error'] for error in jobs['bad']['errors']] == ['RuntimeError: ks_bad failed']*2
+    assert all([error['gpu_device'] in [1, 2] for error in jobs['bad']['errors']])
+    assert finished == ['good']
+    assert list(scheduler.failures().keys()) == ['bad']
+    with open(jobs_file, 'r') as f:
+        saved = json.load(f)
+    assert saved['bad']['state'] == 'failed' and saved['good']['probe'] == 'good'
+
+
+def test_crashed_engine_is_replaced(tmp_path):
+    backend = CrashingBackend(fail_scripts=('crash',), write_outputs=False)
+    with et.EngineService(backend, n_engines=1) as service:
+        failed = service.submit(str(tmp_path), 'crash')
+        assert service.run(str(tmp_path), 'sort', description='sorted') == 'sorted'
+    assert isinstance(failed.exception(), RuntimeError)
+    assert len(backend.engines) == 2
+    assert [call[1] for call in backend.engines[0].calls] == ['crash']
+    assert [call[1] for call in backend.engines[1].calls] == ['sort']
@@ -0,0 +1,31 @@
+import os
+
+import numpy as np
+
+import np2_ultra.tools.signal_tools as st
+
+
+def test_preprocessed_copy_is_remade_when_it_no_longer_matches(tmp_path):
+    raw_data_file = str(tmp_path / 'continuous.dat')
+    np.random.RandomState(3).randint(-300, 300, size=(30000, 4)).astype(np.int16).tofile(raw_data_file)
+    extraction_params = {'n_channels': 4, 'highpass_hz': 300., 'highpass_taps': 101, 'reference': 'median'}
+
+    preprocessed_file = st.get_preprocessed_file(raw_data_file, extraction_params, n_threads=2)
+    assert sorted(os.listdir(str(tmp_path))) == ['continuous.dat', 'continuous_preprocessed.dat', 'continuous_preprocessed.json']
+    first = np.fromfile(preprocessed_file, dtype=np.int16)
+    made = os.stat(preprocessed_file).st_mtime_ns
+    assert st.get_preprocessed_file(raw_data_file, extraction_params) == preprocessed_file
+    assert os.stat(preprocessed_file).st_mtime_ns == made
+
+    # a partial copy with its old metadata still in place
+    with open(preprocessed_file, 'r+b') as f:
+        f.truncate(1000)
+    st.get_preprocessed_file(raw_data_file, extraction_params, n_threads=2)
+    np.testing.assert_array_equal(np.fromfile(preprocessed_file, dtype=np.int16), first)
+
+    # the source is transferred again with different data
+    np.random.RandomState(4).randint(-300, 300, size=(20000, 4)).astype(np.int16).tofile(raw_data_file)
+    os.utime(raw_data_file, (1e9, 1e9))
+    st.get_preprocessed_file(raw_data_file, extraction_params, n_threads=2)
+    assert os.path.getsize(preprocessed_file) == 20000*4*2
+    assert st.read_sidecar_metadata(preprocessed_file)['source_mtime'] == 1e9
@@ -0,0 +1,114 @@
+import numpy as np
+import pytest
+
+import np2_ultra.tools.analysis_tools as ant
+import np2_ultra.tools.waveform_tools as wt
+
+
+def old_bootstrap_waveforms(data, times_for_cluster, extraction_params):
+    """
+    The per-bootstrap extraction loop from GetWaveforms.get_waveforms before it was vectorized.
+    """
+    samples_per_spike = extraction_params['samples_per_spike']
+    pre_samples = extraction_params['pre_samples']
+    tot_waveforms = extraction_params['tot_waveforms']
+    waveform_boots = np.zeros((extraction_params['n_boots'], samples_per_spike, data.shape[1]))
+    SNR_boots = np.zeros(waveform_boots.shape)
+    for i in range(extraction_params['n_boots']):
+        times_boot = ant.bootstrap_resample(times_for_cluster, n=tot_waveforms)
+        waveforms = np.zeros((samples_per_spike, data.shape[1], tot_waveforms))
+        bad_spikes = []
+        for wv_idx in range(0, tot_waveforms):
+            peak_time = times_boot[wv_idx][0]
+            raw_waveform = data[int(peak_time-pre_samples):int(peak_time+samples_per_spike-pre_samples), :]
+            if raw_waveform.shape[0] < samples_per_spike:
+                bad_spikes.append(wv_idx)
+                continue
+            waveforms[:, :, wv_idx] = raw_waveform - np.tile(raw_waveform[0, :], (samples_per_spike, 1))
+        if len(bad_spikes) > 0:
+            waveforms = waveforms[:, :, np.setdiff1d(np.arange(tot_waveforms), bad_spikes)]
+        SNR_boots[i, :, :] = ant.signaltonoise(waveforms, axis=2)
+        waveform_boots[i, :, :] = np.mean(waveforms, 2)
+    return np.mean(waveform_boots, 0), np.mean(SNR_boots, 0)
+
+
+@pytest.fixture
+def raw_data(tmp_path):
+    rng = np.random.RandomState(1)
+    n_samples, n_channels = 20000, 8
+    raw_data_file = tmp_path / 'continuous.dat'
+    data = np.memmap(str(raw_data_file), dtype='int16', mode='w+', shape=(n_samples, n_channels))
+    data[:] = rng.randint(-200, 200, size=(n_samples, n_channels))
+    data.flush()
+    # spikes near the end of the file fall off it, and are dropped by both versions
+    spike_times = np.sort(np.concatenate([rng.randint(100, n_samples-100, 60), [n_samples-20, n_samples-5]])).reshape(-1, 1)
+    return np.memmap(str(raw_data_file), dtype='int16', mode='r', shape=(n_samples, n_channels)), spike_times
+
+
+@pytest.fixture
+def extraction_params():
+    return {'n_channels': 8,
+            'tot_waveforms': 50,
+            'samples_per_spike': 30,
+            'pre_samples': 10,
+            'n_boots': 20,
+            'snippet_block_size': 7}
+
+
+@pytest.mark.parametrize('dtype, rtol', [('float64', 1e-9), ('float32', 1e-3)])
+def test_matches_per_bootstrap_extraction(raw_data, extraction_params, dtype, rtol):
+    data, spike_times = raw_data
+    extraction_params['accumulator_dtype'] = dtype
+
+    np.random.seed(0)
+    old_waveform, old_SNR = old_bootstrap_waveforms(data, spike_times, extraction_params)
+    np.random.seed(0)
+    waveform, SNR = wt.extract_bootstrap_waveforms(data, spike_times, extraction_params)
+
+    np.testing.assert_allclose(waveform, old_waveform, rtol=rtol, atol=rtol)
+    np.testing.assert_allclose(SNR, old_SNR, rtol=rtol, atol=rtol)
+
+
+def test_stream_matches_per_bootstrap_extraction(raw_data, extraction_params):
+    data, spike_times = raw_data
+    extraction_params['stream_chunk_samples'] = 3000
+    split = spike_times.size // 2
+    cluster_jobs = [(3, spike_times[:split], None), (7, spike_times[split:], None)]
+
+    results = wt.stream_extract_waveforms(data, cluster_jobs, extraction_params, random_seed=5)
+    for cluster_num, times_for_cluster, channels in cluster_jobs:
+        np.random.seed([5, cluster_num])
+        old_waveform, old_SNR = old_bootstrap_waveforms(data, times_for_cluster, extraction_params)
+        np.testing.assert_allclose(results[cluster_num][0], old_waveform, rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(results[cluster_num][1], old_SNR, rtol=1e-9, atol=1e-9)
+
+
+def test_stream_batches_match_single_pass(raw_data, extraction_params):
+    data, spike_times = raw_data
+    cluster_jobs = [(c, spike_times[c::4], None) for c in range(4)]
+
+    single_pass = wt.stream_extract_waveforms(data, cluster_jobs, extraction_params, random_seed=5)
+    extraction_params['stream_memory_mb'] = 0.1
+    draws = [wt.draw_bootstrap_spikes(times, extraction_params, data.shape[0]) for c, times, channels in cluster_jobs]
+    assert len(wt.batch_stream_clusters(cluster_jobs, draws, data.shape[1], extraction_params)) == 4
+    batched = wt.stream_extract_waveforms(data, cluster_jobs, extraction_params, random_seed=5)
+    for cluster_num in single_pass:
+        np.testing.assert_array_equal(batched[cluster_num][0], single_pass[cluster_num][0])
+        np.testing.assert_array_equal(batched[cluster_num][1], single_pass[cluster_num][1])
+
+
+def test_stream_clusters_in_different_parts_of_the_recording_share_a_pass(raw_data, extraction_params):
+    data, spike_times = raw_data
+    extraction_params['stream_chunk_samples'] = 2000
+    extraction_params['stream_memory_mb'] = 0.1
+    times = spike_times.reshape(-1)
+    cluster_jobs = [(c, times[(times >= c*5000) & (times < c*5000 + 4000)].reshape(-1, 1), None) for c in range(4)]
+    draws = [wt.draw_bootstrap_spikes(t, extraction_params, data.shape[0]) for c, t, channels in cluster_jobs]
+    assert wt.batch_stream_clusters(cluster_jobs, draws, data.shape[1], extraction_params) == [[0, 1, 2, 3]]
+
+    results = wt.stream_extract_waveforms(data, cluster_jobs, extraction_params, random_seed=5)
+    for cluster_num, times_for_cluster, channels in cluster_jobs:
+        np.random.seed([5, cluster_num])
+        waveform, SNR = wt.extract_bootstrap_waveforms(data, times_for_cluster, extraction_params)
+        np.testing.assert_allclose(results[cluster_num][0], waveform, rtol=1e-9, atol=1e-9)
+        np.testing.assert_allclose(results[cluster_num][1], SNR, rtol=1e-9, atol=1e-9)